@@ -1,7 +1,7 @@
 import streamlit as st
 import time
 import json
-from utils import game_state, openrouter, storyteller
+from utils import game_state, openrouter, storyteller, http_api, generation, profiling, handoff, presence, room_feed
 
 # Import but don't use socket handler yet - it's available for external integration
 from utils import socket_handler
@@ -19,21 +19,40 @@ if "player_name" not in st.session_state:
 if "room_code" not in st.session_state:
     st.session_state.room_code = None
 if "game_phase" not in st.session_state:
-    st.session_state.game_phase = "welcome"  # welcome, create_room, join_room, lobby, game, results
-if "last_refresh" not in st.session_state:
-    st.session_state.last_refresh = time.time()
+    st.session_state.game_phase = "welcome"  # welcome, create_room, join_room, lobby, game, results, spectate
+if "spectator" not in st.session_state:
+    st.session_state.spectator = False  # Watching the room rather than playing
 if "player_count" not in st.session_state:
     st.session_state.player_count = 0
 if "last_status_check" not in st.session_state:
     st.session_state.last_status_check = time.time()
 if "last_update_timestamp" not in st.session_state:
     st.session_state.last_update_timestamp = 0
+if "last_seen_version" not in st.session_state:
+    st.session_state.last_seen_version = 0
 if "current_suspect" not in st.session_state:
     st.session_state.current_suspect = None
 if "needs_refresh" not in st.session_state:
     st.session_state.needs_refresh = False
 if "refresh_counter" not in st.session_state:
     st.session_state.refresh_counter = 0
+if "css_injected" not in st.session_state:
+    st.session_state.css_injected = False  # The page keeps the styles until it is reloaded
+
+# Serve the long-poll room API alongside Streamlit, and the public room feed that
+# pushes room changes to browsers (no-op after the first run)
+http_api.start_api_server()
+http_api.start_feed_server()
+
+# Compress the stories of ended and abandoned games (no-op after the first run)
+game_state.start_compactor()
+
+# Load rooms handed off by a previous server process and watch for later handoffs
+# (no-op after the first run)
+handoff.start_watcher()
+
+# Keep players online while their browser stays connected (no-op after the first run)
+presence.start_heartbeats()
 
 # Register a callback for game state changes - this would be used for WebSocket integration
 # This is optional and can be enabled when integrating with external platforms
@@ -45,6 +64,15 @@ def restore_session_from_query_params():
         player_name = st.query_params["player_name"]
         room_code = st.query_params["room_code"]
         
+        # Spectators aren't kept across restarts, so rejoin as one
+        if st.query_params.get("spectator") == "1":
+            if game_state.join_as_spectator(room_code, player_name):
+                st.session_state.player_name = player_name
+                st.session_state.room_code = room_code
+                st.session_state.spectator = True
+                st.session_state.game_phase = "spectate"
+            return
+        
         # Check if room exists
         room_summary = game_state.get_room_summary(room_code)
         if room_summary and player_name in room_summary["players"]:
@@ -52,7 +80,7 @@ def restore_session_from_query_params():
             st.session_state.room_code = room_code
             
             # Set appropriate game phase based on room status
-            if room_summary["status"] == "lobby":
+            if room_summary["status"] in ["lobby", "setup"]:
                 st.session_state.game_phase = "lobby"
             elif room_summary["status"] == "playing":
                 st.session_state.game_phase = "game"
@@ -64,23 +92,15 @@ def update_query_params():
     if st.session_state.player_name and st.session_state.room_code:
         st.query_params["player_name"] = st.session_state.player_name
         st.query_params["room_code"] = st.session_state.room_code
+        if st.session_state.spectator:
+            st.query_params["spectator"] = "1"
+        elif "spectator" in st.query_params:
+            del st.query_params["spectator"]
     else:
         # Clear all query parameters
         for key in list(st.query_params.keys()):
             del st.query_params[key]
 
-# Refresh very frequently (every 0.5 seconds) to update game state
-def auto_refresh():
-    current_time = time.time()
-    # Use a longer interval to reduce browser strain but still maintain responsiveness
-    if current_time - st.session_state.last_refresh > 2.0:
-        st.session_state.last_refresh = current_time
-        check_for_updates()
-        # Only rerun if there are actual changes detected
-        if st.session_state.needs_refresh:
-            st.session_state.needs_refresh = False
-            st.rerun()
-
 # Check for any updates in game state
 def check_for_updates():
     # Initialize the refresh flag
@@ -107,8 +127,9 @@ def check_for_updates():
         st.session_state.player_count = current_player_count
         st.session_state.needs_refresh = True
     
-    # Check if there's a new update based on the timestamp
-    if room_summary["last_update"] != st.session_state.last_update_timestamp:
+    # Check if there's a new update based on the room version
+    if room_summary["version"] != st.session_state.last_seen_version:
+        st.session_state.last_seen_version = room_summary["version"]
         st.session_state.last_update_timestamp = room_summary["last_update"]
         st.session_state.needs_refresh = True
         
@@ -157,12 +178,18 @@ def create_room_page():
         submit = st.form_submit_button("Create Room")
         
         if submit and player_name:
-            st.session_state.player_name = player_name
             room_code, _ = game_state.create_game_room(player_name)
-            st.session_state.room_code = room_code
-            st.session_state.game_phase = "lobby"
-            update_query_params()
-            st.rerun()
+            if room_code is None:
+                st.warning("This server is shutting down and can't create new rooms.")
+                redirect_link = handoff.get_redirect_link()
+                if redirect_link:
+                    st.markdown(f"[Create your room on the new server]({redirect_link})")
+            else:
+                st.session_state.player_name = player_name
+                st.session_state.room_code = room_code
+                st.session_state.game_phase = "lobby"
+                update_query_params()
+                st.rerun()
     
     if st.button("Back"):
         st.session_state.game_phase = "welcome"
@@ -175,9 +202,20 @@ def join_room_page():
     with st.form("join_room_form"):
         room_code = st.text_input("Room Code", max_chars=6).upper()
         player_name = st.text_input("Your Name", max_chars=20)
+        spectate = st.checkbox("Watch as a spectator", help="Follow the game without playing")
         submit = st.form_submit_button("Join")
         
-        if submit and room_code and player_name:
+        if submit and room_code and player_name and spectate:
+            if game_state.join_as_spectator(room_code, player_name):
+                st.session_state.player_name = player_name
+                st.session_state.room_code = room_code
+                st.session_state.spectator = True
+                st.session_state.game_phase = "spectate"
+                update_query_params()
+                st.rerun()
+            else:
+                st.error("Could not watch the room. Check the room code, or pick a name no player is using.")
+        elif submit and room_code and player_name:
             # Try to join the room
             joined = game_state.join_game_room(room_code, player_name)
             
@@ -187,7 +225,7 @@ def join_room_page():
                 
                 # Determine game phase from room status
                 room_summary = game_state.get_room_summary(room_code)
-                if room_summary["status"] == "lobby":
+                if room_summary["status"] in ["lobby", "setup"]:
                     st.session_state.game_phase = "lobby"
                 elif room_summary["status"] == "playing":
                     st.session_state.game_phase = "game"
@@ -243,20 +281,37 @@ def lobby_page():
     player_list_container = st.container()
     with player_list_container:
         st.markdown("### Players:")
+        online_players = room_summary.get("online_players", ())
         for idx, p in enumerate(room_summary["players"]):
+            status = "🟢" if p in online_players else "⚪ (offline)"
             if p == room_summary["admin"]:
-                st.markdown(f"{idx+1}. {p} (Admin)")
+                st.markdown(f"{idx+1}. {p} (Admin) {status}")
             else:
-                st.markdown(f"{idx+1}. {p}")
+                st.markdown(f"{idx+1}. {p} {status}")
     
     # Track player count changes to update session state
     current_player_count = len(room_summary["players"])
     if not hasattr(st.session_state, "player_count") or current_player_count != st.session_state.player_count:
         st.session_state.player_count = current_player_count
-        # We no longer need to call st.rerun() here as the auto_refresh will handle it
+        # No st.rerun() needed here, the room feed reruns the page when players join
+    
+    # Story generation progress is shared by everyone in the room
+    if room_summary["status"] == "setup":
+        # The room feed reruns the page on each progress update and when the game starts
+        elapsed = int(time.time() - (room_summary.get("setup_started") or time.time()))
+        st.info(f"⏳ {room_summary.get('setup_progress') or 'Creating story...'} (started {elapsed}s ago). "
+                "The game is being prepared. It will start automatically for everyone.")
+        
+        if player_info["is_admin"]:
+            if st.button("Cancel Start"):
+                generation.cancel_game_start(room_code)
+                st.rerun()
     
-    # Admin controls
-    if player_info["is_admin"]:
+    if room_summary.get("setup_error"):
+        st.error(room_summary["setup_error"])
+    
+    # Admin controls, hidden while the story is being written
+    if player_info["is_admin"] and room_summary["status"] == "lobby":
         st.markdown("### Admin Controls")
         
         min_players = 3
@@ -265,27 +320,19 @@ def lobby_page():
         if not can_start:
             st.warning(f"At least {min_players} players are required to start the game.")
         
+        offline_players = [p for p in room_summary["players"] if p not in room_summary.get("online_players", ())]
+        if offline_players:
+            st.warning(f"Offline: {', '.join(offline_players)}. They may have closed the game.")
+        
         start_col, settings_col = st.columns([1, 1])
         
         with start_col:
             if st.button("Start Game", disabled=not can_start):
-                with st.spinner("Creating story..."):
-                    try:
-                        # Generate story
-                        num_players = len(room_summary["players"])
-                        story_data = storyteller.generate_game_story(num_players)
-                        
-                        # Start the game
-                        success = game_state.start_game(room_code, story_data)
-                        
-                        if success:
-                            st.session_state.game_phase = "game"
-                            update_query_params()
-                            st.rerun()
-                        else:
-                            st.error("Failed to start the game.")
-                    except Exception as e:
-                        st.error(f"Error starting game: {str(e)}")
+                # Generation runs in the background; duplicate clicks join the same job
+                if generation.request_game_start(room_code):
+                    st.rerun()
+                else:
+                    st.error("Failed to start the game.")
     
     # Leave game button
     if st.button("Leave Game"):
@@ -303,8 +350,8 @@ def lobby_page():
     # Show current player count for visibility
     st.info(f"Currently {current_player_count} players in the room")
     
-    # Auto-refresh to update player list
-    auto_refresh()
+    # Follow the game starting
+    check_for_updates()
 
 # Game page
 def game_page():
@@ -323,12 +370,17 @@ def game_page():
         update_query_params()
         st.rerun()
     
+    # A game left idle has its story compressed; bring it back for display
+    if room_summary.get("compacted"):
+        room_summary = game_state.expand_room(room_code)
+    
     # Update tracking variables for state changes
     st.session_state.last_update_timestamp = room_summary.get("last_update", 0)
+    st.session_state.last_seen_version = room_summary.get("version", 0)
     st.session_state.current_suspect = room_summary.get("current_suspect")
     
     # If game is still in lobby, redirect to lobby
-    if room_summary["status"] == "lobby":
+    if room_summary["status"] in ["lobby", "setup"]:
         st.session_state.game_phase = "lobby"
         st.rerun()
     
@@ -413,6 +465,20 @@ def game_page():
                 suspect = room_summary["current_suspect"]
                 st.warning(f"Admin suspects: **{suspect}**")
             
+            # Outcome of the last vote
+            vote_result = room_summary.get("vote_result")
+            if vote_result:
+                st.markdown(storyteller.format_vote_result(vote_result))
+            
+            discussion_deadline = room_summary.get("discussion_deadline")
+            if discussion_deadline:
+                seconds_left = max(0, int(discussion_deadline - time.time()))
+                st.info(f"Discussion ends in {seconds_left}s, then everyone votes.")
+            
+            vote = room_summary.get("vote")
+            if vote:
+                voting_section(room_code, player_name, player_info, vote)
+            
             # Admin controls for suspect selection
             if player_info["is_admin"]:
                 st.markdown("### Admin Controls")
@@ -438,7 +504,7 @@ def game_page():
                     
                     # Accuse button (only show if suspect is selected)
                     with col2:
-                        if room_summary.get("current_suspect"):
+                        if room_summary.get("current_suspect") and not vote:
                             if st.button("Accuse Suspect", type="primary"):
                                 result = game_state.process_admin_accusation(room_code)
                                 if "error" not in result:
@@ -446,6 +512,25 @@ def game_page():
                                     st.rerun()
                                 else:
                                     st.error(f"Error processing accusation: {result['error']}")
+                
+                # Or let every player still in the game vote
+                if vote:
+                    if st.button("Close Vote Now"):
+                        game_state.close_voting(room_code, vote["id"])
+                        st.session_state.needs_refresh = True
+                        st.rerun()
+                else:
+                    col1, col2 = st.columns([1, 1])
+                    with col1:
+                        if not discussion_deadline and st.button("Start Discussion Timer"):
+                            if game_state.start_discussion(room_code):
+                                st.session_state.needs_refresh = True
+                                st.rerun()
+                    with col2:
+                        if st.button("Open Vote"):
+                            if game_state.open_voting(room_code):
+                                st.session_state.needs_refresh = True
+                                st.rerun()
             else:
                 # Non-admin players see status of accusation
                 st.info("Wait for the admin to select a suspect based on your offline discussion.")
@@ -463,9 +548,59 @@ def game_page():
                 st.markdown("### Eliminated Players")
                 for eliminated in room_summary["eliminated_players"]:
                     st.markdown(f"- {eliminated}")
+            
+            chat_section(room_code, player_name, can_post=not player_info["is_eliminated"])
     
-    # Auto-refresh to update game state
-    auto_refresh()
+    # Follow the game ending or being reset
+    check_for_updates()
+
+def chat_section(room_code, player_name=None, can_post=False):
+    st.markdown("### Chat")
+    # Filled in after the form so a message sent on this run is included
+    log = st.empty()
+    
+    if can_post:
+        with st.form("chat_form", clear_on_submit=True):
+            text = st.text_input("Message", max_chars=game_state.CHAT_MAX_LENGTH, label_visibility="collapsed",
+                                 placeholder="Say something to the room...")
+            if st.form_submit_button("Send") and text.strip():
+                result = game_state.post_message(room_code, player_name, text)
+                if "error" in result:
+                    st.error(result["error"])
+    
+    # The browser streams new messages into the log itself. Only a browser that can't
+    # reach the chat feed gets the messages from the app, on each run.
+    messages = None
+    if st.session_state.get("chat_log"):
+        update = game_state.get_messages(room_code)
+        messages = list(update["messages"]) if update else []
+    with log:
+        room_feed.chat_log(room_code, player_name, messages, key="chat_log")
+
+# Ballot for the open vote, shown to everyone in the game
+def voting_section(room_code, player_name, player_info, vote):
+    seconds_left = max(0, int(vote["deadline"] - time.time()))
+    title = "Revote" if vote["revote"] else "Vote"
+    st.markdown(f"### {title}: {len(vote['voted'])} of {len(vote['voters'])} votes in, "
+                f"closes in {seconds_left}s")
+    
+    for candidate, count in sorted(vote["tallies"].items(), key=lambda item: -item[1]):
+        st.markdown(f"- **{candidate}**: {count} vote{'s' if count != 1 else ''}")
+    
+    if player_name not in vote["voters"]:
+        st.info("Only players still in the game can vote.")
+    elif player_name in vote["voted"]:
+        st.success("Your vote is in. Waiting for the other players...")
+    else:
+        options = [p for p in vote["candidates"] if p != player_name]
+        choice = st.selectbox("Vote to accuse:", options, key=f"vote_{vote['round']}_{vote['revote']}")
+        if st.button("Cast Vote", type="primary"):
+            result = game_state.cast_vote(room_code, player_name, choice)
+            if "error" in result:
+                st.error(result["error"])
+            else:
+                st.session_state.needs_refresh = True
+                st.rerun()
 
 # Results page
 def results_page():
@@ -484,7 +619,7 @@ def results_page():
         st.rerun()
     
     # If game is not ended, redirect to appropriate page
-    if room_summary["status"] == "lobby":
+    if room_summary["status"] in ["lobby", "setup"]:
         st.session_state.game_phase = "lobby"
         st.rerun()
     elif room_summary["status"] == "playing":
@@ -500,12 +635,10 @@ def results_page():
         winner = "civilians"
         
         # Find the Mafia player
-        for p_name in room_summary["players"]:
-            p_info = game_state.get_player_info(room_code, p_name)
-            if p_info and p_info.get("is_mafia"):
-                suspected_player = p_name
-                character_name = p_info["character_name"]
-                break
+        mafia_players = game_state.get_mafia_players(room_code)
+        if mafia_players:
+            suspected_player = next(iter(mafia_players))
+            character_name = game_state.get_private_view(room_code, suspected_player)["character_name"]
     
     elif room_summary["game_result"] == "mafia_wins":
         winner = "mafia"
@@ -538,41 +671,83 @@ def results_page():
         update_query_params()
         st.rerun()
 
+# Spectator page
+def spectator_page():
+    room_code = st.session_state.room_code
+    spectator_name = st.session_state.player_name
+    
+    # Every spectator of the room shares one view, rendered once per change
+    view = game_state.get_public_view(room_code)
+    
+    if not view:
+        st.error("Room not found. Returning to the home page.")
+        st.session_state.player_name = None
+        st.session_state.room_code = None
+        st.session_state.spectator = False
+        st.session_state.game_phase = "welcome"
+        update_query_params()
+        st.rerun()
+    
+    st.session_state.last_seen_version = view["version"]
+    
+    st.title(f"Watching Room {room_code}")
+    st.caption(f"You are watching as {spectator_name}. {view['spectator_count']} watching.")
+    
+    st.markdown(view["markdown"])
+    
+    # Spectators can read the players' chat but not post
+    if view["status"] in ["playing", "ended"]:
+        chat_section(room_code)
+    
+    if st.button("Stop Watching"):
+        game_state.remove_spectator(room_code, spectator_name)
+        st.session_state.player_name = None
+        st.session_state.room_code = None
+        st.session_state.spectator = False
+        st.session_state.game_phase = "welcome"
+        update_query_params()
+        st.rerun()
+    
+    check_for_updates()
+
+# Styles for the whole app, added to the page once per session by the room feed
+APP_CSS = """
+.main .block-container {
+    padding-top: 2rem;
+    padding-bottom: 2rem;
+}
+.stButton button {
+    background-color: #FF4B4B;
+    color: white;
+}
+"""
+
 # Main app control flow
 def main():
     # Restore session from URL parameters if coming from a refresh
     restore_session_from_query_params()
     
-    # Add custom CSS for styling
-    st.markdown("""
-    <style>
-    .main .block-container {
-        padding-top: 2rem;
-        padding-bottom: 2rem;
-    }
-    .stButton button {
-        background-color: #FF4B4B;
-        color: white;
-    }
-    </style>
-    """, unsafe_allow_html=True)
-    
-    # Add JavaScript for periodic refresh that's gentler on the browser
-    st.markdown("""
-    <script>
-    // Set up periodic refresh without full page reload
-    const intervalId = setInterval(function() {
-        // This triggers a "heartbeat" to keep the session alive and check for updates
-        const time = new Date().getTime();
-        fetch(`/_stcore/stream?n=${time}`, { method: 'GET' });
-    }, 3000); // Check every 3 seconds
-    
-    // Clean up on page unload
-    window.addEventListener('beforeunload', function() {
-        clearInterval(intervalId);
-    });
-    </script>
-    """, unsafe_allow_html=True)
+    # Once this process has handed its rooms off, send players to the new one
+    if game_state.get_drain_state() == "handed_off":
+        st.warning("This game has moved to a new server.")
+        redirect_link = handoff.get_redirect_link(st.session_state.room_code, st.session_state.player_name,
+                                                  st.session_state.spectator)
+        if redirect_link:
+            st.markdown(f"[Continue your game]({redirect_link})")
+        else:
+            st.info("Reload the page in a moment to continue where you left off.")
+        return
+    
+    # Heartbeat for this session's player or spectator, see utils/presence.py
+    presence.track_session(st.session_state.room_code, st.session_state.player_name)
+    
+    # Rerun whenever the room changes, pushed by the browser's room feed (see
+    # utils/room_feed.py). The feed also adds the app's styles on the first run.
+    room_summary = game_state.get_room_summary(st.session_state.room_code) if st.session_state.room_code else None
+    room_feed.follow_room(st.session_state.room_code if room_summary else None,
+                          room_summary["version"] if room_summary else 0,
+                          css=None if st.session_state.css_injected else APP_CSS)
+    st.session_state.css_injected = True
     
     # Display appropriate page based on game phase
     if st.session_state.game_phase == "welcome":
@@ -587,6 +762,9 @@ def main():
         game_page()
     elif st.session_state.game_phase == "results":
         results_page()
+    elif st.session_state.game_phase == "spectate":
+        spectator_page()
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    # Each rerun is one profiled scope when profiling is switched on (see utils/profiling.py)
+    profiling.run("app.main", main)
\ No newline at end of file
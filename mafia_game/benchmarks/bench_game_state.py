@@ -0,0 +1,296 @@
+"""
+GameState throughput benchmark.
+
+Drives the utils.game_state module API with simulated rooms and players and reports
+ops/sec and p50/p99 latency per scenario. Each scenario runs against a fresh
+GameState instance.
+
+Usage (from the mafia_game directory):
+    python benchmarks/bench_game_state.py                          # run and print
+    python benchmarks/bench_game_state.py --save-baseline          # store benchmarks/baseline.json
+    python benchmarks/bench_game_state.py --compare                # compare with the stored baseline
+    python benchmarks/bench_game_state.py --rooms 5000 --threads 16 --scenario summary_reads_mt
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import game_state
+from utils.event_log import EVENT_LOG_DIR
+from utils.storyteller import generate_fallback_story
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+class Recorder:
+    """
+    Collects per-operation latencies, safe to share between threads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.wall_start = None
+        self.wall_end = None
+
+    def timed(self, fn, *args):
+        start = time.perf_counter_ns()
+        result = fn(*args)
+        elapsed = time.perf_counter_ns() - start
+        with self._lock:
+            self.latencies.append(elapsed)
+        return result
+
+    def __enter__(self):
+        self.wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall_end = time.perf_counter()
+
+    def report(self):
+        ordered = sorted(self.latencies)
+        count = len(ordered)
+        wall = (self.wall_end - self.wall_start) if self.wall_end else 0.0
+
+        def pct(p):
+            return ordered[min(count - 1, int(count * p))] / 1000.0 if count else 0.0
+
+        return {
+            "ops": count,
+            "seconds": round(wall, 4),
+            "ops_per_sec": round(count / wall, 1) if wall > 0 else 0.0,
+            "p50_us": round(pct(0.50), 2),
+            "p99_us": round(pct(0.99), 2),
+        }
+
+
+def fresh_state():
+    # The module-level functions resolve _instance on every call, so swapping it
+    # isolates scenarios from each other. With EVENT_LOG_DIR set, each scenario logs
+    # to its own subdirectory so it measures the logging cost without replaying others.
+    log_dir = tempfile.mkdtemp(dir=EVENT_LOG_DIR) if EVENT_LOG_DIR else None
+    game_state._instance = game_state.GameState(event_log_dir=log_dir)
+    return game_state._instance
+
+
+def make_stories(count, players):
+    # Generate outside the timed region; the fallback generator prints on every call
+    with contextlib.redirect_stdout(io.StringIO()):
+        return [generate_fallback_story(players) for _ in range(count)]
+
+
+def setup_rooms(rooms, players, start=False):
+    codes = []
+    stories = make_stories(rooms, players) if start else None
+    for r in range(rooms):
+        code, _ = game_state.create_game_room("admin")
+        for i in range(1, players):
+            game_state.join_game_room(code, f"player{i}")
+        if start:
+            game_state.start_game(code, stories[r])
+        codes.append(code)
+    return codes
+
+
+def run_threads(count, target):
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def scenario_create(args):
+    fresh_state()
+    rec = Recorder()
+    with rec:
+        for _ in range(args.rooms):
+            rec.timed(game_state.create_game_room, "admin")
+    return rec
+
+
+def scenario_join_burst(args):
+    fresh_state()
+    codes = setup_rooms(args.rooms, 1)
+    rec = Recorder()
+    with rec:
+        for code in codes:
+            for i in range(1, args.players):
+                rec.timed(game_state.join_game_room, code, f"player{i}")
+    return rec
+
+
+def scenario_join_burst_mt(args):
+    # Every thread joins a player into every room at once, as when a code is shared
+    fresh_state()
+    codes = setup_rooms(args.rooms, 1)
+    rec = Recorder()
+
+    def worker(idx):
+        for code in codes:
+            rec.timed(game_state.join_game_room, code, f"thread{idx}")
+
+    with rec:
+        run_threads(args.threads, worker)
+    return rec
+
+
+def scenario_start(args):
+    fresh_state()
+    codes = setup_rooms(args.rooms, args.players)
+    stories = make_stories(args.rooms, args.players)
+    rec = Recorder()
+    with rec:
+        for code, story in zip(codes, stories):
+            rec.timed(game_state.start_game, code, story)
+    return rec
+
+
+def scenario_suspect_accuse(args):
+    fresh_state()
+    codes = setup_rooms(args.rooms, args.players, start=True)
+    rng = random.Random(args.seed)
+    rec = Recorder()
+    with rec:
+        for code in codes:
+            while True:
+                summary = game_state.get_room_summary(code)
+                if summary["status"] != "playing":
+                    break
+                alive = [p for p in summary["players"] if p not in summary["eliminated_players"]]
+                rec.timed(game_state.set_admin_suspect, code, rng.choice(alive))
+                rec.timed(game_state.process_admin_accusation, code)
+    return rec
+
+
+def scenario_summary_reads(args):
+    # Every simulated player polls its room summary once per "tick"
+    fresh_state()
+    codes = setup_rooms(args.rooms, args.players, start=True)
+    rec = Recorder()
+    with rec:
+        for _ in range(args.ticks):
+            for code in codes:
+                for _ in range(args.players):
+                    rec.timed(game_state.get_room_summary, code)
+    return rec
+
+
+def scenario_summary_reads_mt(args):
+    # Poller threads read while one writer keeps changing suspects
+    fresh_state()
+    codes = setup_rooms(args.rooms, args.players, start=True)
+    rec = Recorder()
+    stop = threading.Event()
+
+    def writer():
+        rng = random.Random(args.seed)
+        while not stop.is_set():
+            game_state.set_admin_suspect(rng.choice(codes), f"player{rng.randint(1, args.players - 1)}")
+
+    def reader(idx):
+        rng = random.Random(idx)
+        for _ in range(args.ticks * len(codes) * args.players // args.threads):
+            rec.timed(game_state.get_room_summary, rng.choice(codes))
+
+    writer_thread = threading.Thread(target=writer)
+    writer_thread.start()
+    with rec:
+        run_threads(args.threads, reader)
+    stop.set()
+    writer_thread.join()
+    return rec
+
+
+def scenario_cleanup(args):
+    # Time a full sweep that removes every room
+    fresh_state()
+    setup_rooms(args.rooms, args.players)
+    rec = Recorder()
+    with rec:
+        rec.timed(game_state.cleanup_stale_rooms, -1)
+    rec.latencies = [rec.latencies[0] // max(1, args.rooms)] * args.rooms  # Per-room cost
+    return rec
+
+
+SCENARIOS = {
+    "create": scenario_create,
+    "join_burst": scenario_join_burst,
+    "join_burst_mt": scenario_join_burst_mt,
+    "start": scenario_start,
+    "suspect_accuse": scenario_suspect_accuse,
+    "summary_reads": scenario_summary_reads,
+    "summary_reads_mt": scenario_summary_reads_mt,
+    "cleanup": scenario_cleanup,
+}
+
+
+def print_results(results, baseline=None):
+    header = f"{'scenario':<18}{'ops':>10}{'ops/sec':>14}{'p50 us':>10}{'p99 us':>10}"
+    if baseline:
+        header += f"{'vs base':>10}"
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        line = f"{name:<18}{r['ops']:>10}{r['ops_per_sec']:>14,.0f}{r['p50_us']:>10.1f}{r['p99_us']:>10.1f}"
+        base = (baseline or {}).get(name)
+        if base and base.get("ops_per_sec"):
+            delta = (r["ops_per_sec"] - base["ops_per_sec"]) / base["ops_per_sec"] * 100
+            line += f"{delta:>+9.1f}%"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rooms", type=int, default=2000)
+    parser.add_argument("--players", type=int, default=6)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--ticks", type=int, default=5, help="Polling rounds in the summary read scenarios")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="Run only this scenario (repeatable)")
+    parser.add_argument("--json", help="Write results to this file")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline file for --compare/--save-baseline")
+    parser.add_argument("--compare", action="store_true", help="Show change against the baseline")
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the baseline")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    results = {}
+    for name in args.scenario or SCENARIOS:
+        results[name] = SCENARIOS[name](args).report()
+
+    baseline = None
+    if args.compare and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    print(f"rooms={args.rooms} players={args.players} threads={args.threads} python={platform.python_version()}")
+    print_results(results, baseline)
+
+    payload = {
+        "config": {k: getattr(args, k) for k in ("rooms", "players", "threads", "ticks", "seed")},
+        "python": platform.python_version(),
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(payload, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(payload, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
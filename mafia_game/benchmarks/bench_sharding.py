@@ -0,0 +1,126 @@
+"""
+Room sharding benchmark.
+
+Plays the same set of complete games (create, joins, start, polling, suspect and
+accuse until the game ends) from many client threads, first against an in-process
+GameState and then against ShardRouter with each requested number of worker
+processes, and reports throughput and latency for each.
+
+Every call to a shard is a pickled round trip, which costs more than most GameState
+operations themselves, so a single shard is slower than no sharding. Throughput should
+then grow with the shard count until the shards run out of cores or the router
+process, which pickles every call, becomes the bottleneck. Set EVENT_LOG_DIR to
+include the event log's encoding work, which moves into the shards.
+
+Usage (from the mafia_game directory):
+    python benchmarks/bench_sharding.py                          # 0 (in-process), 1, 2 and 4 shards
+    python benchmarks/bench_sharding.py --shards 0,2,4,8 --rooms 2000 --threads 32
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_game_state import Recorder, make_stories, run_threads
+from utils import game_state
+from utils.event_log import EVENT_LOG_DIR
+from utils.sharding import ShardRouter
+
+
+def play_game(rec, story, players, rng):
+    code, _ = rec.timed(game_state.create_game_room, "admin")
+    for i in range(1, players):
+        rec.timed(game_state.join_game_room, code, f"player{i}")
+    rec.timed(game_state.start_game, code, story)
+    for i in range(1, players):
+        rec.timed(game_state.get_private_view, code, f"player{i}")
+
+    while True:
+        # Every player polls once per round
+        for _ in range(players):
+            summary = rec.timed(game_state.get_room_summary, code)
+        if summary["status"] != "playing":
+            return
+        alive = [p for p in summary["players"] if p not in summary["eliminated_players"] and p != "admin"]
+        rec.timed(game_state.set_admin_suspect, code, rng.choice(alive))
+        rec.timed(game_state.process_admin_accusation, code)
+
+
+def run(shard_count, stories, args):
+    log_dir = tempfile.mkdtemp(dir=EVENT_LOG_DIR) if EVENT_LOG_DIR else ""
+    if shard_count:
+        state = ShardRouter(shard_count, event_log_dir=log_dir)
+    else:
+        state = game_state.GameState(event_log_dir=log_dir)
+    game_state._instance = state
+
+    rec = Recorder()
+    next_game = iter(range(len(stories)))
+    lock = threading.Lock()
+
+    def client(idx):
+        rng = random.Random(args.seed + idx)
+        while True:
+            with lock:
+                game = next(next_game, None)
+            if game is None:
+                return
+            play_game(rec, stories[game], args.players, rng)
+
+    try:
+        with rec:
+            run_threads(args.threads, client)
+    finally:
+        if shard_count:
+            state.close()
+    return rec.report()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", default="0,1,2,4",
+                        help="Comma-separated shard counts to compare; 0 runs in-process")
+    parser.add_argument("--rooms", type=int, default=500, help="Games to play in each run")
+    parser.add_argument("--players", type=int, default=6)
+    parser.add_argument("--threads", type=int, default=16, help="Client threads playing games at once")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    shard_counts = [int(count) for count in args.shards.split(",")]
+    stories = make_stories(args.rooms, args.players)
+
+    results = {}
+    for shard_count in shard_counts:
+        results[shard_count] = run(shard_count, stories, args)
+
+    print(f"rooms={args.rooms} players={args.players} threads={args.threads} "
+          f"cpus={os.cpu_count()} python={platform.python_version()}")
+    header = f"{'shards':<12}{'ops':>10}{'ops/sec':>14}{'p50 us':>10}{'p99 us':>10}{'speedup':>10}"
+    print(header)
+    print("-" * len(header))
+    base = results[shard_counts[0]]["ops_per_sec"]
+    for shard_count, r in results.items():
+        label = str(shard_count) if shard_count else "in-process"
+        speedup = r["ops_per_sec"] / base if base else 0.0
+        print(f"{label:<12}{r['ops']:>10}{r['ops_per_sec']:>14,.0f}{r['p50_us']:>10.1f}{r['p99_us']:>10.1f}"
+              f"{speedup:>9.2f}x")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "config": {k: getattr(args, k) for k in ("rooms", "players", "threads", "seed")},
+                "cpus": os.cpu_count(),
+                "python": platform.python_version(),
+                "results": {str(k): v for k, v in results.items()},
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Room summary read throughput under concurrent writers.
+
+Compares the lock-free snapshot read (get_room_summary) against the previous
+approach of building a fresh summary under the lock on every call.
+
+Usage (from the mafia_game directory):
+    python benchmarks/bench_snapshot_reads.py --rooms 200 --readers 8 --writers 2 --seconds 5
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.game_state import GameState
+from utils.storyteller import generate_fallback_story
+
+
+def build_rooms(state, num_rooms, players_per_room):
+    codes = []
+    for _ in range(num_rooms):
+        code, _ = state.create_game_room("admin")
+        for i in range(1, players_per_room):
+            state.join_game_room(code, f"player{i}")
+        state.start_game(code, generate_fallback_story(players_per_room))
+        codes.append(code)
+    return codes
+
+
+def copying_read(state, room_code):
+    # The pre-snapshot read path: lock, then build a new summary dict
+    with state._lock:
+        room = state.game_rooms.get(room_code)
+        return state._build_summary(room) if room else None
+
+
+def run(state, codes, read_fn, readers, writers, seconds):
+    stop = threading.Event()
+    read_counts = [0] * readers
+    write_counts = [0] * writers
+
+    def reader(idx):
+        rng = random.Random(idx)
+        count = 0
+        while not stop.is_set():
+            for _ in range(100):
+                read_fn(state, rng.choice(codes))
+            count += 100
+        read_counts[idx] = count
+
+    def writer(idx):
+        rng = random.Random(1000 + idx)
+        count = 0
+        while not stop.is_set():
+            code = rng.choice(codes)
+            state.set_admin_suspect(code, f"player{rng.randint(1, 4)}")
+            count += 1
+        write_counts[idx] = count
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+    threads += [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    return sum(read_counts) / seconds, sum(write_counts) / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rooms", type=int, default=200)
+    parser.add_argument("--players", type=int, default=6)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    args = parser.parse_args()
+
+    state = GameState()
+    codes = build_rooms(state, args.rooms, args.players)
+
+    print(f"{args.rooms} rooms, {args.readers} readers, {args.writers} writers, {args.seconds}s per run")
+    for name, read_fn in [("snapshot", lambda s, c: s.get_room_summary(c)), ("copy+lock", copying_read)]:
+        reads, writes = run(state, codes, read_fn, args.readers, args.writers, args.seconds)
+        print(f"{name:>10}: {reads:>12,.0f} reads/s  {writes:>10,.0f} writes/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""
+Headless load test of the Streamlit app.
+
+Simulates many concurrent player sessions with Streamlit's AppTest driver. Every
+session runs app.py in-process, the same way a browser tab triggers a script run.
+Rooms go through lobby, game and results. Each session re-runs the script on a
+fixed polling interval, as clients do in production.
+
+Reported:
+    - script-run time per page function (attributed by the session's game phase when
+      the run starts)
+    - achieved reruns per second against the target polling rate
+    - Python heap (tracemalloc) per session, measured while sessions are created so
+      tracing does not slow down the timed polling phases (includes the AppTest
+      element tree each session keeps, so treat it as an upper bound)
+    - an estimate of how many rooms one core can keep at the target polling rate
+
+The OpenRouter key is blanked so starts use the fallback story, unless --use-api is
+passed.
+
+AppTest is not safe to drive from several threads, so script runs are interleaved
+on one thread. That matches one script thread per core in the server, and the
+capacity estimate is per core for that reason.
+
+Usage (from the mafia_game directory):
+    python benchmarks/load_app.py --rooms 5 --players 4 --poll-interval 2.5 --phase-seconds 10
+"""
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+PAGE_FUNCTIONS = {
+    "welcome": "welcome_page",
+    "create_room": "create_room_page",
+    "join_room": "join_room_page",
+    "lobby": "lobby_page",
+    "game": "game_page",
+    "results": "results_page",
+}
+
+
+class Session:
+    """
+    One simulated browser session.
+    """
+    def __init__(self, room_idx, name, is_admin, timeout):
+        from streamlit.testing.v1 import AppTest
+
+        self.room_idx = room_idx
+        self.name = name
+        self.is_admin = is_admin
+        self.at = AppTest.from_file(os.path.join(APP_DIR, "app.py"), default_timeout=timeout)
+        self.lock = threading.Lock()
+
+    @property
+    def phase(self):
+        try:
+            return self.at.session_state.game_phase
+        except (KeyError, AttributeError):
+            return "welcome"
+
+    def button(self, label):
+        for b in self.at.button:
+            if b.label == label:
+                return b
+        raise LookupError(f"{self.name}: no '{label}' button on {self.phase}")
+
+
+class LoadStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.run_times = {}  # page function -> [seconds]
+        self.errors = 0
+
+    def record(self, page, seconds, failed):
+        with self._lock:
+            self.run_times.setdefault(page, []).append(seconds)
+            if failed:
+                self.errors += 1
+
+    def total_runs(self):
+        return sum(len(v) for v in self.run_times.values())
+
+
+def run_session(session, stats):
+    with session.lock:
+        page = PAGE_FUNCTIONS.get(session.phase, session.phase)
+        start = time.perf_counter()
+        session.at.run()
+        stats.record(page, time.perf_counter() - start, bool(session.at.exception))
+
+
+def poll_all(sessions, stats, seconds, interval, on_round=None):
+    """
+    Rerun every session once per interval for the given duration.
+
+    Returns:
+        tuple: (rounds, late_rounds) where late rounds took longer than the interval
+    """
+    deadline = time.monotonic() + seconds
+    rounds = late = 0
+    while time.monotonic() < deadline:
+        round_start = time.monotonic()
+        if on_round:
+            on_round(rounds)
+        for session in sessions:
+            run_session(session, stats)
+        rounds += 1
+        elapsed = time.monotonic() - round_start
+        if elapsed > interval:
+            late += 1
+        else:
+            time.sleep(interval - elapsed)
+    return rounds, late
+
+
+def setup_room(room_idx, players, stats, timeout):
+    """
+    Create a room through the UI and join the other players through the UI.
+    """
+    admin = Session(room_idx, f"admin{room_idx}", True, timeout)
+    run_session(admin, stats)
+    admin.button("Create Room").click()
+    run_session(admin, stats)
+    admin.at.text_input[0].input(admin.name)
+    admin.button("Create Room").click()
+    run_session(admin, stats)
+    room_code = admin.at.session_state.room_code
+
+    sessions = [admin]
+    for p in range(1, players):
+        player = Session(room_idx, f"p{room_idx}_{p}", False, timeout)
+        run_session(player, stats)
+        player.button("Join Room").click()
+        run_session(player, stats)
+        player.at.text_input[0].input(room_code)
+        player.at.text_input[1].input(player.name)
+        player.button("Join").click()
+        run_session(player, stats)
+        sessions.append(player)
+
+    return room_code, sessions
+
+
+def play_turn(game_state, room_code, rng_offset):
+    """
+    Act as the admin for one round: pick a living player and accuse them.
+    Driven through game_state directly; AppTest keeps button clicks pressed across
+    st.rerun(), which would loop on these in-page handlers.
+    """
+    summary = game_state.get_room_summary(room_code)
+    if not summary or summary["status"] != "playing":
+        return
+    alive = [p for p in summary["players"]
+             if p not in summary["eliminated_players"] and p != summary["admin"]]
+    if alive:
+        game_state.set_admin_suspect(room_code, alive[rng_offset % len(alive)])
+        game_state.process_admin_accusation(room_code)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rooms", type=int, default=5)
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--poll-interval", type=float, default=2.5, help="Seconds between reruns per session")
+    parser.add_argument("--phase-seconds", type=float, default=10.0, help="Polling time in each of lobby, game, results")
+    parser.add_argument("--turn-every", type=int, default=2, help="Polling rounds between admin accusations")
+    parser.add_argument("--timeout", type=float, default=30.0, help="AppTest per-run timeout")
+    parser.add_argument("--use-api", action="store_true", help="Keep the OpenRouter key for real story generation")
+    args = parser.parse_args()
+
+    if not args.use_api:
+        os.environ["OPENROUTER_API_KEY"] = ""
+    os.environ.setdefault("MAFIA_API_PORT", "")  # No HTTP side server needed here
+
+    # Imported after the environment is set, the app shares this process's modules
+    from utils import game_state
+
+    setup_stats = LoadStats()
+    stats = LoadStats()
+    report = io.StringIO()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracemalloc.start()
+        heap_before = tracemalloc.get_traced_memory()[0]
+        rooms = [setup_room(r, args.players, setup_stats, args.timeout) for r in range(args.rooms)]
+        sessions = [s for _, room_sessions in rooms for s in room_sessions]
+        admins = [room_sessions[0] for _, room_sessions in rooms]
+        heap_after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        wall_start = time.monotonic()
+        lobby = poll_all(sessions, stats, args.phase_seconds, args.poll_interval)
+
+        # Start every room from the admin's page
+        for admin in admins:
+            run_session(admin, stats)
+            admin.button("Start Game").click()
+            run_session(admin, stats)
+        for code, _ in rooms:
+            while game_state.get_room_summary(code)["status"] == "setup":
+                time.sleep(0.05)
+
+        def take_turns(round_idx):
+            if round_idx and round_idx % args.turn_every == 0:
+                for offset, (code, _) in enumerate(rooms):
+                    play_turn(game_state, code, round_idx + offset)
+
+        game = poll_all(sessions, stats, args.phase_seconds, args.poll_interval, take_turns)
+
+        # Finish any game still running, then poll the results page
+        for offset, (code, _) in enumerate(rooms):
+            while game_state.get_room_summary(code)["status"] == "playing":
+                play_turn(game_state, code, offset)
+        results = poll_all(sessions, stats, args.phase_seconds, args.poll_interval)
+
+    wall = time.monotonic() - wall_start
+
+    num_sessions = len(sessions)
+    all_times = [t for times in stats.run_times.values() for t in times]
+    mean_run = statistics.mean(all_times) if all_times else 0.0
+    target_rate = num_sessions / args.poll_interval
+    sessions_per_core = args.poll_interval / mean_run if mean_run else 0.0
+
+    print(f"{args.rooms} rooms x {args.players} players = {num_sessions} sessions, "
+          f"poll every {args.poll_interval}s", file=report)
+    print(f"{'page function':<18}{'runs':>8}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}", file=report)
+    for page, times in sorted(stats.run_times.items()):
+        ordered = sorted(times)
+        p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+        print(f"{page:<18}{len(times):>8}{statistics.mean(times) * 1000:>10.1f}"
+              f"{statistics.median(times) * 1000:>10.1f}{p99 * 1000:>10.1f}", file=report)
+    print(f"script runs: {stats.total_runs()} in {wall:.1f}s = {stats.total_runs() / wall:.1f} reruns/s "
+          f"(target while polling {target_rate:.1f}/s)", file=report)
+    for name, (rounds, late) in (("lobby", lobby), ("game", game), ("results", results)):
+        print(f"  {name}: {rounds} polling rounds, {late} overran the interval", file=report)
+    print(f"script errors: {stats.errors + setup_stats.errors}", file=report)
+    print(f"python heap per session: {(heap_after - heap_before) / num_sessions / 1024:.1f} KiB", file=report)
+    print(f"estimated capacity at this poll interval: ~{sessions_per_core:.0f} sessions "
+          f"(~{sessions_per_core / args.players:.0f} rooms of {args.players}) per core", file=report)
+
+    sys.stdout.write(report.getvalue())
+
+
+if __name__ == "__main__":
+    main()
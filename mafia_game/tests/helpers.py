@@ -0,0 +1,16 @@
+import time
+
+
+def wait_until(predicate, timeout=5.0):
+    """
+    Poll predicate until it is true or timeout seconds have passed.
+
+    Returns:
+        bool: The predicate's last result
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
@@ -0,0 +1,67 @@
+import threading
+import time
+import unittest
+
+from utils.event_bus import EventBus
+
+
+class EventBusTest(unittest.TestCase):
+    def setUp(self):
+        self.dispatched = []
+        self.lock = threading.Lock()
+
+    def dispatch(self, room_code, event_type):
+        with self.lock:
+            self.dispatched.append((room_code, event_type))
+
+    def test_a_burst_on_one_room_is_delivered_once_per_window(self):
+        bus = EventBus(self.dispatch, name="test-events", window=0.2)
+        for _ in range(20):
+            bus.publish("AAAAAA", "join")
+        bus.publish("AAAAAA", "leave")
+        bus.publish("BBBBBB", "join")
+        bus.publish("AAAAAA", "join")
+        # Nothing goes out before the window has passed
+        self.assertEqual(self.dispatched, [])
+
+        self.assertTrue(bus.flush())
+        self.assertEqual(self.dispatched, [("AAAAAA", "join"), ("AAAAAA", "leave"), ("BBBBBB", "join")])
+        stats = bus.get_stats()
+        self.assertEqual((stats["published"], stats["coalesced"], stats["batches"]), (23, 20, 2))
+
+        # The next burst opens a new window
+        bus.publish("AAAAAA", "join")
+        self.assertTrue(bus.flush())
+        self.assertEqual(self.dispatched[3:], [("AAAAAA", "join")])
+
+    def test_flush_waits_for_pending_events(self):
+        bus = EventBus(self.dispatch, name="test-events", window=0.05)
+        bus.publish("AAAAAA", "join")
+        self.assertTrue(bus.flush(timeout=5))
+        self.assertEqual(self.dispatched, [("AAAAAA", "join")])
+        self.assertEqual(bus.get_stats()["pending_rooms"], 0)
+
+    def test_flush_times_out_while_the_window_is_open(self):
+        bus = EventBus(self.dispatch, name="test-events", window=10)
+        bus.publish("AAAAAA", "join")
+        start = time.monotonic()
+        self.assertFalse(bus.flush(timeout=0.1))
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(self.dispatched, [])
+
+    def test_a_failing_subscriber_does_not_stop_the_bus(self):
+        def dispatch(room_code, event_type):
+            if event_type == "fail":
+                raise RuntimeError("subscriber failed")
+            self.dispatch(room_code, event_type)
+
+        bus = EventBus(dispatch, name="test-events", window=0)
+        bus.publish("AAAAAA", "fail")
+        bus.publish("AAAAAA", "join")
+        self.assertTrue(bus.flush())
+        self.assertEqual(self.dispatched, [("AAAAAA", "join")])
+        self.assertEqual(bus.get_stats()["errors"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import tempfile
+import threading
+import time
+import unittest
+
+from utils.event_log import EventLog, read_events
+
+
+class _SlowEventLog(EventLog):
+    """
+    Holds each batch between taking it off the queue and writing it until released.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.taken = threading.Event()
+        self.release = threading.Event()
+
+    def _write(self, events):
+        if events:
+            self.taken.set()
+            self.release.wait(5)
+        super()._write(events)
+
+
+class EventLogFlushTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = _SlowEventLog(self.directory, lambda: (0, {}), flush_interval=0.01)
+        self.log.load()
+        self.log.start()
+
+    def tearDown(self):
+        self.log.release.set()
+        self.log.close()
+
+    def test_flush_waits_for_a_batch_taken_but_not_written(self):
+        self.log.append({"seq": 1, "room": "ABCD", "type": "put"})
+        self.assertTrue(self.log.taken.wait(5))
+        self.assertEqual(self.log.get_stats()["queued"], 0)
+
+        # The queue is empty but the event isn't on disk yet
+        self.assertFalse(self.log.flush(timeout=0.1))
+        self.assertEqual(list(read_events(self.directory)), [])
+
+        self.log.release.set()
+        self.assertTrue(self.log.flush(timeout=5))
+        self.assertEqual([e["seq"] for e in read_events(self.directory, room_code="ABCD")], [1])
+
+    def test_flush_with_nothing_appended_returns_at_once(self):
+        start = time.monotonic()
+        self.assertTrue(self.log.flush(timeout=5))
+        self.assertLess(time.monotonic() - start, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
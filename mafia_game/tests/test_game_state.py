@@ -0,0 +1,426 @@
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from utils import event_log, game_state, handoff, storyteller
+from tests.helpers import wait_until
+
+
+def _start_game(players=("host", "ann", "bob", "cat")):
+    room_code, _ = game_state.create_game_room(players[0])
+    for name in players[1:]:
+        game_state.join_game_room(room_code, name)
+    game_state.start_game(room_code, storyteller.generate_fallback_story(len(players)))
+    return room_code
+
+
+class PublicViewTest(unittest.TestCase):
+    def setUp(self):
+        self.room_code = _start_game()
+        self.renders = mock.patch.object(storyteller, "format_public_view",
+                                         wraps=storyteller.format_public_view).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_spectators_coming_and_going_keep_the_render(self):
+        view = game_state.get_public_view(self.room_code)
+        for name in ("eve", "fay", "gus"):
+            game_state.join_as_spectator(self.room_code, name)
+            view = game_state.get_public_view(self.room_code)
+        game_state.remove_spectator(self.room_code, "fay")
+        view = game_state.get_public_view(self.room_code)
+
+        self.assertEqual(self.renders.call_count, 1)
+        self.assertEqual(view["spectator_count"], 2)
+        self.assertIs(game_state.get_public_view(self.room_code), view)
+
+    def test_compacted_room_is_shown_without_expanding_it(self):
+        view = game_state.get_public_view(self.room_code)
+        game_state.compact_rooms(ended_after=0, idle_after=0)
+        self.assertTrue(game_state.get_room_summary(self.room_code).get("compacted"))
+        self.assertIs(game_state.get_public_view(self.room_code), view)
+
+        # A new version of a compacted room is rendered from the compressed story
+        game_state.join_as_spectator(self.room_code, "eve")
+        game_state.set_admin_suspect(self.room_code, "ann")
+        view = game_state.get_public_view(self.room_code)
+        self.assertEqual(self.renders.call_count, 2)
+        self.assertTrue(game_state.get_room_summary(self.room_code).get("compacted"))
+        self.assertIn(view["main_story"], view["markdown"])
+        self.assertEqual(view["spectator_count"], 1)
+
+
+class SupplyClueTest(unittest.TestCase):
+    def setUp(self):
+        # A state of its own, so no background clue job writes to the room meanwhile
+        self.state = game_state.GameState(event_log_dir=None)
+        self.addCleanup(self.state._timers.stop)
+        self.room_code, _ = self.state.create_game_room("host")
+        for name in ("ann", "bob", "cat"):
+            self.state.join_game_room(self.room_code, name)
+        story = storyteller.generate_fallback_story(4)
+        story["lazy_clues"] = True
+        self.state.start_game(self.room_code, story)
+
+    def clues(self):
+        return list(self.state.get_clue_context(self.room_code)["story_data"]["clues"])
+
+    def test_replaces_only_the_targeted_clue(self):
+        before = self.clues()
+        summary = self.state.get_room_summary(self.room_code)
+
+        self.assertTrue(self.state.supply_clue(self.room_code, 2, "A new clue"))
+        self.assertEqual(self.clues(), before[:2] + ["A new clue"] + before[3:])
+        # Nobody can see the clue yet, so the room hasn't changed for them
+        self.assertIs(self.state.get_room_summary(self.room_code), summary)
+
+    def test_revealed_and_unknown_clues_are_left_alone(self):
+        before = self.clues()
+        self.assertFalse(self.state.supply_clue(self.room_code, 0, "Too late"))
+        self.assertFalse(self.state.supply_clue(self.room_code, len(before), "No such clue"))
+        self.assertFalse(self.state.supply_clue("NOROOM", 1, "No such room"))
+        self.assertEqual(self.clues(), before)
+
+
+class PrivateViewTest(unittest.TestCase):
+    PLAYERS = ("host", "ann", "bob", "cat")
+
+    def setUp(self):
+        self.state = game_state.GameState(event_log_dir=None)
+        self.addCleanup(self.state._timers.stop)
+        self.room_code, _ = self.state.create_game_room(self.PLAYERS[0])
+        for name in self.PLAYERS[1:]:
+            self.state.join_game_room(self.room_code, name)
+        self.state.start_game(self.room_code, storyteller.generate_fallback_story(len(self.PLAYERS)))
+        story_players = self.state.get_clue_context(self.room_code)["story_data"]["players"]
+        self.characters = {character["character_name"]: character for character in story_players}
+
+    def test_views_match_the_story_assignment(self):
+        names = set()
+        mafia = set()
+        for player in self.PLAYERS:
+            view = self.state.get_private_view(self.room_code, player)
+            character = self.characters[view["character_name"]]
+            self.assertEqual(view["character_description"], character["character_description"])
+            self.assertEqual(view["is_mafia"], character["is_mafia"])
+            names.add(view["character_name"])
+            if view["is_mafia"]:
+                mafia.add(player)
+
+            info = self.state.get_player_info(self.room_code, player)
+            self.assertEqual({key: info[key] for key in view}, dict(view))
+            self.assertEqual(info["is_admin"], player == "host")
+
+        # Every player has a character of their own, and exactly one is the Mafia
+        self.assertEqual(len(names), len(self.PLAYERS))
+        self.assertEqual(len(mafia), 1)
+        self.assertEqual(self.state.get_mafia_players(self.room_code), mafia)
+        self.assertIsNone(self.state.get_private_view(self.room_code, "stranger"))
+
+    def test_views_are_read_only(self):
+        view = self.state.get_private_view(self.room_code, "ann")
+        with self.assertRaises(TypeError):
+            view["is_mafia"] = not view["is_mafia"]
+
+        # get_player_info hands out a copy, so changing it changes nothing in the room
+        info = self.state.get_player_info(self.room_code, "ann")
+        info["character_name"] = "Someone else"
+        self.assertEqual(self.state.get_player_info(self.room_code, "ann")["character_name"],
+                         view["character_name"])
+        with self.assertRaises(AttributeError):
+            self.state.get_mafia_players(self.room_code).add("ann")
+
+
+class WaitForChangeTest(unittest.TestCase):
+    def setUp(self):
+        self.room_code, _ = game_state.create_game_room("host")
+        self.version = game_state.get_room_summary(self.room_code)["version"]
+
+    def wait_in_thread(self, version, timeout):
+        result = {}
+
+        def wait():
+            start = time.monotonic()
+            result["summary"] = game_state.wait_for_change(self.room_code, version, timeout)
+            result["elapsed"] = time.monotonic() - start
+
+        thread = threading.Thread(target=wait)
+        thread.start()
+        return thread, result
+
+    def test_returns_at_once_if_the_room_has_moved_on(self):
+        start = time.monotonic()
+        summary = game_state.wait_for_change(self.room_code, self.version - 1, timeout=5)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(summary["version"], self.version)
+
+    def test_wakes_on_a_change(self):
+        thread, result = self.wait_in_thread(self.version, timeout=5)
+        time.sleep(0.05)
+        game_state.join_game_room(self.room_code, "ann")
+        thread.join(5)
+
+        self.assertLess(result["elapsed"], 1)
+        self.assertGreater(result["summary"]["version"], self.version)
+        self.assertIn("ann", result["summary"]["players"])
+
+    def test_times_out_with_the_same_version(self):
+        summary = game_state.wait_for_change(self.room_code, self.version, timeout=0.1)
+        self.assertEqual(summary["version"], self.version)
+
+    def test_is_not_woken_by_other_rooms_or_chat(self):
+        other_room, _ = game_state.create_game_room("other")
+        thread, result = self.wait_in_thread(self.version, timeout=0.3)
+        game_state.join_game_room(other_room, "ann")
+        game_state.post_message(self.room_code, "host", "hello")
+        thread.join(5)
+
+        self.assertGreaterEqual(result["elapsed"], 0.3)
+        self.assertEqual(result["summary"]["version"], self.version)
+
+    def test_returns_none_when_the_room_is_removed(self):
+        thread, result = self.wait_in_thread(self.version, timeout=5)
+        time.sleep(0.05)
+        with game_state._instance._lock:
+            game_state._instance._remove_room(self.room_code, "cleanup")
+        thread.join(5)
+
+        self.assertLess(result["elapsed"], 1)
+        self.assertIsNone(result["summary"])
+        self.assertIsNone(game_state.wait_for_change(self.room_code, 0, timeout=0))
+
+
+class VoteDeadlineTest(unittest.TestCase):
+    PLAYERS = ("host", "ann", "bob", "cat", "dan", "eve")
+
+    def test_votes_racing_the_deadline_are_counted_once(self):
+        for _ in range(10):
+            room_code = _start_game(self.PLAYERS)
+            self.assertTrue(game_state.open_voting(room_code, duration=0.1))
+            deadline = game_state.get_room_summary(room_code)["vote"]["deadline"]
+            results = {}
+
+            def vote(voter, candidate):
+                # Some votes land before the deadline timer fires, some after
+                time.sleep(max(0.0, deadline - time.time() + random.uniform(-0.1, 0.15)))
+                results[voter] = game_state.cast_vote(room_code, voter, candidate)
+
+            threads = [threading.Thread(target=vote, args=(voter, self.PLAYERS[i - 1]))
+                       for i, voter in enumerate(self.PLAYERS)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(5)
+            self.assertTrue(wait_until(lambda: "vote" not in game_state.get_room_summary(room_code)))
+
+            accepted = {voter for voter, result in results.items() if "error" not in result}
+            result = game_state.get_room_summary(room_code)["vote_result"]
+            self.assertEqual(set(result["ballots"]), accepted)
+            self.assertEqual(sum(result["tallies"].values()), len(accepted))
+            for voter in set(self.PLAYERS) - accepted:
+                self.assertEqual(results[voter], {"error": "No vote is open"})
+
+    def test_votes_after_the_deadline_are_refused(self):
+        room_code = _start_game(self.PLAYERS)
+        game_state.open_voting(room_code, duration=0.05)
+        self.assertEqual(game_state.cast_vote(room_code, "ann", "bob"), {"remaining": 5})
+        self.assertTrue(wait_until(lambda: "vote" not in game_state.get_room_summary(room_code)))
+
+        self.assertEqual(game_state.cast_vote(room_code, "cat", "bob"), {"error": "No vote is open"})
+        result = game_state.get_room_summary(room_code)["vote_result"]
+        self.assertEqual(dict(result["ballots"]), {"ann": "bob"})
+        self.assertEqual(result["accused"], "bob")
+
+    def test_deadline_of_a_closed_vote_leaves_the_revote_open(self):
+        room_code = _start_game()
+        game_state.open_voting(room_code, duration=60, tie_policy="revote")
+        first_vote = game_state.get_room_summary(room_code)["vote"]["id"]
+        for voter, candidate in (("host", "ann"), ("ann", "host"), ("bob", "cat"), ("cat", "bob")):
+            result = game_state.cast_vote(room_code, voter, candidate)
+        self.assertTrue(result["result"]["revote"])
+
+        # The first vote's timer firing late must not close the revote
+        self.assertEqual(game_state.close_voting(room_code, first_vote), {"error": "No vote is open"})
+        vote = game_state.get_room_summary(room_code)["vote"]
+        self.assertTrue(vote["revote"])
+        self.assertNotEqual(vote["id"], first_vote)
+
+
+class PresenceExpiryTest(unittest.TestCase):
+    def setUp(self):
+        for name, value in (("PRESENCE_TIMEOUT", 0.1), ("ROOM_EMPTY_EXPIRE_AFTER", 0.5)):
+            patch = mock.patch.object(game_state, name, value)
+            patch.start()
+            self.addCleanup(patch.stop)
+        # A state of its own, so the presence timer runs on the short timeout
+        self.state = game_state.GameState(event_log_dir=None)
+        self.addCleanup(self.state._timers.stop)
+        self.room_code, _ = self.state.create_game_room("host")
+
+    def stay_online(self, name, seconds):
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            self.assertTrue(self.state.heartbeat(self.room_code, name))
+            time.sleep(0.02)
+
+    def go_offline(self):
+        self.assertTrue(self.state.heartbeat(self.room_code, "host"))
+        self.assertTrue(wait_until(lambda: not self.state.get_room_summary(self.room_code)["online_players"]))
+
+    def test_empty_room_is_reclaimed(self):
+        self.go_offline()
+        self.assertTrue(wait_until(lambda: self.state.get_room_summary(self.room_code) is None))
+
+    def test_room_that_became_non_empty_is_kept(self):
+        self.go_offline()
+        # Back before the empty room is reclaimed, and for longer than it takes
+        self.stay_online("host", 0.8)
+        self.assertIsNotNone(self.state.get_room_summary(self.room_code))
+        self.assertNotIn("empty", self.state._room_timers[self.room_code])
+
+    def test_empty_timer_firing_after_a_return_keeps_the_room(self):
+        self.go_offline()
+        # The player comes back just as the empty timer fires
+        with self.state._lock:
+            self.state.heartbeat(self.room_code, "host")
+            self.state._reclaim_empty_room(self.room_code)
+        self.assertEqual(self.state.get_room_summary(self.room_code)["online_players"], ("host",))
+
+    def test_spectator_keeps_the_room_but_not_the_players_online(self):
+        self.assertTrue(self.state.join_as_spectator(self.room_code, "eve"))
+        self.go_offline()
+        self.stay_online("eve", 0.8)
+        summary = self.state.get_room_summary(self.room_code)
+        self.assertIsNotNone(summary)
+        self.assertEqual(summary["online_players"], ())
+        self.assertEqual(summary["spectator_count"], 1)
+
+
+class EventLogReplayTest(unittest.TestCase):
+    def setUp(self):
+        # Snapshot every few events, so the restore reads a snapshot plus a tail
+        for name, value in (("EVENT_LOG_SNAPSHOT_EVERY", 5), ("EVENT_LOG_FLUSH_INTERVAL", 0.01)):
+            patch = mock.patch.object(event_log, name, value)
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.directory = tempfile.mkdtemp()
+
+    def open_state(self):
+        state = game_state.GameState(event_log_dir=self.directory)
+        self.addCleanup(state._timers.stop)
+        self.addCleanup(state._event_log.close)
+        return state
+
+    def test_restore_reproduces_every_summary(self):
+        state = self.open_state()
+        playing, _ = state.create_game_room("host")
+        for name in ("ann", "bob", "cat"):
+            state.join_game_room(playing, name)
+        state.start_game(playing, storyteller.generate_fallback_story(4))
+        state.set_admin_suspect(playing, "ann")
+        state.open_voting(playing, tie_policy="revote")
+        state.cast_vote(playing, "host", "ann")
+        state.cast_vote(playing, "ann", "bob")
+
+        lobby, _ = state.create_game_room("dan")
+        state.join_game_room(lobby, "eve")
+        removed, _ = state.create_game_room("fay")
+        with state._lock:
+            state._remove_room(removed, "cleanup")
+
+        self.assertTrue(state.flush_event_log())
+        state._event_log.close()
+        self.assertGreater(state.get_event_log_stats()["snapshots"], 0)
+
+        restored = self.open_state()
+        self.assertEqual(sorted(restored.get_all_room_codes()), sorted([playing, lobby]))
+        for room_code in (playing, lobby):
+            self.assertEqual(dict(restored.get_room_summary(room_code)), dict(state.get_room_summary(room_code)))
+        for player in ("host", "ann", "bob", "cat"):
+            self.assertEqual(dict(restored.get_private_view(playing, player)),
+                             dict(state.get_private_view(playing, player)))
+
+        # The restored room carries on where it left off
+        self.assertEqual(restored.cast_vote(playing, "bob", "ann"), {"remaining": 1})
+
+
+class HandoffTest(unittest.TestCase):
+    PLAYERS = ("host", "ann", "bob", "cat")
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "handoff.json")
+        self.old = self.new_state()
+
+    def new_state(self):
+        state = game_state.GameState(event_log_dir=None)
+        self.addCleanup(state._timers.stop)
+        return state
+
+    def start_game(self, state):
+        room_code, _ = state.create_game_room(self.PLAYERS[0])
+        for name in self.PLAYERS[1:]:
+            state.join_game_room(room_code, name)
+        state.start_game(room_code, storyteller.generate_fallback_story(len(self.PLAYERS)))
+        return room_code
+
+    def in_process(self, state):
+        # handoff works on the module's singleton
+        return mock.patch.object(game_state, "_instance", state)
+
+    def test_game_continues_in_the_new_process(self):
+        discussing = self.start_game(self.old)
+        self.old.set_admin_suspect(discussing, "ann")
+        self.assertTrue(self.old.start_discussion(discussing, duration=1.0))
+        voting = self.start_game(self.old)
+        self.assertTrue(self.old.open_voting(voting, duration=1.0))
+        self.assertEqual(self.old.cast_vote(voting, "host", "ann"), {"remaining": 3})
+
+        with self.in_process(self.old):
+            self.assertEqual(handoff.hand_off(self.path), 2)
+        self.assertEqual(self.old.get_drain_state(), "handed_off")
+
+        # The old process refuses every change but still serves reads
+        self.assertEqual(self.old.create_game_room("dan"), (None, None))
+        self.assertFalse(self.old.join_game_room(discussing, "dan"))
+        self.assertFalse(self.old.set_admin_suspect(discussing, "bob"))
+        self.assertFalse(self.old.heartbeat(discussing, "host"))
+        self.assertEqual(self.old.cast_vote(voting, "ann", "host"), game_state.HANDED_OFF_ERROR)
+        self.assertEqual(self.old.post_message(voting, "ann", "hi"), game_state.HANDED_OFF_ERROR)
+        self.assertEqual(self.old.process_admin_accusation(discussing), game_state.HANDED_OFF_ERROR)
+        self.assertEqual(self.old.get_room_summary(discussing)["current_suspect"], "ann")
+
+        new = self.new_state()
+        with self.in_process(new):
+            self.assertEqual(handoff.resume(self.path), 2)
+            # The file was claimed, so neither a second load nor another process gets it
+            self.assertEqual(handoff.resume(self.path), 0)
+        with self.in_process(self.new_state()):
+            self.assertEqual(handoff.resume(self.path), 0)
+
+        for room_code in (discussing, voting):
+            old_summary = dict(self.old.get_room_summary(room_code))
+            new_summary = dict(new.get_room_summary(room_code))
+            # A new version, so clients of the old process see the room change
+            self.assertGreater(new_summary.pop("version"), old_summary.pop("version"))
+            new_summary.pop("last_update")
+            old_summary.pop("last_update")
+            self.assertEqual(new_summary, old_summary)
+            for player in self.PLAYERS:
+                self.assertEqual(dict(new.get_private_view(room_code, player)),
+                                 dict(self.old.get_private_view(room_code, player)))
+        self.assertIn("discussion", new._room_timers[discussing])
+        self.assertIn("vote", new._room_timers[voting])
+
+        # The countdown and the vote deadline run out in the new process, not the old one
+        self.assertTrue(wait_until(lambda: "discussion_deadline" not in new.get_room_summary(discussing)))
+        self.assertTrue(wait_until(lambda: "vote" not in new.get_room_summary(voting)))
+        self.assertEqual(dict(new.get_room_summary(voting)["vote_result"]["ballots"]), {"host": "ann"})
+        self.assertIn("discussion_deadline", self.old.get_room_summary(discussing))
+        self.assertIn("vote", self.old.get_room_summary(voting))
+
+
+if __name__ == "__main__":
+    unittest.main()
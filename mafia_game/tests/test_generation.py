@@ -0,0 +1,96 @@
+import threading
+import unittest
+from unittest import mock
+
+from utils import game_state, generation, providers, storyteller
+from tests.helpers import wait_until
+
+
+class GameStartTest(unittest.TestCase):
+    def setUp(self):
+        self.room_code, _ = game_state.create_game_room("host")
+        for name in ("ann", "bob", "cat"):
+            game_state.join_game_room(self.room_code, name)
+
+    def tearDown(self):
+        generation.cancel_game_start(self.room_code)
+
+    def test_restart_after_cancelling_a_running_start(self):
+        release = threading.Event()
+        calls = []
+
+        def generate(num_players, timeout=None, lazy_clues=None):
+            calls.append(num_players)
+            if len(calls) == 1:
+                # The first start is still generating when it is cancelled
+                release.wait(5)
+            return storyteller.generate_fallback_story(num_players)
+
+        with mock.patch.object(storyteller, "generate_game_story", generate):
+            first_job = generation.request_game_start(self.room_code)
+            self.assertTrue(wait_until(lambda: calls))
+            self.assertTrue(generation.cancel_game_start(self.room_code))
+            self.assertEqual(game_state.get_room_summary(self.room_code)["status"], "lobby")
+
+            second_job = generation.request_game_start(self.room_code)
+            self.assertIsNotNone(second_job)
+            self.assertNotEqual(first_job, second_job)
+            try:
+                self.assertTrue(wait_until(
+                    lambda: game_state.get_room_summary(self.room_code)["status"] == "playing"))
+            finally:
+                release.set()
+
+        # The cancelled job's story arrives late and is discarded
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(game_state.get_room_summary(self.room_code)["status"], "playing")
+
+    def test_repeated_start_returns_the_pending_job(self):
+        release = threading.Event()
+
+        def generate(num_players, timeout=None, lazy_clues=None):
+            release.wait(5)
+            return storyteller.generate_fallback_story(num_players)
+
+        with mock.patch.object(storyteller, "generate_game_story", generate):
+            job_id = generation.request_game_start(self.room_code)
+            try:
+                self.assertEqual(generation.request_game_start(self.room_code), job_id)
+            finally:
+                release.set()
+            self.assertTrue(wait_until(
+                lambda: game_state.get_room_summary(self.room_code)["status"] == "playing"))
+
+
+class LazyClueTest(unittest.TestCase):
+    def start_game(self, lazy_clues):
+        room_code, _ = game_state.create_game_room("host")
+        for name in ("ann", "bob", "cat"):
+            game_state.join_game_room(room_code, name)
+        story = storyteller.generate_fallback_story(4)
+        story["lazy_clues"] = lazy_clues
+        game_state.start_game(room_code, story)
+        return room_code
+
+    def test_next_clue_is_written_in_the_background(self):
+        with mock.patch.object(providers, "generate_clue", return_value="A generated clue") as generate:
+            room_code = self.start_game(lazy_clues=True)
+            version = game_state.get_room_summary(room_code)["version"]
+            # Starting the game queues the clue the next round reveals
+            self.assertTrue(wait_until(lambda: generate.called))
+            self.assertTrue(wait_until(
+                lambda: game_state.get_clue_context(room_code)["story_data"]["clues"][1] == "A generated clue"))
+
+        self.assertEqual(generate.call_args.args[1], 2)
+        self.assertEqual(game_state.get_room_summary(room_code)["version"], version)
+
+    def test_games_without_lazy_clues_are_skipped(self):
+        with mock.patch.object(providers, "generate_clue") as generate:
+            room_code = self.start_game(lazy_clues=False)
+            self.assertIsNone(generation.schedule_next_clue(room_code))
+            game_state.flush_events()
+        generate.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
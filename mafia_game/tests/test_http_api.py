@@ -0,0 +1,162 @@
+import json
+import threading
+import unittest
+import http.client
+from http.server import ThreadingHTTPServer
+from unittest import mock
+
+from utils import game_state, http_api, profiling
+
+
+class AdminRoutesTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), http_api.GameAPIHandler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def request(self, method, path, headers=None):
+        connection = http.client.HTTPConnection("127.0.0.1", self.server.server_address[1], timeout=10)
+        try:
+            connection.request(method, path, headers=headers or {})
+            response = connection.getresponse()
+            return response.status, dict(response.getheaders()), json.loads(response.read() or b"null")
+        finally:
+            connection.close()
+
+    def test_admin_routes_are_off_without_a_token(self):
+        with mock.patch.object(http_api, "ADMIN_TOKEN", ""):
+            status, _, body = self.request("POST", "/handoff", {"X-Mafia-Admin-Token": ""})
+        self.assertEqual(status, 403)
+        self.assertIn("MAFIA_ADMIN_TOKEN", body["error"])
+        self.assertIsNone(game_state.get_drain_state())
+
+    def test_admin_routes_need_the_token_header(self):
+        with mock.patch.object(http_api, "ADMIN_TOKEN", "secret"):
+            for headers in ({}, {"X-Mafia-Admin-Token": "wrong"}, {"Origin": "https://evil.example"}):
+                status, _, _ = self.request("POST", "/drain?handoff=true", headers)
+                self.assertEqual(status, 403)
+            self.assertIsNone(game_state.get_drain_state())
+
+            # With the token, handoff is still refused until a handoff file is configured
+            with mock.patch("utils.handoff.MAFIA_HANDOFF_FILE", ""):
+                status, _, body = self.request("POST", "/handoff", {"X-Mafia-Admin-Token": "secret"})
+            self.assertEqual(status, 400)
+            self.assertIsNone(game_state.get_drain_state())
+
+    def test_profiler_can_only_be_switched_by_an_admin(self):
+        with mock.patch.object(http_api, "ADMIN_TOKEN", "secret"):
+            status, _, _ = self.request("POST", "/profile?mode=cprofile")
+            self.assertEqual(status, 403)
+            self.assertFalse(profiling.is_enabled())
+
+            status, _, body = self.request("POST", "/profile?mode=cprofile", {"X-Mafia-Admin-Token": "secret"})
+            self.assertEqual((status, body["mode"]), (200, "cprofile"))
+            status, _, body = self.request("POST", "/profile?mode=off", {"X-Mafia-Admin-Token": "secret"})
+            self.assertEqual((status, body["mode"]), (200, "off"))
+
+    def test_room_history_is_admin_only(self):
+        room_code, _ = game_state.create_game_room("host")
+        with mock.patch.object(http_api, "ADMIN_TOKEN", "secret"):
+            status, _, _ = self.request("GET", f"/rooms/{room_code}/history")
+            self.assertEqual(status, 403)
+            # Past the gate, this process has no event log
+            status, _, body = self.request("GET", f"/rooms/{room_code}/history", {"X-Mafia-Admin-Token": "secret"})
+            self.assertEqual(status, 404)
+            self.assertIn("EVENT_LOG_DIR", body["error"])
+
+    def test_json_routes_send_no_cors_header(self):
+        room_code, _ = game_state.create_game_room("host")
+        status, headers, body = self.request("GET", f"/rooms/{room_code}")
+        self.assertEqual(status, 200)
+        self.assertEqual(body["admin"], "host")
+        self.assertNotIn("Access-Control-Allow-Origin", headers)
+
+
+
+class RoomFeedListenerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), http_api.RoomFeedHandler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def connect(self, path):
+        connection = http.client.HTTPConnection("127.0.0.1", self.server.server_address[1], timeout=10)
+        connection.request("GET", path)
+        return connection, connection.getresponse()
+
+    def test_only_the_feed_is_served(self):
+        room_code, _ = game_state.create_game_room("host")
+        for path in (f"/rooms/{room_code}", f"/rooms/{room_code}/history", "/metrics"):
+            connection, response = self.connect(path)
+            self.assertEqual(response.status, 404, path)
+            connection.close()
+        connection = http.client.HTTPConnection("127.0.0.1", self.server.server_address[1], timeout=10)
+        connection.request("POST", "/drain")
+        self.assertEqual(connection.getresponse().status, 501)
+        connection.close()
+
+    def test_feeds_over_the_limit_are_refused(self):
+        room_code, _ = game_state.create_game_room("host")
+        with mock.patch.object(http_api, "MAX_FEED_CONNECTIONS", 0):
+            connection, response = self.connect(f"/rooms/{room_code}/events")
+            self.assertEqual(response.status, 503)
+            connection.close()
+
+    def test_feed_pushes_versions_without_heartbeats(self):
+        room_code, _ = game_state.create_game_room("host")
+        version = game_state.get_room_summary(room_code)["version"]
+        connection, response = self.connect(f"/rooms/{room_code}/events?version={version}&player=host")
+        try:
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.getheader("Access-Control-Allow-Origin"), "*")
+            game_state.join_game_room(room_code, "ann")
+
+            lines = []
+            while "event: version" not in lines:
+                lines.append(response.fp.readline().decode("utf-8").strip())
+            data = json.loads(response.fp.readline().decode("utf-8")[len("data: "):])
+            self.assertGreater(data["version"], version)
+            self.assertNotIn("host", game_state.get_room_summary(room_code)["online_players"])
+        finally:
+            response.close()
+            connection.close()
+
+    def read_message(self, response):
+        lines = []
+        while "event: message" not in lines:
+            lines.append(response.fp.readline().decode("utf-8").strip())
+        return json.loads(response.fp.readline().decode("utf-8")[len("data: "):])
+
+    def test_chat_feed_sends_history_then_new_messages(self):
+        room_code, _ = game_state.create_game_room("host")
+        game_state.join_game_room(room_code, "ann")
+        game_state.post_message(room_code, "host", "first")
+        game_state.post_message(room_code, "ann", "second")
+        connection, response = self.connect(f"/rooms/{room_code}/chat/events?after=1")
+        try:
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.getheader("Access-Control-Allow-Origin"), "*")
+            self.assertEqual(self.read_message(response)["text"], "second")
+
+            game_state.post_message(room_code, "host", "third")
+            message = self.read_message(response)
+            self.assertEqual((message["seq"], message["player"], message["text"]), (3, "host", "third"))
+        finally:
+            response.close()
+            connection.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
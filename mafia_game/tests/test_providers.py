@@ -0,0 +1,57 @@
+import unittest
+from unittest import mock
+
+from utils import providers
+
+
+class _StubProvider(providers.Provider):
+    def __init__(self, name, error=None):
+        super().__init__()
+        self.name = self.label = name
+        self.error = error
+
+    def _complete(self, prompt, max_tokens, timeout):
+        if self.error:
+            raise self.error
+        return "ok"
+
+
+class AutoRoutingTest(unittest.TestCase):
+    def route(self, *stubs):
+        patches = (mock.patch.object(providers, "LLM_PROVIDER", "auto"),
+                   mock.patch.object(providers, "_providers", {p.name: p for p in stubs}))
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_any_failure_starts_the_cooldown(self):
+        broken = _StubProvider("broken", ValueError("OpenRouter API error: 400"))
+        self.route(broken)
+        with self.assertRaises(ValueError):
+            broken.complete("prompt", 400)
+        self.assertEqual(providers.get_providers(400), [])
+
+        with mock.patch.object(providers, "FAILURE_COOLDOWN", 0):
+            with self.assertRaises(ValueError):
+                broken.complete("prompt", 400)
+            self.assertEqual(providers.get_providers(400), [broken])
+
+    def test_providers_that_only_failed_go_after_measured_ones(self):
+        measured, untried = _StubProvider("measured"), _StubProvider("untried")
+        broken = _StubProvider("broken", ValueError("Unexpected response structure"))
+        self.route(measured, broken, untried)
+        measured.complete("prompt", 400)
+        with mock.patch.object(providers, "FAILURE_COOLDOWN", 0):
+            with self.assertRaises(ValueError):
+                broken.complete("prompt", 400)
+        self.assertEqual(providers.get_providers(400), [untried, measured, broken])
+
+        # A success puts it back among the measured providers
+        broken.error = None
+        broken.complete("prompt", 400)
+        self.assertEqual([p.name for p in providers.get_providers(400)][0], "untried")
+        self.assertIsNotNone(broken.get_latency(400))
+
+
+if __name__ == "__main__":
+    unittest.main()
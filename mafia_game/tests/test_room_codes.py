@@ -0,0 +1,56 @@
+import os
+import json
+import hashlib
+import tempfile
+import unittest
+
+from utils import room_codes
+from utils.room_codes import ALPHABET, CODE_LENGTH, RoomCodeAllocator
+
+
+class RoomCodeAllocatorTest(unittest.TestCase):
+    def test_codes_across_blocks_are_distinct(self):
+        allocator = RoomCodeAllocator(secret="test", block_size=8)
+        codes = [allocator.allocate() for _ in range(100)]
+
+        self.assertEqual(len(set(codes)), len(codes))
+        for code in codes:
+            self.assertEqual(len(code), CODE_LENGTH)
+            self.assertTrue(set(code) <= set(ALPHABET), code)
+
+    @unittest.skipIf(room_codes.fcntl is None, "needs file locking")
+    def test_allocators_sharing_a_state_file_never_collide(self):
+        state_path = os.path.join(tempfile.mkdtemp(), "room_codes.json")
+        first = RoomCodeAllocator(state_path=state_path, block_size=4)
+        second = RoomCodeAllocator(state_path=state_path, block_size=4)
+
+        codes = []
+        for _ in range(50):
+            codes.append(first.allocate())
+            codes.append(second.allocate())
+        self.assertEqual(len(set(codes)), len(codes))
+
+        # Both use the secret the first one stored in the file
+        with open(state_path) as f:
+            secret = json.load(f)["secret"]
+        key = hashlib.blake2b(secret.encode("utf-8"), digest_size=32).digest()
+        self.assertEqual(first._key, key)
+        self.assertEqual(second._key, key)
+
+    def test_codes_in_use_are_skipped(self):
+        asked = []
+
+        class FirstCodeTaken:
+            def __contains__(self, code):
+                asked.append(code)
+                return len(asked) == 1
+
+        allocator = RoomCodeAllocator(secret="test")
+        code = allocator.allocate(in_use=FirstCodeTaken())
+
+        self.assertEqual(asked, [asked[0], code])
+        self.assertNotEqual(code, asked[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
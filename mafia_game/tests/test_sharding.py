@@ -0,0 +1,95 @@
+import unittest
+from unittest import mock
+
+from utils import game_state, sharding, storyteller
+from tests.helpers import wait_until
+
+_router = None
+
+
+def setUpModule():
+    global _router
+    _router = sharding.ShardRouter(2, event_log_dir=None)
+
+
+def tearDownModule():
+    _router.close()
+
+
+class SummaryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.router = _router
+        self.room_code, _ = self.router.create_game_room("host")
+        shard = self.router._shard_for(self.room_code)
+        self.calls = mock.patch.object(shard, "call", wraps=shard.call).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def summary_reads(self):
+        return sum(1 for call in self.calls.call_args_list if call.args[0] == "get_room_summary")
+
+    def test_repeated_reads_make_one_round_trip(self):
+        self.router.heartbeat(self.room_code, "host")
+        self.router.flush_events()
+        summary = self.router.get_room_summary(self.room_code)
+        self.assertEqual(summary["online_players"], ("host",))
+        for _ in range(5):
+            self.assertIs(self.router.get_room_summary(self.room_code), summary)
+        self.assertEqual(self.summary_reads(), 1)
+
+        # Chat and heartbeats leave the summary as it is
+        self.router.post_message(self.room_code, "host", "hello")
+        self.router.heartbeat(self.room_code, "host")
+        self.router.flush_events()
+        self.assertIs(self.router.get_room_summary(self.room_code), summary)
+        self.assertEqual(self.summary_reads(), 1)
+
+    def test_a_change_through_the_router_is_read_back(self):
+        self.router.get_room_summary(self.room_code)
+        self.router.join_game_room(self.room_code, "ann")
+        self.assertIn("ann", self.router.get_room_summary(self.room_code)["players"])
+
+    def test_a_change_made_in_the_shard_reaches_the_cache(self):
+        for name in ("ann", "bob", "cat"):
+            self.router.join_game_room(self.room_code, name)
+        self.router.start_game(self.room_code, storyteller.generate_fallback_story(4))
+        self.router.open_voting(self.room_code, 0.05)
+        self.assertIn("vote", self.router.get_room_summary(self.room_code))
+
+        # The deadline closes the vote inside the shard, with no call through the router
+        self.assertTrue(wait_until(lambda: "vote" not in self.router.get_room_summary(self.room_code)))
+
+    def test_wait_for_change_fills_the_cache(self):
+        version = self.router.get_room_summary(self.room_code)["version"]
+        self.router.join_game_room(self.room_code, "ann")
+        summary = self.router.wait_for_change(self.room_code, version, 5)
+        self.assertIs(self.router.get_room_summary(self.room_code), summary)
+
+    def test_removed_room_is_not_served_from_the_cache(self):
+        self.router.get_room_summary(self.room_code)
+        self.router.cleanup_stale_rooms(max_age_hours=0)
+        self.assertIsNone(self.router.get_room_summary(self.room_code))
+
+
+class CallbackTest(unittest.TestCase):
+    def callback_errors(self, callback_id):
+        return sum(value for _, labels, value in game_state._callback_errors_total.collect()
+                   if ("callback", callback_id) in labels)
+
+    def test_failing_callbacks_are_counted(self):
+        def fail_on_create(room_code, event_type):
+            if event_type == "create":
+                raise RuntimeError("callback failed")
+
+        # Events left over from other tests go to the callbacks registered now
+        _router.flush_events()
+        _router.register_callback("failing", fail_on_create)
+        self.addCleanup(_router.unregister_callback, "failing")
+        before = self.callback_errors("failing")
+
+        _router.create_game_room("host")
+        _router.flush_events()
+        self.assertEqual(self.callback_errors("failing"), before + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
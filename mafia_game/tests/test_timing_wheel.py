@@ -0,0 +1,83 @@
+import threading
+import time
+import unittest
+
+from utils.timing_wheel import SLOTS, TimingWheel
+
+
+class TimingWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.wheel = TimingWheel(tick=0.005, name="test-wheel")
+        self.addCleanup(self.wheel.stop)
+        self.fired = []
+        self.lock = threading.Lock()
+
+    def schedule(self, delay, label):
+        scheduled = time.monotonic()
+
+        def fire():
+            with self.lock:
+                self.fired.append((label, time.monotonic() - scheduled))
+
+        return self.wheel.schedule(delay, fire)
+
+    def wait_for(self, count, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                if len(self.fired) >= count:
+                    return True
+            time.sleep(0.005)
+        return False
+
+    def test_timers_fire_in_deadline_order_and_never_early(self):
+        delays = {"c": 0.06, "a": 0.02, "b": 0.04, "now": 0}
+        for label, delay in delays.items():
+            self.schedule(delay, label)
+        self.assertTrue(self.wait_for(len(delays)))
+
+        self.assertEqual([label for label, _ in self.fired], ["now", "a", "b", "c"])
+        for label, elapsed in self.fired:
+            self.assertGreaterEqual(elapsed, delays[label])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cancelled_timers_never_fire(self):
+        cancelled = self.schedule(0.02, "cancelled")
+        self.schedule(0.04, "kept")
+        self.assertTrue(cancelled.cancel())
+        self.assertFalse(cancelled.cancel())
+        self.assertTrue(self.wait_for(1))
+        time.sleep(0.05)
+
+        self.assertEqual([label for label, _ in self.fired], ["kept"])
+        stats = self.wheel.get_stats()
+        self.assertEqual((stats["fired"], stats["cancelled"], stats["pending"]), (1, 1, 0))
+
+    def test_cancel_after_firing_does_nothing(self):
+        timer = self.schedule(0, "fired")
+        self.assertTrue(self.wait_for(1))
+        self.assertFalse(timer.cancel())
+        self.assertEqual(self.wheel.get_stats()["cancelled"], 0)
+
+    def test_long_timers_cascade_down_and_fire_on_time(self):
+        # Past the bottom ring, so these move down a level before firing
+        delays = {"short": 0.01, "long": SLOTS * 0.005 * 1.5, "longer": SLOTS * 0.005 * 2.5}
+        for label, delay in delays.items():
+            self.schedule(delay, label)
+        self.assertTrue(self.wait_for(len(delays)))
+
+        self.assertEqual([label for label, _ in self.fired], ["short", "long", "longer"])
+        for label, elapsed in self.fired:
+            self.assertGreaterEqual(elapsed, delays[label])
+            self.assertLess(elapsed, delays[label] + 0.5)
+        self.assertGreaterEqual(self.wheel.get_stats()["cascaded"], 2)
+
+    def test_a_failing_timer_does_not_stop_the_wheel(self):
+        self.wheel.schedule(0.01, lambda: 1 / 0)
+        self.schedule(0.03, "after")
+        self.assertTrue(self.wait_for(1))
+        self.assertEqual(self.wheel.get_stats()["errors"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
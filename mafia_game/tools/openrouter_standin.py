@@ -0,0 +1,347 @@
+"""
+Local stand-in for the OpenRouter chat completions API.
+
+Speaks enough of the protocol for the game: POST .../chat/completions with a JSON
+body, answered either as a single JSON response or, when the request sets
+"stream": true, as server-sent events with one delta per chunk followed by
+"data: [DONE]".
+
+Story prompts are answered with recorded responses (--recordings, a JSONL file with
+one {"content": "..."} object or JSON string per line) or, by default, with stories
+synthesized from the fallback story generator for the requested player count. Clue
+prompts are answered with a fallback clue.
+
+Failure injection, each drawn per request:
+    --latency          response delay distribution (see below)
+    --rate-429         fraction answered with 429 and a Retry-After header
+    --rate-5xx         fraction answered with a random 500/502/503
+    --malformed        fraction whose content is no longer valid JSON
+    --truncate         fraction whose content is cut short (finish_reason "length")
+
+Latency distributions: "0", "fixed:2", "uniform:1,5", "normal:3,1" (mean, stddev)
+or "lognormal:1,0.5" (mu, sigma of the underlying normal), all in seconds.
+
+Usage (from the mafia_game directory):
+    python tools/openrouter_standin.py --port 8090 --latency lognormal:1,0.6 --rate-429 0.1
+    OPENROUTER_BASE_URL=http://127.0.0.1:8090/v1/chat/completions OPENROUTER_API_KEY=sk-or-local streamlit run app.py
+
+GET /stats returns request and outcome counters.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.storyteller import FALLBACK_CLUES, generate_fallback_story
+
+PLAYER_COUNT_PATTERN = re.compile(r"exactly (\d+) characters")
+LAZY_CLUES_MARKER = "الدليل الأول بس"
+STREAM_CHUNK_CHARS = 40
+
+
+def parse_latency(spec):
+    """
+    Turn a latency spec into a function returning a delay in seconds.
+
+    Args:
+        spec (str): "0", "fixed:S", "uniform:LO,HI", "normal:MEAN,STD" or "lognormal:MU,SIGMA"
+
+    Returns:
+        callable: Takes a random.Random and returns a non-negative delay
+    """
+    kind, _, params = spec.partition(":")
+    if not params:
+        delay = float(kind)
+        return lambda rng: delay
+
+    values = [float(v) for v in params.split(",")]
+    if kind == "fixed":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(values[0], values[1])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def load_recordings(path):
+    """
+    Load recorded response contents from a JSONL file.
+
+    Returns:
+        list: Content strings, in file order
+    """
+    recordings = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if isinstance(entry, dict):
+                entry = entry.get("content") or json.dumps(entry.get("story"), ensure_ascii=False)
+            recordings.append(entry)
+    return recordings
+
+
+class StandIn:
+    """
+    Response source and failure profile shared by all request handlers.
+    """
+    def __init__(self, latency, rate_429=0.0, rate_5xx=0.0, malformed=0.0, truncate=0.0,
+                 recordings=None, seed=None):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.malformed = malformed
+        self.truncate = truncate
+        self.recordings = recordings or []
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._replay_index = 0
+        self.stats = {"requests": 0, "ok": 0, "streamed": 0, "429": 0, "5xx": 0,
+                      "malformed": 0, "truncated": 0, "bad_request": 0}
+
+    def count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def draw(self):
+        """
+        Draw this request's fate under the lock, so a seeded run is reproducible.
+
+        Returns:
+            dict: delay, status and content mutation for one request
+        """
+        with self._lock:
+            roll = self._rng.random()
+            if roll < self.rate_429:
+                status = 429
+            elif roll < self.rate_429 + self.rate_5xx:
+                status = self._rng.choice([500, 502, 503])
+            else:
+                status = 200
+
+            mutation = None
+            roll = self._rng.random()
+            if roll < self.malformed:
+                mutation = "malformed"
+            elif roll < self.malformed + self.truncate:
+                mutation = "truncated"
+
+            return {"delay": self.latency(self._rng), "status": status,
+                    "mutation": mutation, "cut": self._rng.uniform(0.2, 0.9)}
+
+    def content_for(self, prompt):
+        if '"clue"' in prompt:
+            with self._lock:
+                clue = self._rng.choice(FALLBACK_CLUES)
+            return json.dumps({"clue": clue}, ensure_ascii=False)
+
+        if self.recordings:
+            with self._lock:
+                content = self.recordings[self._replay_index % len(self.recordings)]
+                self._replay_index += 1
+            return content
+
+        match = PLAYER_COUNT_PATTERN.search(prompt)
+        num_players = int(match.group(1)) if match else 5
+        # The fallback generator is chatty and reseeds the global random module
+        with contextlib.redirect_stdout(io.StringIO()):
+            story = generate_fallback_story(num_players)
+        if LAZY_CLUES_MARKER in prompt:
+            story["clues"] = story["clues"][:1]
+        return json.dumps(story, ensure_ascii=False)
+
+    def mutate(self, content, fate):
+        if fate["mutation"] == "malformed":
+            # Break the JSON in a way none of the extraction strategies can repair
+            return "Here is your story: " + content.replace('"', "'", 3).replace("}", "", 1)
+        if fate["mutation"] == "truncated":
+            return content[:int(len(content) * fate["cut"])]
+        return content
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    standin = None  # Set by serve()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            self._send_json(200, dict(self.standin.stats))
+        else:
+            self._send_json(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self):
+        standin = self.standin
+        standin.count("requests")
+
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "Not found"}})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", "0"))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            prompt = request["messages"][-1]["content"]
+        except (ValueError, KeyError, IndexError, TypeError):
+            standin.count("bad_request")
+            self._send_json(400, {"error": {"message": "Invalid request body"}})
+            return
+
+        fate = standin.draw()
+
+        if fate["status"] == 429:
+            standin.count("429")
+            time.sleep(min(fate["delay"], 0.5))
+            self._send_json(429, {"error": {"message": "Rate limit exceeded", "code": 429}},
+                            headers={"Retry-After": "1"})
+            return
+        if fate["status"] != 200:
+            standin.count("5xx")
+            time.sleep(fate["delay"])
+            self._send_json(fate["status"], {"error": {"message": "Upstream error", "code": fate["status"]}})
+            return
+
+        content = standin.mutate(standin.content_for(prompt), fate)
+        if fate["mutation"]:
+            standin.count(fate["mutation"])
+        finish_reason = "length" if fate["mutation"] == "truncated" else "stop"
+        completion_id = f"gen-{uuid.uuid4().hex[:16]}"
+        model = request.get("model", "standin")
+
+        if request.get("stream"):
+            standin.count("streamed")
+            self._stream(completion_id, model, content, finish_reason, fate["delay"])
+            return
+
+        time.sleep(fate["delay"])
+        standin.count("ok")
+        self._send_json(200, {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": finish_reason,
+            }],
+            "usage": {
+                "prompt_tokens": len(prompt) // 4,
+                "completion_tokens": len(content) // 4,
+                "total_tokens": (len(prompt) + len(content)) // 4,
+            },
+        })
+
+    def _stream(self, completion_id, model, content, finish_reason, delay):
+        """
+        Send the completion as SSE chunks, spreading the delay over the first token
+        (half) and the remaining chunks (the other half).
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        chunks = [content[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(content), STREAM_CHUNK_CHARS)] or [""]
+        per_chunk = delay / 2 / len(chunks)
+
+        def event(delta, reason=None):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": reason}],
+            }
+            self.wfile.write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        try:
+            time.sleep(delay / 2)
+            event({"role": "assistant", "content": ""})
+            for chunk in chunks:
+                time.sleep(per_chunk)
+                event({"content": chunk})
+            event({}, finish_reason)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+            self.standin.count("ok")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # Client gave up mid-stream, e.g. on its own timeout
+
+
+def serve(standin, host="127.0.0.1", port=8090):
+    """
+    Create the stand-in HTTP server. The caller runs serve_forever().
+
+    Returns:
+        ThreadingHTTPServer: The bound server
+    """
+    handler = type("BoundStandInHandler", (StandInHandler,), {"standin": standin})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", default="0", help="Response delay distribution in seconds")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fraction of requests rate limited")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="Fraction of requests failing with 5xx")
+    parser.add_argument("--malformed", type=float, default=0.0, help="Fraction of responses with broken JSON")
+    parser.add_argument("--truncate", type=float, default=0.0, help="Fraction of responses cut short")
+    parser.add_argument("--recordings", help="JSONL file of recorded story responses to replay")
+    parser.add_argument("--seed", type=int, help="Seed for reproducible failure sequences")
+    args = parser.parse_args()
+
+    standin = StandIn(
+        latency=parse_latency(args.latency),
+        rate_429=args.rate_429,
+        rate_5xx=args.rate_5xx,
+        malformed=args.malformed,
+        truncate=args.truncate,
+        recordings=load_recordings(args.recordings) if args.recordings else None,
+        seed=args.seed,
+    )
+    server = serve(standin, args.host, args.port)
+    host, port = server.server_address[:2]
+    print(f"OpenRouter stand-in on http://{host}:{port}/v1/chat/completions")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(standin.stats))
+
+
+if __name__ == "__main__":
+    main()
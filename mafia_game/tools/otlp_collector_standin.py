@@ -0,0 +1,207 @@
+"""
+Minimal OTLP/HTTP trace collector for local use.
+
+Accepts POST /v1/traces with the OTLP JSON encoding (what utils/tracing.py sends),
+keeps the spans in memory and prints each trace as an indented tree once its root
+span arrives. Optionally appends every span to a JSONL file in the same flat format
+as TRACE_FILE.
+
+Usage (from the mafia_game directory):
+    python tools/otlp_collector_standin.py --port 4318 --output spans.jsonl
+    TRACE_OTLP_ENDPOINT=http://127.0.0.1:4318/v1/traces streamlit run app.py
+
+GET /traces returns a summary of every trace received.
+"""
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Attributes worth showing inline in the printed tree
+SUMMARY_ATTRIBUTES = ("room_code", "outcome", "provider", "strategy", "repair_count", "attempt",
+                      "http.status_code", "http.request_bytes", "http.response_bytes",
+                      "llm.prompt_tokens", "llm.completion_tokens", "llm.finish_reason")
+
+
+def _attribute_value(value):
+    for key in ("stringValue", "boolValue", "doubleValue"):
+        if key in value:
+            return value[key]
+    if "intValue" in value:
+        return int(value["intValue"])
+    if "arrayValue" in value:
+        return [_attribute_value(v) for v in value["arrayValue"].get("values", [])]
+    return None
+
+
+def flatten(payload):
+    """
+    Turn an OTLP JSON export request into flat span dicts.
+
+    Returns:
+        list: Spans in the TRACE_FILE format
+    """
+    spans = []
+    for resource_spans in payload.get("resourceSpans", []):
+        for scope_spans in resource_spans.get("scopeSpans", []):
+            for span in scope_spans.get("spans", []):
+                start, end = int(span["startTimeUnixNano"]), int(span["endTimeUnixNano"])
+                status = span.get("status", {})
+                spans.append({
+                    "trace_id": span["traceId"],
+                    "span_id": span["spanId"],
+                    "parent_id": span.get("parentSpanId") or None,
+                    "name": span["name"],
+                    "start_time_unix_nano": start,
+                    "end_time_unix_nano": end,
+                    "duration_ms": round((end - start) / 1e6, 3),
+                    "status": {0: "unset", 1: "ok", 2: "error"}.get(status.get("code", 0), "unset"),
+                    "status_message": status.get("message"),
+                    "attributes": {a["key"]: _attribute_value(a["value"]) for a in span.get("attributes", [])},
+                })
+    return spans
+
+
+def format_tree(spans):
+    """
+    Render one trace as an indented tree ordered by start time.
+
+    Returns:
+        str: The rendered tree
+    """
+    children = {}
+    for span in spans:
+        children.setdefault(span["parent_id"], []).append(span)
+    known = {span["span_id"] for span in spans}
+    roots = [s for s in spans if s["parent_id"] is None or s["parent_id"] not in known]
+    trace_start = min(s["start_time_unix_nano"] for s in spans)
+
+    lines = []
+
+    def walk(span, depth):
+        offset = (span["start_time_unix_nano"] - trace_start) / 1e6
+        details = [f"{k}={span['attributes'][k]}" for k in SUMMARY_ATTRIBUTES if k in span["attributes"]]
+        if span["status"] == "error":
+            details.append(f"ERROR {span['status_message'] or ''}".strip())
+        lines.append(f"{'  ' * depth}{span['name']:<{max(1, 36 - 2 * depth)}} "
+                     f"+{offset:>9.1f}ms {span['duration_ms']:>10.1f}ms  {' '.join(details)}")
+        for child in sorted(children.get(span["span_id"], []), key=lambda s: s["start_time_unix_nano"]):
+            walk(child, depth + 1)
+
+    for root in sorted(roots, key=lambda s: s["start_time_unix_nano"]):
+        walk(root, 0)
+    return "\n".join(lines)
+
+
+class Collector:
+    def __init__(self, output=None, quiet=False):
+        self.output = output
+        self.quiet = quiet
+        self.traces = {}  # trace_id -> [span, ...]
+        self._lock = threading.Lock()
+
+    def ingest(self, payload):
+        spans = flatten(payload)
+        finished = []
+        with self._lock:
+            for span in spans:
+                self.traces.setdefault(span["trace_id"], []).append(span)
+                if span["parent_id"] is None:
+                    finished.append(span["trace_id"])
+            if self.output:
+                with open(self.output, "a", encoding="utf-8") as f:
+                    for span in spans:
+                        f.write(json.dumps(span, ensure_ascii=False) + "\n")
+            trees = [(trace_id, list(self.traces[trace_id])) for trace_id in finished]
+
+        if not self.quiet:
+            for trace_id, trace_spans in trees:
+                print(f"trace {trace_id} ({len(trace_spans)} spans)")
+                print(format_tree(trace_spans), flush=True)
+        return len(spans)
+
+    def summary(self):
+        with self._lock:
+            result = []
+            for trace_id, spans in self.traces.items():
+                root = next((s for s in spans if s["parent_id"] is None), None)
+                result.append({
+                    "trace_id": trace_id,
+                    "root": root["name"] if root else None,
+                    "duration_ms": root["duration_ms"] if root else None,
+                    "spans": len(spans),
+                })
+            return result
+
+
+class CollectorHandler(BaseHTTPRequestHandler):
+    collector = None  # Set by serve()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/v1/traces":
+            self._send_json(404, {"error": "Not found"})
+            return
+        if "json" not in self.headers.get("Content-Type", ""):
+            self._send_json(415, {"error": "Only the OTLP JSON encoding is supported"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", "0"))
+            count = self.collector.ingest(json.loads(self.rfile.read(length) or b"{}"))
+        except (ValueError, KeyError) as e:
+            self._send_json(400, {"error": f"Invalid export request: {e}"})
+            return
+        self._send_json(200, {"partialSuccess": {}, "accepted": count})
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/traces":
+            self._send_json(200, self.collector.summary())
+        else:
+            self._send_json(404, {"error": "Not found"})
+
+
+def serve(collector, host="127.0.0.1", port=4318):
+    """
+    Create the collector HTTP server. The caller runs serve_forever().
+
+    Returns:
+        ThreadingHTTPServer: The bound server
+    """
+    handler = type("BoundCollectorHandler", (CollectorHandler,), {"collector": collector})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4318)
+    parser.add_argument("--output", help="Append every received span to this JSONL file")
+    parser.add_argument("--quiet", action="store_true", help="Don't print trace trees")
+    args = parser.parse_args()
+
+    server = serve(Collector(args.output, args.quiet), args.host, args.port)
+    host, port = server.server_address[:2]
+    print(f"OTLP collector stand-in on http://{host}:{port}/v1/traces")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
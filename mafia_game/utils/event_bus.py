@@ -0,0 +1,158 @@
+import os
+import time
+import threading
+
+from . import metrics
+
+# Events for a room that arrive within this many seconds of its first pending event
+# are delivered together, so a burst of joins reaches subscribers once
+EVENT_COALESCE_WINDOW = float(os.getenv("EVENT_COALESCE_WINDOW", "0.05"))
+
+_published_total = metrics.counter("mafia_events_published_total", "Game events published to the event bus")
+_coalesced_total = metrics.counter("mafia_events_coalesced_total",
+                                   "Game events merged into an identical pending event for the same room")
+_dispatch_lag_seconds = metrics.histogram("mafia_event_dispatch_lag_seconds",
+                                          "Time from publishing an event to dispatching it, "
+                                          "including the coalescing window")
+_dispatch_seconds = metrics.histogram("mafia_event_dispatch_seconds",
+                                      "Time spent dispatching one room's batch of events")
+
+
+class EventBus:
+    """
+    Delivers (room_code, event_type) events to a dispatch function on a dedicated
+    thread, so publishers never wait for subscribers.
+
+    Pending events are grouped per room. A room's batch is dispatched once
+    EVENT_COALESCE_WINDOW has passed since its first event, with each event type
+    delivered once, in the order first seen. Rooms are dispatched in the order their
+    batches were opened, so events for one room always arrive in order.
+    """
+    def __init__(self, dispatch_fn, name="event-bus", window=None):
+        self.dispatch_fn = dispatch_fn
+        self.name = name
+        self.window = EVENT_COALESCE_WINDOW if window is None else window
+        self._cond = threading.Condition()
+        self._pending = {}  # room_code -> (first publish time, [event types]), oldest first
+        self._dispatching = 0  # Batches taken off the queue but not yet delivered
+        self._thread = None
+        self._published = _published_total.labels()
+        self._coalesced = _coalesced_total.labels()
+        self._lag = _dispatch_lag_seconds.labels()
+        self._dispatch_time = _dispatch_seconds.labels()
+        self.stats = {"published": 0, "coalesced": 0, "dispatched": 0, "batches": 0,
+                      "errors": 0, "max_lag_seconds": 0.0, "total_lag_seconds": 0.0}
+
+    def publish(self, room_code, event_type):
+        """
+        Queue an event. Never blocks on subscribers.
+
+        Args:
+            room_code (str): The room the event belongs to
+            event_type (str): Type of event (e.g., 'join', 'start', ...)
+        """
+        now = time.monotonic()
+        with self._cond:
+            self.stats["published"] += 1
+            batch = self._pending.get(room_code)
+            if batch is None:
+                self._pending[room_code] = (now, [event_type])
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                    self._thread.start()
+                self._cond.notify_all()
+            elif event_type in batch[1]:
+                self.stats["coalesced"] += 1
+                self._coalesced.inc()
+            else:
+                batch[1].append(event_type)
+        self._published.inc()
+
+    def _take_due(self):
+        """
+        Wait for batches whose window has passed and take them off the queue.
+        Called with the condition held.
+        """
+        while True:
+            if not self._pending:
+                self._cond.wait()
+                continue
+
+            now = time.monotonic()
+            due = []
+            for room_code, (first, events) in self._pending.items():
+                if now - first < self.window:
+                    break  # Later batches were opened even later
+                due.append((room_code, first, events))
+
+            if due:
+                for room_code, _, _ in due:
+                    del self._pending[room_code]
+                self._dispatching += len(due)
+                return due
+
+            oldest = next(iter(self._pending.values()))[0]
+            self._cond.wait(self.window - (now - oldest))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                due = self._take_due()
+
+            for room_code, first, events in due:
+                start = time.monotonic()
+                lag = start - first
+                errors = 0
+                for event_type in events:
+                    try:
+                        self.dispatch_fn(room_code, event_type)
+                    except Exception as e:
+                        errors += 1
+                        print(f"Error dispatching {event_type} for room {room_code}: {str(e)}")
+                self._lag.observe(lag)
+                self._dispatch_time.observe(time.monotonic() - start)
+
+                with self._cond:
+                    self._dispatching -= 1
+                    self.stats["dispatched"] += len(events)
+                    self.stats["batches"] += 1
+                    self.stats["errors"] += errors
+                    self.stats["total_lag_seconds"] += lag
+                    self.stats["max_lag_seconds"] = max(self.stats["max_lag_seconds"], lag)
+                    self._cond.notify_all()
+
+    def flush(self, timeout=5.0):
+        """
+        Wait until every event published so far has been dispatched.
+
+        Returns:
+            bool: True if everything was dispatched before the timeout
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._dispatching:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(min(remaining, self.window or remaining))
+        return True
+
+    def get_stats(self):
+        """
+        Get event counts and dispatch lag.
+
+        Returns:
+            dict: Published, coalesced and dispatched counts, dispatch errors, the
+                  average and maximum lag, and the number of rooms with pending events
+        """
+        with self._cond:
+            stats = dict(self.stats)
+            stats["pending_rooms"] = len(self._pending)
+            oldest = next(iter(self._pending.values()))[0] if self._pending else None
+
+        total_lag = stats.pop("total_lag_seconds")
+        stats["avg_lag_seconds"] = round(total_lag / stats["batches"], 6) if stats["batches"] else 0.0
+        stats["max_lag_seconds"] = round(stats["max_lag_seconds"], 6)
+        stats["oldest_pending_seconds"] = round(time.monotonic() - oldest, 6) if oldest is not None else 0.0
+        stats["window_seconds"] = self.window
+        return stats
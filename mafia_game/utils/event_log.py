@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import threading
+
+# Directory for the game event log. Empty (the default) keeps game state in memory only.
+EVENT_LOG_DIR = os.getenv("EVENT_LOG_DIR", "")
+EVENT_LOG_FLUSH_INTERVAL = float(os.getenv("EVENT_LOG_FLUSH_INTERVAL", "0.5"))  # Seconds between batched writes
+EVENT_LOG_SNAPSHOT_EVERY = int(os.getenv("EVENT_LOG_SNAPSHOT_EVERY", "5000"))  # Events between snapshots
+EVENT_LOG_FSYNC = os.getenv("EVENT_LOG_FSYNC", "false").lower() in ("1", "true", "yes")
+
+SNAPSHOT_FILE = "snapshot.json"
+SEGMENT_PREFIX = "events-"
+SEGMENT_SUFFIX = ".jsonl"
+
+
+def _segment_name(first_seq):
+    # Zero-padded so segments sort by name in sequence order
+    return f"{SEGMENT_PREFIX}{first_seq:012d}{SEGMENT_SUFFIX}"
+
+
+def list_segments(directory):
+    """
+    Get the event segments in a log directory, oldest first.
+
+    Returns:
+        list: (first sequence number, path) tuples
+    """
+    segments = []
+    for name in os.listdir(directory):
+        if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+            try:
+                first_seq = int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+            except ValueError:
+                continue
+            segments.append((first_seq, os.path.join(directory, name)))
+    return sorted(segments)
+
+
+def read_events(directory, room_code=None, after_seq=0):
+    """
+    Read events from a log directory in sequence order. Finished games stay in the
+    log after their rooms are cleaned up, so this is also the audit trail.
+
+    Args:
+        directory (str): The log directory
+        room_code (str, optional): Only yield this room's events
+        after_seq (int): Only yield events with a higher sequence number
+
+    Yields:
+        dict: Events as written by EventLog
+    """
+    segments = list_segments(directory)
+    for idx, (first_seq, path) in enumerate(segments):
+        # Skip whole segments that end before after_seq
+        if idx + 1 < len(segments) and segments[idx + 1][0] <= after_seq + 1:
+            continue
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # A crash can leave a partly written last line
+                    print(f"Skipping unreadable event in {path}")
+                    continue
+                if event["seq"] <= after_seq:
+                    continue
+                if room_code is None or event["room"] == room_code:
+                    yield event
+
+
+class EventLog:
+    """
+    Append-only, sequence-numbered log of room changes on local disk.
+
+    Events are queued in memory by the caller (under the game state lock, so sequence
+    numbers follow the order of changes) and written in batches by a background
+    thread. Every EVENT_LOG_SNAPSHOT_EVERY events the writer asks for a snapshot of
+    all rooms, writes it atomically and starts a new segment, so recovery only
+    replays the events after the latest snapshot. Old segments are kept for auditing.
+    """
+    def __init__(self, directory, snapshot_fn, flush_interval=None, snapshot_every=None):
+        """
+        Args:
+            directory (str): Directory for segments and the snapshot, created if missing
+            snapshot_fn (callable): Returns (last sequence number, rooms) for a snapshot
+            flush_interval (float, optional): Seconds between writes
+            snapshot_every (int, optional): Events between snapshots
+        """
+        self.directory = directory
+        self.snapshot_fn = snapshot_fn
+        self.flush_interval = flush_interval or EVENT_LOG_FLUSH_INTERVAL
+        self.snapshot_every = snapshot_every or EVENT_LOG_SNAPSHOT_EVERY
+        self._cond = threading.Condition()
+        self._queue = []
+        self._appended_seq = 0  # Last event handed to append, written or not
+        self._written_seq = 0
+        self._since_snapshot = 0
+        self._segment = None
+        self._thread = None
+        self._stopped = False
+        self._flush_requested = False
+        self.stats = {"events": 0, "batches": 0, "snapshots": 0, "errors": 0}
+        os.makedirs(directory, exist_ok=True)
+
+    def load(self):
+        """
+        Read the latest snapshot and the events after it.
+
+        Returns:
+            tuple: (snapshot sequence number, rooms dict, list of later events)
+        """
+        snapshot_seq, rooms = 0, {}
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+            snapshot_seq, rooms = snapshot["seq"], snapshot["rooms"]
+
+        tail = list(read_events(self.directory, after_seq=snapshot_seq))
+        self._written_seq = tail[-1]["seq"] if tail else snapshot_seq
+        self._appended_seq = self._written_seq
+        self._since_snapshot = len(tail)
+        return snapshot_seq, rooms, tail
+
+    def start(self):
+        """
+        Start the writer thread. Events appended before this are written on its first pass.
+        """
+        with self._cond:
+            if self._thread is None:
+                self._open_segment(self._written_seq + 1)
+                self._thread = threading.Thread(target=self._run, name="event-log", daemon=True)
+                self._thread.start()
+
+    def append(self, event):
+        """
+        Queue an event for writing. Must be called in sequence order.
+
+        Args:
+            event (dict): JSON-serializable event with a "seq" key
+        """
+        with self._cond:
+            self._queue.append(event)
+            self._appended_seq = event["seq"]
+
+    def _open_segment(self, first_seq):
+        if self._segment is not None:
+            self._segment.close()
+        path = os.path.join(self.directory, _segment_name(first_seq))
+        self._segment = open(path, "a", encoding="utf-8")
+
+    def _write(self, events):
+        if not events:
+            return
+        self._segment.write("".join(json.dumps(e, ensure_ascii=False, separators=(",", ":")) + "\n"
+                                    for e in events))
+        self._segment.flush()
+        if EVENT_LOG_FSYNC:
+            os.fsync(self._segment.fileno())
+        self._written_seq = events[-1]["seq"]
+        self._since_snapshot += len(events)
+        self.stats["events"] += len(events)
+        self.stats["batches"] += 1
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopped and not self._flush_requested:
+                    self._cond.wait(self.flush_interval)
+                self._flush_requested = False
+                batch, self._queue = self._queue, []
+                stopped = self._stopped
+
+            try:
+                self._write(batch)
+                if self._since_snapshot >= self.snapshot_every:
+                    self.snapshot()
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"Error writing event log: {str(e)}")
+
+            with self._cond:
+                self._cond.notify_all()
+                if stopped and not self._queue:
+                    self._segment.close()
+                    return
+
+    def snapshot(self):
+        """
+        Write a snapshot of every room and start a new segment after it. Runs on the
+        writer thread.
+        """
+        seq, rooms = self.snapshot_fn()
+
+        # Events up to the snapshot may still be queued; they belong to the old segment
+        with self._cond:
+            covered = [e for e in self._queue if e["seq"] <= seq]
+            self._queue = self._queue[len(covered):]
+        self._write(covered)
+
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"seq": seq, "created": time.time(), "rooms": rooms}, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+        self._open_segment(seq + 1)
+        self._since_snapshot = 0
+        self.stats["snapshots"] += 1
+
+    def flush(self, timeout=5.0):
+        """
+        Wait until every event appended so far has been written, including a batch the
+        writer has already taken off the queue but not written yet.
+
+        Returns:
+            bool: True if the queue drained before the timeout
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            target = self._appended_seq
+            self._flush_requested = True
+            self._cond.notify_all()
+            while self._written_seq < target:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=5.0):
+        """
+        Write everything queued and stop the writer thread.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self.stats)
+            stats["queued"] = len(self._queue)
+        stats["written_seq"] = self._written_seq
+        stats["since_snapshot"] = self._since_snapshot
+        stats["directory"] = self.directory
+        return stats
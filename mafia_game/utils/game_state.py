@@ -1,455 +1,2300 @@
+import os
+import sys
+import json
 import uuid
+import zlib
 import random
 import time
-from collections import defaultdict
+import itertools
+import functools
+import threading
+import atexit
+import tracemalloc
+from collections import defaultdict, OrderedDict, deque
+from types import MappingProxyType
+
+from . import metrics, profiling, storyteller
+from .event_bus import EventBus
+from .event_log import EventLog, EVENT_LOG_DIR, read_events
+from .room_codes import RoomCodeAllocator
+from .timing_wheel import TimingWheel
 
 # Game state dictionary to store all active game rooms
 game_rooms = {}
 
+class FrozenDict(dict):
+    """
+    A dict that can't be modified after construction. Room summaries are published as
+    FrozenDicts so every reader can share the same object without copying it. It is
+    still a dict, so JSON serialization and .get() work as before.
+    """
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Room summaries are read-only snapshots")
+    
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+    __ior__ = _readonly
+    
+    def __reduce__(self):
+        # Rebuild from a plain dict so pickling doesn't go through __setitem__
+        return (FrozenDict, (dict(self),))
+
+ROOM_STATUSES = ("lobby", "setup", "playing", "ended")
+
+# Room fields written to the event log and snapshots. role_index and private_views are
+# rebuilt from these on restore; the compaction fields only describe the in-memory form.
+PERSISTED_FIELDS = ("admin", "players", "status", "story_data", "player_assignments", "current_round",
+                    "revealed_clues", "current_suspect", "eliminated_players", "game_result",
+                    "setup_job", "setup_progress", "setup_started", "setup_error", "discussion_deadline",
+                    "vote", "vote_result", "last_update", "version")
+
+# Fields changed by the setup transitions and by an accusation, logged as patches
+SETUP_FIELDS = ("status", "setup_job", "setup_progress", "setup_started", "setup_error")
+ACCUSATION_FIELDS = ("status", "game_result", "eliminated_players", "current_round",
+                     "revealed_clues", "current_suspect", "discussion_deadline")
+VOTE_FIELDS = ("vote", "vote_result", "discussion_deadline")
+
+def _env_seconds(name, default):
+    value = os.getenv(name, default).strip()
+    return float(value) if value else None
+
+# Story payloads of finished and abandoned games are compressed after these many
+# seconds without changes (or reads that needed the story). Empty disables.
+ROOM_COMPACT_ENDED_AFTER = _env_seconds("ROOM_COMPACT_ENDED_AFTER", "120")
+ROOM_COMPACT_IDLE_AFTER = _env_seconds("ROOM_COMPACT_IDLE_AFTER", "900")
+ROOM_COMPACT_INTERVAL = _env_seconds("ROOM_COMPACT_INTERVAL", "60")  # How often the compactor runs
+
+# Voting rounds close on their own after this many seconds if not every player has
+# voted. A tie eliminates nobody ("none"), one of the tied players at random
+# ("random"), or is voted on again between the tied players ("revote", once).
+VOTE_DURATION = float(os.getenv("VOTE_DURATION", "120"))
+VOTE_TIE_POLICY = os.getenv("VOTE_TIE_POLICY", "none").lower()
+VOTE_TIE_POLICIES = ("none", "random", "revote")
+
+# Length of the discussion countdown the admin can start each round; a vote opens
+# when it runs out
+DISCUSSION_DURATION = float(os.getenv("DISCUSSION_DURATION", "180"))
+
+# Rooms are removed after this many seconds without changes. Empty disables.
+ROOM_EXPIRE_AFTER = _env_seconds("ROOM_EXPIRE_AFTER", "86400")
+
+# A player or spectator shows as offline this many seconds after their last
+# heartbeat, and a room with nobody online is removed after ROOM_EMPTY_EXPIRE_AFTER
+# seconds (empty disables)
+PRESENCE_TIMEOUT = float(os.getenv("PRESENCE_TIMEOUT", "45"))
+ROOM_EMPTY_EXPIRE_AFTER = _env_seconds("ROOM_EMPTY_EXPIRE_AFTER", "600")
+
+# In-room chat: the most recent CHAT_HISTORY messages are kept per room, messages
+# are cut to CHAT_MAX_LENGTH characters, and each player may post CHAT_BURST
+# messages at once and CHAT_RATE per second after that
+CHAT_HISTORY = int(os.getenv("CHAT_HISTORY", "200"))
+CHAT_MAX_LENGTH = int(os.getenv("CHAT_MAX_LENGTH", "500"))
+CHAT_RATE = float(os.getenv("CHAT_RATE", "0.5"))
+CHAT_BURST = int(os.getenv("CHAT_BURST", "5"))
+
+# Run rooms in this many worker processes, each owning the rooms whose code hashes to
+# it (see utils/sharding.py). 0 or 1 keeps every room in this process.
+GAME_SHARDS = int(os.getenv("GAME_SHARDS", "0") or 0)
+
+# The histogram's _count is the number of calls; only unsuccessful calls are counted
+# separately, so a successful call costs a single metrics update
+_operation_seconds = metrics.histogram("mafia_game_state_operation_seconds",
+                                       "GameState operation latency in seconds", ["operation"])
+_operation_failures_total = metrics.counter("mafia_game_state_operation_failures_total",
+                                            "GameState operations that were rejected or raised",
+                                            ["operation", "outcome"])
+_callback_errors_total = metrics.counter("mafia_callback_errors_total",
+                                         "Exceptions raised by game state callbacks", ["callback"])
+
+def _copy_value(value):
+    # Logged values are encoded later on the writer thread, so copy what the room
+    # may still mutate in place
+    if isinstance(value, list):
+        return list(value)
+    if isinstance(value, dict):
+        return dict(value)
+    return value
+
+def _instrumented(method):
+    """
+    Record the latency of a GameState method. A call that returns False, None or an
+    error dict (unknown room, wrong status, ...) is also counted as "rejected", and one
+    that raises as "error". The method is also a scope for the on-demand profiler.
+    """
+    profiled = profiling.profiled(method)
+    if not metrics.METRICS_ENABLED:
+        return profiled
+
+    name = method.__name__
+    seconds = _operation_seconds.labels(operation=name)
+    rejected = _operation_failures_total.labels(operation=name, outcome="rejected")
+    errors = _operation_failures_total.labels(operation=name, outcome="error")
+
+    clock = time.perf_counter
+    profiler = profiling.get_profiler()
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start = clock()
+        try:
+            # The profiler's wrapper is skipped while it is off: one call less per operation
+            result = (method if profiler.mode is None else profiled)(*args, **kwargs)
+        except Exception:
+            seconds.observe(clock() - start)
+            errors.inc()
+            raise
+        seconds.observe(clock() - start)
+        if result is False or result is None or (type(result) is dict and "error" in result):
+            rejected.inc()
+        return result
+
+    return wrapper
+
+def _refused_after_handoff(rejection):
+    """
+    Make a mutating GameState method return its usual failure value once the rooms
+    have been exported to another process, so no change is made here that the new
+    process would never see. The check and the call share one lock acquisition.
+    """
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self._lock:
+                if self._drain_state == "handed_off":
+                    return dict(rejection) if isinstance(rejection, dict) else rejection
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorate
+
+HANDED_OFF_ERROR = {"error": "This game has moved to another server"}
+
 class GameState:
-    def __init__(self):
+    def __init__(self, event_log_dir=EVENT_LOG_DIR):
+        """
+        Args:
+            event_log_dir (str, optional): Record every change in an event log in this
+                                           directory and restore the rooms found there
+        """
         # Initialize empty game state
         self.game_rooms = {}
         self.callbacks = {}  # Callback registry for external integrations
+        
+        # All room access goes through this lock. Each watched room gets its own
+        # condition on the same lock so waiters in wait_for_change only wake for their
+        # room; it is made by the first waiter, so unwatched rooms wake no one.
+        self._lock = threading.RLock()
+        self._room_conditions = {}
+        # Versions come from one global counter so they stay monotonic even if a
+        # room code is cleaned up and later reused.
+        self._version_counter = itertools.count(1)
+        # Immutable summary per room, replaced (never modified) on every change so
+        # get_room_summary can hand out the current reference without locking.
+        self._snapshots = {}
+        # room code -> (summary it was built from, public view) for spectators
+        self._public_views = {}
+        self._public_view_lock = threading.Lock()
+        # Chat readers wait on these, apart from the room version waiters
+        self._chat_conditions = {}
+        # Every room's discussion countdown, vote deadline and expiry runs on this one
+        # wheel; room code -> {kind: its WheelTimer}
+        self._timers = TimingWheel(name="game-timers")
+        self._room_timers = {}
+        # (room code, name) -> time of the last heartbeat, for everyone online, least
+        # recently seen first; one timer on the wheel expires the front of it
+        self._presence = OrderedDict()
+        self._presence_timer = None
+        self._code_allocator = RoomCodeAllocator.from_env()
+        # Callbacks run on the bus's thread, never inside the mutating call
+        self._events = EventBus(self._run_callbacks, name="game-events")
+        # None, "draining" (no new rooms) or "handed_off" (rooms exported, no changes)
+        self._drain_state = None
+        # Sequence numbers for the event log, assigned under the lock
+        self._event_seq = 0
+        self._event_log = None
+        if event_log_dir:
+            self._open_event_log(event_log_dir)
+    
+    def register_callback(self, callback_id, callback_fn):
+        """
+        Register a callback function that will be called when game state changes.
+        Useful for external integrations like websockets or other real-time notification systems.
+        
+        Callbacks run on the event bus thread shortly after the change, with bursts of
+        the same event for a room delivered once (see utils/event_bus.py). Read the
+        current state from get_room_summary rather than assuming it is unchanged.
+        
+        Args:
+            callback_id (str): Unique ID for the callback
+            callback_fn (function): Function to call with (room_code, event_type) parameters
+        """
+        self.callbacks[callback_id] = callback_fn
+    
+    def unregister_callback(self, callback_id):
+        """
+        Unregister a previously registered callback.
+        
+        Args:
+            callback_id (str): ID of the callback to remove
+        """
+        if callback_id in self.callbacks:
+            del self.callbacks[callback_id]
+    
+    def _notify_callbacks(self, room_code, event_type):
+        """
+        Queue a game state change for the registered callbacks.
+        
+        Args:
+            room_code (str): The room code where the event occurred
+            event_type (str): Type of event (e.g., 'join', 'leave', 'suspect', 'accuse', etc.)
+        """
+        if self.callbacks:
+            self._events.publish(room_code, event_type)
+    
+    def _run_callbacks(self, room_code, event_type):
+        """
+        Call every registered callback for one event. Runs on the event bus thread.
+        
+        Args:
+            room_code (str): The room code where the event occurred
+            event_type (str): Type of event
+        """
+        for callback_id, callback_fn in list(self.callbacks.items()):
+            try:
+                callback_fn(room_code, event_type)
+            except Exception as e:
+                _callback_errors_total.inc(callback=callback_id)
+                print(f"Error in callback: {e}")
+    
+    def _mark_updated(self, room_code, room, event_type, fields=None):
+        """
+        Stamp a room as changed, record the change in the event log and wake any
+        threads waiting on it. Must be called with the lock held.
+        
+        Args:
+            room_code (str): The room code
+            room (dict): The room data
+            event_type (str): Type of change, as passed to the callbacks
+            fields (tuple, optional): The fields that changed; None records the whole room
+        """
+        room["last_update"] = time.time()
+        room["version"] = next(self._version_counter)
+        if self._event_log is not None:
+            if fields is None:
+                self._log_event(room_code, event_type, op="put", state=self._serialize_room(room))
+            else:
+                self._log_event(room_code, event_type, op="set", version=room["version"],
+                                last_update=room["last_update"],
+                                fields={field: _copy_value(room[field]) for field in fields})
+        # Publish before waking waiters so they read the new version
+        self._snapshots[room_code] = self._build_summary(room)
+        condition = self._room_conditions.get(room_code)
+        if condition is not None:
+            condition.notify_all()
+    
+    def wait_for_change(self, room_code, version, timeout=30.0):
+        """
+        Block until the room's version is newer than the given one, or until timeout.
+        Returns immediately if the room has already moved past the caller's version.
+        
+        Args:
+            room_code (str): The room code to watch
+            version (int): The last version the caller has seen (0 for none)
+            timeout (float): Maximum number of seconds to wait
+            
+        Returns:
+            dict: The current room summary (compare its "version" to detect a timeout),
+                  or None if the room does not exist or was removed while waiting
+        """
+        deadline = time.monotonic() + max(0.0, timeout)
+        
+        with self._lock:
+            room = self.game_rooms.get(room_code)
+            if room is None:
+                return None
+            
+            condition = self._room_conditions.get(room_code)
+            if condition is None:
+                condition = self._room_conditions[room_code] = threading.Condition(self._lock)
+            while room["version"] <= version:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                condition.wait(remaining)
+                
+                room = self.game_rooms.get(room_code)
+                if room is None:
+                    return None
+            
+            return self.get_room_summary(room_code)
+    
+    def flush_events(self, timeout=5.0):
+        """
+        Wait until callbacks have run for every change made so far.
+        
+        Args:
+            timeout (float): Maximum number of seconds to wait
+            
+        Returns:
+            bool: True if all events were dispatched in time
+        """
+        return self._events.flush(timeout)
+    
+    def get_event_stats(self):
+        """
+        Get event bus counters and callback dispatch lag.
+        
+        Returns:
+            dict: See EventBus.get_stats
+        """
+        return self._events.get_stats()
+    
+    def _log_event(self, room_code, event_type, **entry):
+        """
+        Queue a change for the event log. Must be called with the lock held so
+        sequence numbers follow the order of changes.
+        
+        Args:
+            room_code (str): The room code
+            event_type (str): Type of change
+            **entry: The change: op="put" with the full state, op="set" with changed
+                     fields, op="clue" with a replaced clue, or op="remove"
+        """
+        self._event_seq += 1
+        entry.update(seq=self._event_seq, ts=time.time(), room=room_code, event=event_type)
+        self._event_log.append(entry)
+    
+    def _serialize_room(self, room):
+        """
+        Get the persisted fields of a room as JSON-serializable data, with a compacted
+        story expanded. Must be called with the lock held.
+        
+        Args:
+            room (dict): The room data
+            
+        Returns:
+            dict: The room state
+        """
+        state = {field: _copy_value(room[field]) for field in PERSISTED_FIELDS}
+        if room["compacted"] is not None:
+            payload = json.loads(zlib.decompress(room["compacted"]).decode("utf-8"))
+            state["story_data"] = payload["story_data"]
+            state["revealed_clues"] = payload["revealed_clues"]
+        elif state["story_data"]:
+            # Clues are replaced in place by supply_clue
+            state["story_data"]["clues"] = list(state["story_data"]["clues"])
+        return state
+    
+    def _deserialize_room(self, state):
+        """
+        Rebuild a room from its persisted state, including the role index and
+        private views of a started game.
+        
+        Args:
+            state (dict): The room state from _serialize_room
+            
+        Returns:
+            dict: The room data
+        """
+        room = dict(state)
+        # Rooms logged before voting existed have no ballot
+        room.setdefault("discussion_deadline", None)
+        room.setdefault("vote", None)
+        room.setdefault("vote_result", None)
+        # Spectators, presence and chat aren't persisted; spectators rejoin through their
+        # session's query params
+        room.update({"role_index": None, "private_views": {}, "spectators": [], "online": set(),
+                     "chat": deque(maxlen=CHAT_HISTORY), "chat_seq": 0, "chat_buckets": {},
+                     "compacted": None, "expanded_at": None})
+        if room["status"] in ["playing", "ended"] and room["story_data"]:
+            room["role_index"], room["private_views"] = self._build_role_index(room["player_assignments"],
+                                                                               room["story_data"])
+        return room
+    
+    def _snapshot_rooms(self):
+        """
+        Capture every room for an event log snapshot.
+        
+        Returns:
+            tuple: (sequence number of the last event included, room code -> state)
+        """
+        with self._lock:
+            return self._event_seq, {code: self._serialize_room(room) for code, room in self.game_rooms.items()}
+    
+    @staticmethod
+    def _apply_logged_event(rooms, event):
+        """
+        Apply one logged change to persisted room states during replay.
+        
+        Args:
+            rooms (dict): room code -> state, updated in place
+            event (dict): The logged event
+        """
+        room_code, op = event["room"], event["op"]
+        if op == "put":
+            rooms[room_code] = event["state"]
+            return
+        if op == "remove":
+            rooms.pop(room_code, None)
+            return
+        
+        state = rooms.get(room_code)
+        if state is None:
+            print(f"Event {event['seq']} refers to unknown room {room_code}, skipping")
+            return
+        if op == "set":
+            state.update(event["fields"])
+            state["version"] = event["version"]
+            state["last_update"] = event["last_update"]
+        elif op == "clue":
+            state["story_data"]["clues"][event["index"]] = event["text"]
+    
+    def _open_event_log(self, directory):
+        """
+        Restore the rooms recorded in an event log directory from its latest snapshot
+        plus the events after it, then record all further changes there.
+        
+        Args:
+            directory (str): The event log directory
+        """
+        start = time.perf_counter()
+        event_log = EventLog(directory, self._snapshot_rooms)
+        snapshot_seq, rooms, tail = event_log.load()
+        for event in tail:
+            self._apply_logged_event(rooms, event)
+        
+        with self._lock:
+            for room_code, state in rooms.items():
+                room = self._deserialize_room(state)
+                self.game_rooms[room_code] = room
+                self._snapshots[room_code] = self._build_summary(room)
+            
+            # Keep versions and sequence numbers increasing across the restart
+            last_version = max([state["version"] for state in rooms.values()] +
+                               [event.get("version", 0) for event in tail] + [0])
+            self._version_counter = itertools.count(last_version + 1)
+            self._event_seq = tail[-1]["seq"] if tail else snapshot_seq
+            self._event_log = event_log
+            self._arm_room_timers()
+        
+        event_log.start()
+        atexit.register(event_log.close)
+        print(f"Restored {len(rooms)} room(s) from {directory}: snapshot at event {snapshot_seq} "
+              f"plus {len(tail)} replayed in {(time.perf_counter() - start) * 1000:.1f} ms")
+        
+        self._reset_interrupted_setups()
+    
+    def _reset_interrupted_setups(self, room_codes=None):
+        """
+        Generation jobs don't survive a restart, so send rooms restored in setup back
+        to the lobby.
+        
+        Args:
+            room_codes (list, optional): Only check these rooms
+        """
+        for room_code in list(room_codes if room_codes is not None else self.game_rooms):
+            room = self.game_rooms.get(room_code)
+            if room is not None and room["status"] == "setup":
+                self.cancel_setup(room_code, error="The server restarted while the story was being written. "
+                                                   "Please start the game again.")
+    
+    def _arm_room_timers(self, room_codes=None):
+        """
+        Restart the timers of restored rooms: their expiry (also if nobody comes
+        back), and the discussion
+        countdown or vote that was running when they were saved. A deadline that
+        passed in the meantime fires straight away. Must be called with the lock held.
+        
+        Args:
+            room_codes (list, optional): Only these rooms
+        """
+        for room_code in (room_codes if room_codes is not None else list(self.game_rooms)):
+            room = self.game_rooms[room_code]
+            self._arm_expiry(room_code, room)
+            # Nobody is online until their sessions reconnect
+            self._arm_empty_expiry(room_code)
+            if room["discussion_deadline"] is not None:
+                self._set_timer(room_code, "discussion", room["discussion_deadline"],
+                                self._end_discussion, room_code, room["discussion_deadline"])
+            if room["vote"] is not None:
+                self._arm_vote_timer(room_code, room["vote"])
+    
+    def _set_timer(self, room_code, kind, deadline, fn, *args):
+        """
+        Schedule a room's timer on the shared wheel, replacing its previous timer of
+        the same kind. Must be called with the lock held.
+        
+        Args:
+            room_code (str): The room code
+            kind (str): "discussion", "vote", "expiry" or "empty"
+            deadline (float): When to fire, as a time.time() value
+            fn (callable): Called with args on the wheel's thread
+        """
+        timers = self._room_timers.get(room_code)
+        if timers is None:
+            timers = self._room_timers[room_code] = {}
+        previous = timers.get(kind)
+        if previous is not None:
+            previous.cancel()
+        timers[kind] = self._timers.schedule(deadline - time.time(), fn, *args)
+    
+    def _cancel_timer(self, room_code, kind):
+        # Also drops a timer that is firing, so it isn't cancelled again later
+        timers = self._room_timers.get(room_code)
+        timer = timers.pop(kind, None) if timers else None
+        if timer is not None:
+            timer.cancel()
+    
+    def _arm_expiry(self, room_code, room):
+        if ROOM_EXPIRE_AFTER:
+            self._set_timer(room_code, "expiry", room["last_update"] + ROOM_EXPIRE_AFTER,
+                            self._expire_room, room_code)
+    
+    def _expire_room(self, room_code):
+        """
+        Remove a room that hasn't changed for ROOM_EXPIRE_AFTER seconds and has nobody
+        online. Changes don't touch the timer; instead a room that changed since it
+        was armed is checked again when its new expiry comes. Runs on the timer thread.
+        """
+        with self._lock:
+            room = self.game_rooms.get(room_code)
+            if room is None or self._drain_state == "handed_off":
+                return
+            self._cancel_timer(room_code, "expiry")
+            if time.time() - room["last_update"] < ROOM_EXPIRE_AFTER or room["online"]:
+                self._arm_expiry(room_code, room)
+                return
+            self._remove_room(room_code, "expired")
+    
+    def _remove_room(self, room_code, event_type):
+        """
+        Delete a room and everything kept for it. Must be called with the lock held.
+        
+        Args:
+            room_code (str): The room code
+            event_type (str): Why, as logged and passed to the callbacks
+        """
+        room = self.game_rooms.pop(room_code)
+        if self._event_log is not None:
+            self._log_event(room_code, event_type, op="remove")
+        self._snapshots.pop(room_code, None)
+        self._public_views.pop(room_code, None)
+        chat_condition = self._chat_conditions.pop(room_code, None)
+        if chat_condition is not None:
+            chat_condition.notify_all()
+        for name in room["online"]:
+            self._presence.pop((room_code, name), None)
+        for timer in self._room_timers.pop(room_code, {}).values():
+            timer.cancel()
+        # Wake anyone waiting on the room so they see it is gone
+        condition = self._room_conditions.pop(room_code, None)
+        if condition is not None:
+            condition.notify_all()
+        self._notify_callbacks(room_code, event_type)
+    
+    @_instrumented
+    @_refused_after_handoff(False)
+    def heartbeat(self, room_code, name):
+        """
+        Record that a player or spectator is still connected. Called on every page run
+        and periodically for each open session; costs O(1). Going online or offline
+        changes the room's "online_players" and version, and a heartbeat that doesn't
+        change either publishes nothing.
+        
+        Args:
+            room_code (str): The room code
+            name (str): The player or spectator
+            
+        Returns:
+            bool: True if recorded, False if the room doesn't exist or has nobody by that name
+        """
+        with self._lock:
+            room = self.game_rooms.get(room_code)
+            if room is None or (name not in room["players"] and name not in room["spectators"]):
+                return False
+            
+            key = (room_code, name)
+            self._presence[key] = time.monotonic()
+            self._presence.move_to_end(key)
+            if self._presence_timer is None:
+                self._presence_timer = self._timers.schedule(PRESENCE_TIMEOUT, self._expire_presence)
+            
+            if name not in room["online"]:
+                room["online"].add(name)
+                self._cancel_timer(room_code, "empty")
+                if name in room["players"]:
+                    self._mark_updated(room_code, room, "online", ())
+                    self._notify_callbacks(room_code, "online")
+            return True
+    
+    def _expire_presence(self):
+        """
+        Take everyone whose last heartbeat is older than PRESENCE_TIMEOUT offline, in
+        one pass from the front of the presence queue, then wait for the next one to
+        expire. Spectators who went away stop watching. Rooms left with nobody online
+        are removed if nobody comes back within ROOM_EMPTY_EXPIRE_AFTER. Runs on the
+        timer thread.
+        """
+        with self._lock:
+            self._presence_timer = None
+            if self._drain_state == "handed_off":
+                return
+            now = time.monotonic()
+            cutoff = now - PRESENCE_TIMEOUT
+            changed = {}  # room code -> True if a player went offline
+            while self._presence:
+                key, seen = next(iter(self._presence.items()))
+                if seen > cutoff:
+                    break
+                del self._presence[key]
+                room_code, name = key
+                room = self.game_rooms.get(room_code)
+                if room is None:
+                    continue
+                room["online"].discard(name)
+                if name in room["spectators"]:
+                    room["spectators"].remove(name)
+                changed[room_code] = changed.get(room_code, False) or name in room["players"]
+            
+            # One update per room, however many of its players dropped
+            for room_code, players_changed in changed.items():
+                room = self.game_rooms[room_code]
+                if players_changed:
+                    self._mark_updated(room_code, room, "offline", ())
+                    self._notify_callbacks(room_code, "offline")
+                else:
+                    self._snapshots[room_code] = self._build_summary(room)
+                if not room["online"]:
+                    self._arm_empty_expiry(room_code)
+            
+            if self._presence:
+                seen = next(iter(self._presence.values()))
+                self._presence_timer = self._timers.schedule(seen + PRESENCE_TIMEOUT - now, self._expire_presence)
+    
+    def _arm_empty_expiry(self, room_code):
+        if ROOM_EMPTY_EXPIRE_AFTER:
+            self._set_timer(room_code, "empty", time.time() + ROOM_EMPTY_EXPIRE_AFTER,
+                            self._reclaim_empty_room, room_code)
+    
+    def _reclaim_empty_room(self, room_code):
+        """
+        Remove a room that has had nobody online for ROOM_EMPTY_EXPIRE_AFTER seconds.
+        Runs on the timer thread.
+        """
+        with self._lock:
+            room = self.game_rooms.get(room_code)
+            if room is None or room["online"] or self._drain_state == "handed_off":
+                return
+            self._cancel_timer(room_code, "empty")
+            self._remove_room(room_code, "abandoned")
+    
+    def get_timer_stats(self):
+        """
+        Get counters of the timer wheel.
+        
+        Returns:
+            dict: See TimingWheel.get_stats
+        """
+        return self._timers.get_stats()
+    
+    def drain(self):
+        """
+        Stop creating rooms here; existing games carry on until they are handed off.
+        """
+        with self._lock:
+            if self._drain_state is None:
+                self._drain_state = "draining"
+    
+    def get_drain_state(self):
+        """
+        Returns:
+            str: None, "draining" or "handed_off"
+        """
+        return self._drain_state
+    
+    def export_rooms(self, path):
+        """
+        Write every room to a handoff file for another process to load, and stop
+        accepting changes here: from now on mutating calls fail as they would for an
+        unknown room, and reads keep serving the last state.
+        
+        Args:
+            path (str): The handoff file, replaced atomically
+            
+        Returns:
+            int: Number of rooms exported
+        """
+        with self._lock:
+            self._drain_state = "handed_off"
+            rooms = {room_code: self._serialize_room(room) for room_code, room in self.game_rooms.items()}
+        
+        # Nothing changes after the state flips, so the file can be written without the lock
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"created": time.time(), "pid": os.getpid(), "rooms": rooms}, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return len(rooms)
+    
+    def import_rooms(self, path):
+        """
+        Load the rooms from a handoff file written by export_rooms. Rooms whose code is
+        already in use here are skipped.
+        
+        Args:
+            path (str): The handoff file
+            
+        Returns:
+            int: Number of rooms imported
+        """
+        with open(path, encoding="utf-8") as f:
+            rooms = json.load(f)["rooms"]
+        
+        imported = []
+        with self._lock:
+            # Clients keep the versions they saw on the old server; stay above them
+            last_version = max([state["version"] for state in rooms.values()] + [0])
+            self._version_counter = itertools.count(max(next(self._version_counter), last_version + 1))
+            
+            for room_code, state in rooms.items():
+                if room_code in self.game_rooms:
+                    print(f"Room {room_code} from the handoff file already exists here, skipping it")
+                    continue
+                
+                room = self._deserialize_room(state)
+                self.game_rooms[room_code] = room
+                self._mark_updated(room_code, room, "handoff")
+                self._notify_callbacks(room_code, "handoff")
+                imported.append(room_code)
+            self._arm_room_timers(imported)
+        
+        # The old process's generation jobs stopped with it
+        self._reset_interrupted_setups(imported)
+        return len(imported)
+    
+    def flush_event_log(self, timeout=5.0):
+        """
+        Wait until every change so far has been written to the event log.
+        
+        Returns:
+            bool: True if written in time (or there is no event log)
+        """
+        return self._event_log.flush(timeout) if self._event_log is not None else True
+    
+    def get_event_log_stats(self):
+        """
+        Get event log counters.
+        
+        Returns:
+            dict: Events, batches and snapshots written and the last sequence number,
+                  or None if there is no event log
+        """
+        return self._event_log.get_stats() if self._event_log is not None else None
+    
+    def get_room_history(self, room_code):
+        """
+        Read every logged change of a room, including rooms that have been cleaned up.
+        Reads the whole log, so it is meant for audits rather than gameplay.
+        
+        Args:
+            room_code (str): The room code
+            
+        Returns:
+            list: The room's events in order, or None if there is no event log
+        """
+        if self._event_log is None:
+            return None
+        self._event_log.flush()
+        return list(read_events(self._event_log.directory, room_code=room_code))
+    
+    def get_all_room_codes(self):
+        """
+        Get list of all active room codes.
+        
+        Returns:
+            list: All active room codes
+        """
+        with self._lock:
+            return list(self.game_rooms.keys())
+    
+    def count_rooms_by_status(self):
+        """
+        Count active rooms in each status.
+        
+        Returns:
+            dict: status -> number of rooms, including statuses with no rooms
+        """
+        counts = dict.fromkeys(ROOM_STATUSES, 0)
+        # Snapshots carry the status, so counting doesn't need the lock
+        for summary in list(self._snapshots.values()):
+            counts[summary["status"]] = counts.get(summary["status"], 0) + 1
+        return counts
+    
+    def generate_room_code(self):
+        """
+        Generate a unique 6-character alphanumeric room code.
+        
+        Returns:
+            str: A unique room code
+        """
+        # O(1) regardless of how many rooms exist; see utils/room_codes.py
+        return self._code_allocator.allocate(self.game_rooms)
+    
+    @_instrumented
+    def create_game_room(self, admin_name, room_code=None):
+        """
+        Create a new game room with the given admin.
+        
+        Args:
+            admin_name (str): The name of the admin player
+            room_code (str, optional): Code chosen by the caller, e.g. the shard router,
+                                       instead of allocating one
+            
+        Returns:
+            tuple: (room_code, room_data), or (None, None) while the server is draining
+                   or if the given code is taken
+        """
+        with self._lock:
+            if self._drain_state is not None:
+                return None, None
+            
+            if room_code is None:
+                room_code = self.generate_room_code()
+            elif room_code in self.game_rooms:
+                return None, None
+            
+            room_data = {
+                "admin": admin_name,
+                "players": [admin_name],
+                "spectators": [],  # Watching only; never assigned a role, see join_as_spectator
+                "online": set(),  # Players and spectators with a recent heartbeat, see heartbeat
+                "chat": deque(maxlen=CHAT_HISTORY),  # Latest chat messages, see post_message
+                "chat_seq": 0,  # Sequence number of the last chat message
+                "chat_buckets": {},  # Maps player names to their rate limit [tokens, last refill]
+                "status": "lobby",  # lobby, setup, playing, ended
+                "story_data": None,
+                "player_assignments": {},  # Maps player names to character indices
+                "role_index": None,  # Built by start_game, see _build_role_index
+                "private_views": {},  # Maps player names to their read-only character info
+                "current_round": 0,
+                "revealed_clues": [],
+                "current_suspect": None,  # Player currently suspected by admin
+                "eliminated_players": [],
+                "game_result": None,  # "civilians_win", "mafia_wins", or None if game is ongoing
+                "setup_job": None,  # ID of the generation job while status is "setup"
+                "setup_progress": None,
+                "setup_started": None,
+                "setup_error": None,  # Why the last setup attempt returned to the lobby
+                "discussion_deadline": None,  # When this round's discussion ends, see start_discussion
+                "vote": None,  # The open ballot while players vote, see open_voting
+                "vote_result": None,  # Outcome of the last vote, shown until the next one opens
+                "compacted": None,  # zlib blob of story_data and revealed_clues, see compact_rooms
+                "expanded_at": None,  # When the compacted story was last restored
+                "last_update": time.time(),  # Timestamp of last update for synchronization
+                "version": 0  # Bumped on every change, used by wait_for_change
+            }
+            
+            self.game_rooms[room_code] = room_data
+            self._mark_updated(room_code, room_data, "create")
+            self._arm_expiry(room_code, room_data)
+            self._notify_callbacks(room_code, "create")
+            return room_code, room_data
+    
+    @_instrumented
+    @_refused_after_handoff(False)
+    def join_game_room(self, room_code, player_name):
+        """
+        Add a player to an existing game room.
+        
+        Args:
+            room_code (str): The room code to join
+            player_name (str): The name of the joining player
+            
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        with self._lock:
+            if room_code not in self.game_rooms:
+                return False
+            
+            room = self.game_rooms[room_code]
+            
+            # Check if player already exists in the room
+            if player_name in room["players"]:
+                return True  # Allow rejoining if already in the room
+            
+            # Only allow new players to join in lobby phase
+            if room["status"] != "lobby":
+                return False
+            
+            room["players"].append(player_name)
+            if player_name in room["spectators"]:
+                room["spectators"].remove(player_name)
+            self._mark_updated(room_code, room, "join", ("players",))
+            self._notify_callbacks(room_code, "join")
+            return True
+    
+    @_instrumented
+    @_refused_after_handoff(False)
+    def begin_setup(self, room_code, job_id):
+        """
+        Move a room from the lobby into the setup phase while its story is generated.
+        
+        Args:
+            room_code (str): The room code
+            job_id (str): ID of the generation job that owns this setup
+            
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        with self._lock:
+            if room_code not in self.game_rooms:
+                return False
+            
+            room = self.game_rooms[room_code]
+            
+            if room["status"] != "lobby":
+                return False
+            
+            if len(room["players"]) < 3:  # Minimum 3 players required
+                return False
+            
+            room["status"] = "setup"
+            room["setup_job"] = job_id
+            room["setup_progress"] = "Waiting for a storyteller..."
+            room["setup_started"] = time.time()
+            room["setup_error"] = None
+            self._mark_updated(room_code, room, "setup", SETUP_FIELDS)
+            
+            self._notify_callbacks(room_code, "setup")
+            return True
+    
+    @_instrumented
+    @_refused_after_handoff(False)
+    def update_setup_progress(self, room_code, job_id, message):
+        """
+        Publish a progress message for a room that is being set up.
+        
+        Args:
+            room_code (str): The room code
+            job_id (str): ID of the generation job reporting progress
+            message (str): Progress message shown to every player
+            
+        Returns:
+            bool: True if successful, False if the job no longer owns the room
+        """
+        with self._lock:
+            room = self.game_rooms.get(room_code)
+            if not room or room["status"] != "setup" or room.get("setup_job") != job_id:
+                return False
+            
+            room["setup_progress"] = message
+            self._mark_updated(room_code, room, "setup_progress", ("setup_progress",))
+            
+            self._notify_callbacks(room_code, "setup_progress")
+            return True
+    
+    @_instrumented
+    @_refused_after_handoff(False)
+    def cancel_setup(self, room_code, job_id=None, error=None):
+        """
+        Return a room from setup to the lobby, e.g. when generation is cancelled or fails.
+        
+        Args:
+            room_code (str): The room code
+            job_id (str, optional): Only cancel if this job still owns the setup
+            error (str, optional): Error message to show in the lobby
+            
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        with self._lock:
+            room = self.game_rooms.get(room_code)
+            if not room or room["status"] != "setup":
+                return False
+            
+            if job_id is not None and room.get("setup_job") != job_id:
+                return False
+            
+            room["status"] = "lobby"
+            room["setup_job"] = None
+            room["setup_progress"] = None
+            room["setup_started"] = None
+            room["setup_error"] = error
+            self._mark_updated(room_code, room, "setup_cancelled", SETUP_FIELDS)
+            
+            self._notify_callbacks(room_code, "setup_cancelled")
+            return True
+    
+    def _build_role_index(self, player_assignments, story_data):
+        """
+        Precompute role lookups and each player's private view for a started game,
+        so later reads don't have to resolve assignments against the story.
+        
+        Args:
+            player_assignments (dict): Maps player names to character indices
+            story_data (dict): The story data with roles already assigned
+            
+        Returns:
+            tuple: (role_index, private_views)
+        """
+        story_players = story_data["players"]
+        character_to_players = defaultdict(list)
+        mafia_players = set()
+        private_views = {}
+        
+        for player, character_idx in player_assignments.items():
+            character_info = story_players[character_idx]
+            character_to_players[character_idx].append(player)
+            if character_info["is_mafia"]:
+                mafia_players.add(player)
+            
+            private_views[player] = MappingProxyType({
+                "character_name": character_info["character_name"],
+                "character_description": character_info["character_description"],
+                "is_mafia": character_info["is_mafia"]
+            })
+        
+        role_index = {
+            "mafia_players": frozenset(mafia_players),
+            "character_to_players": {idx: tuple(p) for idx, p in character_to_players.items()},
+            "player_to_character": MappingProxyType(dict(player_assignments))
+        }
+        return role_index, private_views
+    
+    @_instrumented
+    @_refused_after_handoff(False)
+    def start_game(self, room_code, story_data, job_id=None):
+        """
+        Start a game with the given story data.
+        
+        Args:
+            room_code (str): The room code
+            story_data (dict): The story data from the LLM
+            job_id (str, optional): Generation job finishing the setup phase; a room in
+                                    setup only accepts the story from the job that owns it
+            
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        with self._lock:
+            if room_code not in self.game_rooms:
+                return False
+            
+            room = self.game_rooms[room_code]
+            
+            if room["status"] == "setup":
+                if job_id is None or room.get("setup_job") != job_id:
+                    return False
+            elif room["status"] != "lobby":
+                return False
+            
+            if len(room["players"]) < 3:  # Minimum 3 players required
+                return False
+            
+            # Assign characters to players (only Mafia or Civilian)
+            players = room["players"].copy()
+            random.shuffle(players)
+            
+            # Create player assignments
+            player_assignments = {}
+            for i, player in enumerate(players):
+                player_assignments[player] = i % len(story_data["players"])
+            
+            # Randomly select one player to be Mafia
+            mafia_player = random.choice(list(player_assignments.keys()))
+            
+            # Update player roles in story data
+            for i in range(len(story_data["players"])):
+                story_data["players"][i]["is_mafia"] = False
+                story_data["players"][i]["is_killed"] = False  # No killed player role
+            
+            # Find which character index to make Mafia
+            mafia_character_idx = player_assignments[mafia_player]
+            story_data["players"][mafia_character_idx]["is_mafia"] = True
+            
+            room["status"] = "playing"
+            room["story_data"] = story_data
+            room["player_assignments"] = player_assignments
+            room["role_index"], room["private_views"] = self._build_role_index(player_assignments, story_data)
+            room["current_round"] = 1
+            room["revealed_clues"] = [story_data["clues"][0]]  # Reveal first clue
+            room["current_suspect"] = None
+            room["setup_job"] = None
+            room["setup_progress"] = None
+            room["setup_started"] = None
+            room["setup_error"] = None
+            self._mark_updated(room_code, room, "start")
+            
+            self._notify_callbacks(room_code, "start")
+            return True
+    
+    @_instrumented
+    @_refused_after_handoff(False)
+    def set_admin_suspect(self, room_code, suspect_name):
+        """
+        Set the admin's current suspect.
+        
+        Args:
+            room_code (str): The room code
+            suspect_name (str): The name of the suspected player
+            
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        with self._lock:
+            if room_code not in self.game_rooms:
+                return False
+            
+            room = self.game_rooms[room_code]
+            
+            if room["status"] != "playing":
+                return False
+            
+            if suspect_name not in room["players"]:
+                return False
+            
+            room["current_suspect"] = suspect_name
+            self._mark_updated(room_code, room, "suspect", ("current_suspect",))
+            
+            self._notify_callbacks(room_code, "suspect")
+            return True
+    
+    @_instrumented
+    @_refused_after_handoff(HANDED_OFF_ERROR)
+    def process_admin_accusation(self, room_code):
+        """
+        Process the admin's accusation against the current suspect.
+        
+        Args:
+            room_code (str): The room code
+            
+        Returns:
+            dict: Results of the accusation
+        """
+        with self._lock:
+            room = self.game_rooms.get(room_code)
+            if not room or room["status"] != "playing":
+                return {"error": "Invalid game state"}
+            
+            if room["vote"] is not None:
+                return {"error": "The players are voting"}
+            
+            suspect = room["current_suspect"]
+            if not suspect:
+                return {"error": "No suspect selected"}
+            
+            result, event_type = self._resolve_accusation(room_code, room, suspect)
+            
+            # Stamp the change before notifying so callbacks see the new version
+            self._mark_updated(room_code, room, event_type, ACCUSATION_FIELDS)
+            self._notify_callbacks(room_code, event_type)
+            return result
+    
+    def _resolve_accusation(self, room_code, room, suspect):
+        """
+        Apply the outcome of accusing a player, whether the admin accused them or the
+        players voted them out: the game ends if they are the Mafia or if only the
+        Mafia and one Civilian remain, otherwise they are eliminated and the next round
+        starts. Must be called with the lock held.
+        
+        Args:
+            room_code (str): The room code
+            room (dict): The room data
+            suspect (str): The accused player
+            
+        Returns:
+            tuple: (result dict, event type)
+        """
+        room["discussion_deadline"] = None
+        self._cancel_timer(room_code, "discussion")
+        self._expand_room(room_code, room)
+        # Get character info for suspected player
+        mafia_players = room["role_index"]["mafia_players"]
+        is_mafia = suspect in mafia_players
+        
+        result = {
+            "suspected_player": suspect,
+            "character_name": room["private_views"][suspect]["character_name"],
+            "is_mafia": is_mafia
+        }
+        
+        # Check if accusation was correct (suspect is Mafia)
+        if is_mafia:
+            room["status"] = "ended"
+            room["game_result"] = "civilians_win"
+            result["game_over"] = True
+            result["winner"] = "civilians"
+            return result, "game_over"
+        
+        # Eliminate the wrongly accused player
+        room["eliminated_players"].append(suspect)
+        
+        # Count remaining players
+        active_players = [p for p in room["players"] if p not in room["eliminated_players"]]
+        
+        # Get number of mafia players remaining
+        mafia_count = sum(1 for player in active_players if player in mafia_players)
+        civilian_count = len(active_players) - mafia_count
+        
+        # Check if Mafia wins (only 1 civilian left)
+        if mafia_count == 1 and civilian_count == 1:
+            room["status"] = "ended"
+            room["game_result"] = "mafia_wins"
+            result["game_over"] = True
+            result["winner"] = "mafia"
+            return result, "game_over"
+        
+        self._next_round(room, result)
+        return result, "next_round"
+    
+    def _next_round(self, room, result):
+        """
+        Move a game on to its next round, revealing the next clue if there is one.
+        Must be called with the lock held.
+        
+        Args:
+            room (dict): The room data, with its story expanded
+            result (dict): Accusation or vote result, updated with the new round
+        """
+        room["current_round"] += 1
+        
+        # Reveal next clue if available
+        if room["current_round"] <= len(room["story_data"]["clues"]):
+            next_clue = room["story_data"]["clues"][room["current_round"] - 1]
+            room["revealed_clues"].append(next_clue)
+        
+        # Reset current suspect
+        room["current_suspect"] = None
+        
+        result["game_over"] = False
+        result["next_round"] = room["current_round"]
+        
+        if len(room["revealed_clues"]) >= len(room["story_data"]["clues"]):
+            result["new_clue"] = None
+        else:
+            result["new_clue"] = room["revealed_clues"][-1]
+    
+    @_instrumented
+    @_refused_after_handoff(False)
+    def start_discussion(self, room_code, duration=None):
+        """
+        Start the round's discussion countdown. Everyone sees the deadline in the room
+        summary, and a vote opens when it runs out (unless the admin opened one or
+        made an accusation first).
+        
+        Args:
+            room_code (str): The room code
+            duration (float, optional): Seconds of discussion, defaults to DISCUSSION_DURATION
+            
+        Returns:
+            bool: True if the countdown started, False if the game isn't playing or a
+                  vote is open
+        """
+        duration = DISCUSSION_DURATION if duration is None else duration
+        with self._lock:
+            room = self.game_rooms.get(room_code)
+            if not room or room["status"] != "playing" or room["vote"] is not None:
+                return False
+            
+            deadline = time.time() + duration
+            room["discussion_deadline"] = deadline
+            self._set_timer(room_code, "discussion", deadline, self._end_discussion, room_code, deadline)
+            self._mark_updated(room_code, room, "discussion", ("discussion_deadline",))
+            self._notify_callbacks(room_code, "discussion")
+            return True
+    
+    def _end_discussion(self, room_code, deadline):
+        """
+        Open the vote when a discussion countdown runs out. Runs on the timer thread.
+        
+        Args:
+            room_code (str): The room code
+            deadline (float): The countdown's deadline; a countdown since replaced or
+                              stopped does nothing
+        """
+        with self._lock:
+            room = self.game_rooms.get(room_code)
+            if room is None or room["discussion_deadline"] != deadline or self._drain_state == "handed_off":
+                return
+            
+            self._cancel_timer(room_code, "discussion")
+            room["discussion_deadline"] = None
+            if room["status"] == "playing" and room["vote"] is None:
+                alive = [p for p in room["players"] if p not in room["eliminated_players"]]
+                self._open_vote(room_code, room, alive, alive, VOTE_DURATION, VOTE_TIE_POLICY, revote=False)
+            self._mark_updated(room_code, room, "discussion_over", VOTE_FIELDS)
+            self._notify_callbacks(room_code, "discussion_over")
+    
+    @_instrumented
+    @_refused_after_handoff(False)
+    def open_voting(self, room_code, duration=None, tie_policy=None, candidates=None):
+        """
+        Open a vote for the current round. Every player still in the game gets one
+        vote for another player still in the game; the vote closes as soon as the last
+        one is cast, or at the deadline with whatever votes are in.
+        
+        Args:
+            room_code (str): The room code
+            duration (float, optional): Seconds until the deadline, defaults to VOTE_DURATION
+            tie_policy (str, optional): "none", "random" or "revote", defaults to VOTE_TIE_POLICY
+            candidates (list, optional): Restrict the vote to these players, e.g. for a revote
+            
+        Returns:
+            bool: True if the vote opened, False if the game isn't playing or a vote is open
+        """
+        tie_policy = tie_policy or VOTE_TIE_POLICY
+        if tie_policy not in VOTE_TIE_POLICIES:
+            raise ValueError(f"Unknown tie policy {tie_policy!r}, expected one of {', '.join(VOTE_TIE_POLICIES)}")
+        duration = VOTE_DURATION if duration is None else duration
+        
+        with self._lock:
+            room = self.game_rooms.get(room_code)
+            if not room or room["status"] != "playing" or room["vote"] is not None:
+                return False
+            
+            alive = [p for p in room["players"] if p not in room["eliminated_players"]]
+            if candidates is not None:
+                candidates = [p for p in alive if p in candidates]
+                if len(candidates) < 2:
+                    return False
+            
+            # Opening the vote ends the discussion early
+            room["discussion_deadline"] = None
+            self._cancel_timer(room_code, "discussion")
+            self._open_vote(room_code, room, alive, candidates or alive, duration, tie_policy, revote=False)
+            self._mark_updated(room_code, room, "vote_open", VOTE_FIELDS)
+            self._notify_callbacks(room_code, "vote_open")
+            return True
+    
+    def _open_vote(self, room_code, room, voters, candidates, duration, tie_policy, revote):
+        """
+        Put a new ballot in a room and arm its deadline. Must be called with the lock held.
+        """
+        room["vote"] = {
+            "id": uuid.uuid4().hex,
+            "round": room["current_round"],
+            "voters": list(voters),
+            "candidates": list(candidates),
+            "ballots": {},  # voter -> candidate
+            "tallies": dict.fromkeys(candidates, 0),
+            "remaining": len(voters),  # Votes still to come; the vote closes at 0
+            "duration": duration,
+            "deadline": time.time() + duration,
+            "tie_policy": tie_policy,
+            "revote": revote,
+        }
+        room["vote_result"] = None
+        self._arm_vote_timer(room_code, room["vote"])
+    
+    def _arm_vote_timer(self, room_code, vote):
+        """
+        Close a vote at its deadline. Must be called with the lock held.
+        
+        Args:
+            room_code (str): The room code
+            vote (dict): The open ballot
+        """
+        self._set_timer(room_code, "vote", vote["deadline"], self.close_voting, room_code, vote["id"])
+    
+    @_instrumented
+    @_refused_after_handoff(HANDED_OFF_ERROR)
+    def cast_vote(self, room_code, voter, candidate):
+        """
+        Cast a player's vote. Votes are final. The tallies and the count of votes still
+        to come are updated under the room lock, so when every player votes at once
+        each vote is counted exactly once and the last one closes the vote.
+        
+        Args:
+            room_code (str): The room code
+            voter (str): The voting player
+            candidate (str): The player they vote for
+            
+        Returns:
+            dict: "remaining" votes, plus "result" (see close_voting) if this vote
+                  closed the round, or an error
+        """
+        with self._lock:
+            room = self.game_rooms.get(room_code)
+            vote = room["vote"] if room else None
+            if vote is None:
+                return {"error": "No vote is open"}
+            if voter not in vote["voters"]:
+                return {"error": "You can't vote in this round"}
+            if voter in vote["ballots"]:
+                return {"error": "You have already voted"}
+            if candidate not in vote["tallies"] or candidate == voter:
+                return {"error": "You can't vote for that player"}
+            
+            # The ballot is replaced rather than changed in place, so the copies already
+            # handed to the event log and the published summary stay as they were
+            tallies = dict(vote["tallies"])
+            tallies[candidate] += 1
+            vote = dict(vote, ballots=dict(vote["ballots"], **{voter: candidate}), tallies=tallies,
+                        remaining=vote["remaining"] - 1)
+            room["vote"] = vote
+            
+            if vote["remaining"] == 0:
+                return {"remaining": 0, "result": self._close_vote(room_code, room)}
+            
+            self._mark_updated(room_code, room, "vote", ("vote",))
+            self._notify_callbacks(room_code, "vote")
+            return {"remaining": vote["remaining"]}
+    
+    @_instrumented
+    @_refused_after_handoff(HANDED_OFF_ERROR)
+    def close_voting(self, room_code, vote_id=None):
+        """
+        Close the open vote with the votes cast so far and apply its outcome. Called
+        by the deadline timer, or by the admin to end the vote early.
+        
+        Args:
+            room_code (str): The room code
+            vote_id (str, optional): Only close this vote; a timer for a vote that has
+                                     already closed does nothing
+            
+        Returns:
+            dict: The vote result (see _close_vote), or an error
+        """
+        with self._lock:
+            room = self.game_rooms.get(room_code)
+            vote = room["vote"] if room else None
+            if vote is None or (vote_id is not None and vote["id"] != vote_id):
+                return {"error": "No vote is open"}
+            return self._close_vote(room_code, room)
+    
+    def _close_vote(self, room_code, room):
+        """
+        Count an open vote and apply the outcome. The player with the most votes is
+        accused as if by the admin; a tie is settled by the vote's tie policy, and a
+        vote that eliminates nobody still moves the game to the next round. Must be
+        called with the lock held.
+        
+        Args:
+            room_code (str): The room code
+            room (dict): The room data
+            
+        Returns:
+            dict: "round", "tallies", "ballots", "tied" players, the "accused" player
+                  (None if nobody was voted out) and whether there is a "revote", plus
+                  the accusation or next round fields
+        """
+        vote = room["vote"]
+        self._cancel_timer(room_code, "vote")
+        room["vote"] = None
+        
+        top = max(vote["tallies"].values(), default=0)
+        leaders = [p for p, count in vote["tallies"].items() if count == top] if top else []
+        result = {
+            "round": vote["round"],
+            "tallies": vote["tallies"],
+            "ballots": vote["ballots"],
+            "tied": leaders if len(leaders) > 1 else [],
+            "accused": None,
+            "revote": False,
+        }
+        
+        if len(leaders) > 1 and vote["tie_policy"] == "revote" and not vote["revote"]:
+            # One more vote between the tied players; a second tie eliminates nobody
+            result["revote"] = True
+            self._open_vote(room_code, room, vote["voters"], leaders, vote["duration"], "none", revote=True)
+            room["vote_result"] = result
+            self._mark_updated(room_code, room, "vote_open", VOTE_FIELDS)
+            self._notify_callbacks(room_code, "vote_open")
+            return dict(result)
+        
+        if len(leaders) == 1:
+            accused = leaders[0]
+        elif leaders and vote["tie_policy"] == "random":
+            accused = random.choice(leaders)
+        else:
+            accused = None
+        
+        if accused is not None:
+            accusation, event_type = self._resolve_accusation(room_code, room, accused)
+            result.update(accusation)
+            result["accused"] = accused
+        else:
+            self._expand_room(room_code, room)
+            self._next_round(room, result)
+            event_type = "next_round"
+        
+        room["vote_result"] = result
+        self._mark_updated(room_code, room, event_type, ACCUSATION_FIELDS + VOTE_FIELDS)
+        self._notify_callbacks(room_code, event_type)
+        return dict(result)
+    
+    @_instrumented
+    def get_clue_context(self, room_code):
+        """
+        Get what a clue writer needs to know about a game in progress.
+        
+        Args:
+            room_code (str): The room code
+            
+        Returns:
+            dict: Story data, revealed clues, eliminated characters and the index of
+                  the next clue to reveal, or None if the room is not playing
+        """
+        with self._lock:
+            room = self.game_rooms.get(room_code)
+            if room:
+                self._expand_room(room_code, room)
+            if not room or room["status"] != "playing" or not room["story_data"]:
+                return None
+            
+            story_players = room["story_data"]["players"]
+            eliminated_characters = [
+                story_players[room["player_assignments"][p]]["character_name"]
+                for p in room["eliminated_players"]
+            ]
+            
+            return {
+                "story_data": room["story_data"],
+                "revealed_clues": room["revealed_clues"].copy(),
+                "eliminated_characters": eliminated_characters,
+                "next_clue_index": len(room["revealed_clues"])
+            }
+    
+    @_instrumented
+    @_refused_after_handoff(False)
+    def supply_clue(self, room_code, clue_index, clue_text):
+        """
+        Replace a not-yet-revealed clue with a freshly generated one.
+        
+        Args:
+            room_code (str): The room code
+            clue_index (int): 0-based index of the clue in the story
+            clue_text (str): The new clue
+            
+        Returns:
+            bool: True if the clue was stored, False if it was already revealed
+        """
+        with self._lock:
+            room = self.game_rooms.get(room_code)
+            if room:
+                self._expand_room(room_code, room)
+            if not room or room["status"] != "playing" or not room["story_data"]:
+                return False
+            
+            clues = room["story_data"]["clues"]
+            if clue_index < len(room["revealed_clues"]) or clue_index >= len(clues):
+                return False
+            
+            # Players can't see unrevealed clues, so this doesn't bump the room version
+            clues[clue_index] = clue_text
+            if self._event_log is not None:
+                self._log_event(room_code, "clue", op="clue", index=clue_index, text=clue_text)
+            return True
+    
+    @_instrumented
+    def get_player_info(self, room_code, player_name):
+        """
+        Get information specific to a player.
+        
+        Args:
+            room_code (str): The room code
+            player_name (str): The player's name
+            
+        Returns:
+            dict: Player-specific information or None if player not found
+        """
+        with self._lock:
+            if room_code not in self.game_rooms:
+                return None
+            
+            room = self.game_rooms[room_code]
+            
+            if player_name not in room["players"]:
+                return None
+            
+            player_info = {
+                "name": player_name,
+                "is_admin": player_name == room["admin"],
+                "is_eliminated": player_name in room["eliminated_players"]
+            }
+            
+            # If game is playing or ended, add role information
+            self._expand_room(room_code, room)
+            if room["status"] in ["playing", "ended"] and player_name in room["private_views"]:
+                player_info.update(room["private_views"][player_name])
+            
+            return player_info
+    
+    @_instrumented
+    def get_private_view(self, room_code, player_name):
+        """
+        Get a player's read-only character information for a started game.
+        
+        Args:
+            room_code (str): The room code
+            player_name (str): The player's name
+            
+        Returns:
+            Mapping: character_name, character_description and is_mafia, or None
+        """
+        with self._lock:
+            room = self.game_rooms.get(room_code)
+            if not room or room["status"] not in ["playing", "ended"]:
+                return None
+            
+            self._expand_room(room_code, room)
+            return room["private_views"].get(player_name)
+    
+    @_instrumented
+    def get_mafia_players(self, room_code):
+        """
+        Get the players whose character is the Mafia.
+        
+        Args:
+            room_code (str): The room code
+            
+        Returns:
+            frozenset: Mafia player names, or None if the game hasn't started
+        """
+        with self._lock:
+            room = self.game_rooms.get(room_code)
+            if not room or not room["role_index"] or room["status"] not in ["playing", "ended"]:
+                return None
+            
+            return room["role_index"]["mafia_players"]
+    
+    def _build_summary(self, room):
+        """
+        Build the immutable public snapshot of a room. Must be called with the lock held.
+        
+        Args:
+            room (dict): The room data
+            
+        Returns:
+            FrozenDict: The room summary
+        """
+        # Create a sanitized copy with only the information all players should see
+        summary = {
+            "status": room["status"],
+            "players": tuple(room["players"]),
+            "admin": room["admin"],
+            "current_round": room["current_round"],
+            "eliminated_players": tuple(room["eliminated_players"]),
+            "last_update": room["last_update"],
+            "version": room["version"],
+            "current_suspect": room["current_suspect"],
+            "spectator_count": len(room["spectators"]),
+            "online_players": tuple(filter(room["online"].__contains__, room["players"]))
+        }
+        
+        # Let everyone in the room follow story generation
+        if room["status"] == "setup":
+            summary["setup_progress"] = room["setup_progress"]
+            summary["setup_started"] = room["setup_started"]
+        elif room["status"] == "lobby" and room["setup_error"]:
+            summary["setup_error"] = room["setup_error"]
+        
+        # Add game-specific information if game is in progress
+        if room["status"] in ["playing", "ended"] and room["story_data"]:
+            summary["main_story"] = room["story_data"]["main_story"]
+            summary["killed_character_name"] = room["story_data"]["killed_character_name"]
+            summary["revealed_clues"] = tuple(room["revealed_clues"])
+        
+        if room["status"] == "playing" and room["discussion_deadline"] is not None:
+            summary["discussion_deadline"] = room["discussion_deadline"]
+        
+        # Everyone sees the running tallies and who has voted, but not whom they
+        # voted for until the vote closes
+        vote = room["vote"]
+        if vote is not None:
+            summary["vote"] = FrozenDict({
+                "id": vote["id"],
+                "round": vote["round"],
+                "voters": tuple(vote["voters"]),
+                "candidates": tuple(vote["candidates"]),
+                "voted": tuple(vote["ballots"]),
+                "tallies": FrozenDict(vote["tallies"]),
+                "remaining": vote["remaining"],
+                "deadline": vote["deadline"],
+                "revote": vote["revote"],
+            })
+        if room["vote_result"] is not None:
+            result = room["vote_result"]
+            summary["vote_result"] = FrozenDict(result, tallies=FrozenDict(result["tallies"]),
+                                                ballots=FrozenDict(result["ballots"]), tied=tuple(result["tied"]))
+        
+        # Add game result if game is ended
+        if room["status"] == "ended":
+            summary["game_result"] = room["game_result"]
+        
+        # The story fields are left out while the story is compressed; expand_room
+        # restores them
+        if room["compacted"] is not None:
+            summary["compacted"] = True
+        
+        return FrozenDict(summary)
     
-    def register_callback(self, callback_id, callback_fn):
+    def get_room_summary(self, room_code):
         """
-        Register a callback function that will be called when game state changes.
-        Useful for external integrations like websockets or other real-time notification systems.
+        Get a summary of the room state suitable for sharing with clients.
+        
+        The summary is a read-only snapshot published on the room's last change, so
+        this is a single dict lookup with no locking or copying. Lists in the summary
+        are tuples. Not instrumented: timing it would cost more than the read.
         
         Args:
-            callback_id (str): Unique ID for the callback
-            callback_fn (function): Function to call with (room_code, event_type) parameters
+            room_code (str): The room code
+            
+        Returns:
+            FrozenDict: Room summary or None if room not found
         """
-        self.callbacks[callback_id] = callback_fn
+        return self._snapshots.get(room_code)
     
-    def unregister_callback(self, callback_id):
+    @_instrumented
+    @_refused_after_handoff(False)
+    def join_as_spectator(self, room_code, spectator_name):
         """
-        Unregister a previously registered callback.
+        Watch a room without playing, at any stage of the game. Spectators are never
+        assigned a role and can't be suspected. Spectators coming and going doesn't
+        change the room's version, so it doesn't rerun the players' pages; the new
+        spectator count is published with the current version.
         
         Args:
-            callback_id (str): ID of the callback to remove
+            room_code (str): The room code
+            spectator_name (str): The spectator's name
+            
+        Returns:
+            bool: True if watching, False if the room doesn't exist or a player has the name
         """
-        if callback_id in self.callbacks:
-            del self.callbacks[callback_id]
+        with self._lock:
+            room = self.game_rooms.get(room_code)
+            if room is None or spectator_name in room["players"]:
+                return False
+            
+            if spectator_name not in room["spectators"]:
+                room["spectators"].append(spectator_name)
+                self._snapshots[room_code] = self._build_summary(room)
+            return True
     
-    def _notify_callbacks(self, room_code, event_type):
+    @_instrumented
+    def remove_spectator(self, room_code, spectator_name):
         """
-        Notify all registered callbacks about a game state change.
+        Stop watching a room.
         
         Args:
-            room_code (str): The room code where the event occurred
-            event_type (str): Type of event (e.g., 'join', 'leave', 'suspect', 'accuse', etc.)
+            room_code (str): The room code
+            spectator_name (str): The spectator's name
+            
+        Returns:
+            bool: True if the spectator was watching the room
         """
-        for callback_fn in self.callbacks.values():
-            try:
-                callback_fn(room_code, event_type)
-            except Exception as e:
-                print(f"Error in callback: {e}")
+        with self._lock:
+            room = self.game_rooms.get(room_code)
+            if room is None or spectator_name not in room["spectators"]:
+                return False
+            
+            room["spectators"].remove(spectator_name)
+            room["online"].discard(spectator_name)
+            self._presence.pop((room_code, spectator_name), None)
+            if not room["online"]:
+                self._arm_empty_expiry(room_code)
+            self._snapshots[room_code] = self._build_summary(room)
+            return True
     
-    def get_all_room_codes(self):
+    def get_public_view(self, room_code):
         """
-        Get list of all active room codes.
+        Get the read-only view of a room shown to spectators, with its markdown
+        rendered. The view is rendered once per room version and shared by every
+        spectator, so any number of watchers cost one render per change. Spectators
+        coming and going and compaction keep the version, so they keep the render; a
+        new spectator count is patched into the cached view. It shows what every
+        player can see, plus the killer once the game is over.
         
+        Args:
+            room_code (str): The room code
+            
         Returns:
-            list: All active room codes
+            FrozenDict: The room summary fields plus "room_code", "killer" and
+                        "markdown", or None if room not found
         """
-        return list(self.game_rooms.keys())
+        summary = self._snapshots.get(room_code)
+        if summary is None:
+            return None
+        cached = self._public_views.get(room_code)
+        if cached is None or cached["version"] < summary["version"]:
+            with self._public_view_lock:
+                # Another spectator may have rendered it while this one waited
+                cached = self._public_views.get(room_code)
+                if cached is None or cached["version"] < summary["version"]:
+                    cached = self._render_public_view(room_code)
+                    if cached is None:
+                        return None
+                    self._public_views[room_code] = cached
+        
+        # Spectators come and go without a new version; only their count changes
+        summary = self._snapshots.get(room_code)
+        if (summary is not None and cached["version"] == summary["version"]
+                and cached["spectator_count"] != summary["spectator_count"]):
+            cached = FrozenDict(cached, spectator_count=summary["spectator_count"])
+            self._public_views[room_code] = cached
+        return cached
     
-    def generate_room_code(self):
+    def _render_public_view(self, room_code):
         """
-        Generate a unique 6-character alphanumeric room code.
+        Build and render the public view of a room at its current version. The story
+        is read without expanding the room, so showing it doesn't undo compaction; a
+        compacted story is decompressed outside the lock into a private copy.
         
+        Args:
+            room_code (str): The room code
+            
         Returns:
-            str: A unique room code
+            FrozenDict: The public view, or None if room not found
         """
-        # Generate a random 6-character code
-        code = ''.join(random.choices('ABCDEFGHJKLMNPQRSTUVWXYZ23456789', k=6))
+        with self._lock:
+            room = self.game_rooms.get(room_code)
+            if room is None:
+                return None
+            summary = self._snapshots[room_code]
+            story_data, revealed_clues = room["story_data"], tuple(room["revealed_clues"])
+            compressed, role_index = room["compacted"], room["role_index"]
         
-        # Ensure the code is unique
-        while code in self.game_rooms:
-            code = ''.join(random.choices('ABCDEFGHJKLMNPQRSTUVWXYZ23456789', k=6))
+        if compressed is not None:
+            payload = json.loads(zlib.decompress(compressed).decode("utf-8"))
+            story_data, revealed_clues = payload["story_data"], tuple(payload["revealed_clues"])
         
-        return code
+        view = dict(summary, room_code=room_code, killer=None)
+        view.pop("compacted", None)
+        if summary["status"] in ["playing", "ended"] and story_data:
+            view["main_story"] = story_data["main_story"]
+            view["killed_character_name"] = story_data["killed_character_name"]
+            view["revealed_clues"] = revealed_clues
+            
+            if summary["status"] == "ended" and summary["game_result"] == "civilians_win" and role_index:
+                killer = next(iter(role_index["mafia_players"]), None)
+                if killer is not None:
+                    character = story_data["players"][role_index["player_to_character"][killer]]
+                    view["killer"] = {"player": killer, "character_name": character["character_name"]}
+        view["markdown"] = storyteller.format_public_view(view)
+        return FrozenDict(view)
     
-    def create_game_room(self, admin_name):
+    @_instrumented
+    @_refused_after_handoff(HANDED_OFF_ERROR)
+    def post_message(self, room_code, player_name, text):
         """
-        Create a new game room with the given admin.
+        Post a chat message to everyone in the room. Chat doesn't change the room's
+        version, so it never reruns the players' pages; readers fetch new messages
+        with get_messages or wait_for_messages.
         
         Args:
-            admin_name (str): The name of the admin player
+            room_code (str): The room code
+            player_name (str): The player posting; spectators can read but not post,
+                               and eliminated players can't post while the game is on
+            text (str): The message, cut to CHAT_MAX_LENGTH characters
             
         Returns:
-            tuple: (room_code, room_data)
+            dict: The posted message ("seq", "player", "text", "time"), or an error
         """
-        room_code = self.generate_room_code()
-        
-        room_data = {
-            "admin": admin_name,
-            "players": [admin_name],
-            "status": "lobby",  # lobby, setup, playing, ended
-            "story_data": None,
-            "player_assignments": {},  # Maps player names to character indices
-            "current_round": 0,
-            "revealed_clues": [],
-            "current_suspect": None,  # Player currently suspected by admin
-            "eliminated_players": [],
-            "game_result": None,  # "civilians_win", "mafia_wins", or None if game is ongoing
-            "last_update": time.time()  # Timestamp of last update for synchronization
-        }
+        text = (text or "").strip()[:CHAT_MAX_LENGTH]
+        if not text:
+            return {"error": "Message is empty"}
         
-        self.game_rooms[room_code] = room_data
-        self._notify_callbacks(room_code, "create")
-        return room_code, room_data
+        with self._lock:
+            room = self.game_rooms.get(room_code)
+            if room is None or player_name not in room["players"]:
+                return {"error": "Only players in the room can chat"}
+            if room["status"] == "playing" and player_name in room["eliminated_players"]:
+                return {"error": "Eliminated players can't chat"}
+            
+            # Token bucket: CHAT_BURST messages at once, refilled at CHAT_RATE per second
+            now = time.monotonic()
+            bucket = room["chat_buckets"].setdefault(player_name, [CHAT_BURST, now])
+            bucket[0] = min(CHAT_BURST, bucket[0] + (now - bucket[1]) * CHAT_RATE)
+            bucket[1] = now
+            if bucket[0] < 1:
+                return {"error": "You're sending messages too quickly", "retry_after": (1 - bucket[0]) / CHAT_RATE}
+            bucket[0] -= 1
+            
+            room["chat_seq"] += 1
+            message = FrozenDict(seq=room["chat_seq"], player=player_name, text=text, time=time.time())
+            room["chat"].append(message)
+            
+            condition = self._chat_conditions.get(room_code)
+            if condition is not None:
+                condition.notify_all()
+            self._notify_callbacks(room_code, "chat")
+            return dict(message)
     
-    def join_game_room(self, room_code, player_name):
+    def get_messages(self, room_code, after_seq=0):
         """
-        Add a player to an existing game room.
+        Get the chat messages posted after the given sequence number, so a client only
+        ever fetches what it hasn't seen. Costs O(new messages).
         
         Args:
-            room_code (str): The room code to join
-            player_name (str): The name of the joining player
+            room_code (str): The room code
+            after_seq (int): The last sequence number the caller has seen (0 for none)
             
         Returns:
-            bool: True if successful, False otherwise
+            dict: "messages" (tuple of messages, oldest first), "last_seq", and
+                  "truncated" if older unseen messages have dropped out of the room's
+                  history, or None if room not found
         """
-        if room_code not in self.game_rooms:
-            return False
-        
-        room = self.game_rooms[room_code]
-        
-        # Check if player already exists in the room
-        if player_name in room["players"]:
-            return True  # Allow rejoining if already in the room
-        
-        # Only allow new players to join in lobby phase
-        if room["status"] != "lobby":
-            return False
-        
-        room["players"].append(player_name)
-        room["last_update"] = time.time()  # Use timestamp instead of UUID for better compatibility
-        self._notify_callbacks(room_code, "join")
-        return True
+        with self._lock:
+            room = self.game_rooms.get(room_code)
+            if room is None:
+                return None
+            
+            chat = room["chat"]
+            messages = []
+            # Newest first, stopping at the first message the caller has seen
+            for message in reversed(chat):
+                if message["seq"] <= after_seq:
+                    break
+                messages.append(message)
+            messages.reverse()
+            
+            first_seq = room["chat_seq"] - len(chat) + 1
+            return {"messages": tuple(messages), "last_seq": room["chat_seq"],
+                    "truncated": after_seq < first_seq - 1}
     
-    def start_game(self, room_code, story_data):
+    def wait_for_messages(self, room_code, after_seq, timeout=30.0):
         """
-        Start a game with the given story data.
+        Block until a chat message newer than after_seq is posted, or until timeout.
         
         Args:
             room_code (str): The room code
-            story_data (dict): The story data from the LLM
+            after_seq (int): The last sequence number the caller has seen
+            timeout (float): Maximum number of seconds to wait
             
         Returns:
-            bool: True if successful, False otherwise
+            dict: See get_messages ("messages" is empty on timeout), or None if the
+                  room does not exist or was removed while waiting
         """
-        if room_code not in self.game_rooms:
-            return False
-        
-        room = self.game_rooms[room_code]
-        
-        if room["status"] != "lobby":
-            return False
-        
-        if len(room["players"]) < 3:  # Minimum 3 players required
-            return False
+        deadline = time.monotonic() + max(0.0, timeout)
         
-        # Assign characters to players (only Mafia or Civilian)
-        players = room["players"].copy()
-        random.shuffle(players)
-        
-        # Create player assignments
-        player_assignments = {}
-        for i, player in enumerate(players):
-            player_assignments[player] = i % len(story_data["players"])
-        
-        # Randomly select one player to be Mafia
-        mafia_player = random.choice(list(player_assignments.keys()))
-        
-        # Update player roles in story data
-        for i in range(len(story_data["players"])):
-            story_data["players"][i]["is_mafia"] = False
-            story_data["players"][i]["is_killed"] = False  # No killed player role
-        
-        # Find which character index to make Mafia
-        mafia_character_idx = player_assignments[mafia_player]
-        story_data["players"][mafia_character_idx]["is_mafia"] = True
-        
-        room["status"] = "playing"
-        room["story_data"] = story_data
-        room["player_assignments"] = player_assignments
-        room["current_round"] = 1
-        room["revealed_clues"] = [story_data["clues"][0]]  # Reveal first clue
-        room["current_suspect"] = None
-        room["last_update"] = time.time()
-        
-        self._notify_callbacks(room_code, "start")
-        return True
+        with self._lock:
+            room = self.game_rooms.get(room_code)
+            if room is None:
+                return None
+            
+            condition = self._chat_conditions.get(room_code)
+            if condition is None:
+                condition = self._chat_conditions[room_code] = threading.Condition(self._lock)
+            while room["chat_seq"] <= after_seq:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                condition.wait(remaining)
+                
+                room = self.game_rooms.get(room_code)
+                if room is None:
+                    return None
+            
+            return self.get_messages(room_code, after_seq)
     
-    def set_admin_suspect(self, room_code, suspect_name):
+    @_instrumented
+    @_refused_after_handoff(False)
+    def reset_game(self, room_code):
         """
-        Set the admin's current suspect.
+        Reset a game room to lobby state but keep players.
         
         Args:
             room_code (str): The room code
-            suspect_name (str): The name of the suspected player
             
         Returns:
             bool: True if successful, False otherwise
         """
-        if room_code not in self.game_rooms:
-            return False
-        
-        room = self.game_rooms[room_code]
-        
-        if room["status"] != "playing":
-            return False
-        
-        if suspect_name not in room["players"]:
-            return False
-        
-        room["current_suspect"] = suspect_name
-        room["last_update"] = time.time()
-        
-        self._notify_callbacks(room_code, "suspect")
-        return True
+        with self._lock:
+            if room_code not in self.game_rooms:
+                return False
+            
+            room = self.game_rooms[room_code]
+            
+            # Only allow resetting if game has ended
+            if room["status"] != "ended":
+                return False
+            
+            # Keep players and spectators but reset game state
+            players = room["players"].copy()
+            spectators = room["spectators"].copy()
+            online = room["online"]
+            chat = (room["chat"], room["chat_seq"], room["chat_buckets"])
+            admin = room["admin"]
+            
+            # Create a fresh room with same players
+            room.clear()
+            room.update({
+                "admin": admin,
+                "players": players,
+                "spectators": spectators,
+                "online": online,
+                "chat": chat[0],
+                "chat_seq": chat[1],
+                "chat_buckets": chat[2],
+                "status": "lobby",
+                "story_data": None,
+                "player_assignments": {},
+                "role_index": None,
+                "private_views": {},
+                "current_round": 0,
+                "revealed_clues": [],
+                "current_suspect": None,
+                "eliminated_players": [],
+                "game_result": None,
+                "setup_job": None,
+                "setup_progress": None,
+                "setup_started": None,
+                "setup_error": None,
+                "discussion_deadline": None,
+                "vote": None,
+                "vote_result": None,
+                "compacted": None,
+                "expanded_at": None,
+                "last_update": time.time(),
+                "version": 0
+            })
+            self._mark_updated(room_code, room, "reset")
+            
+            self._notify_callbacks(room_code, "reset")
+            return True
     
-    def process_admin_accusation(self, room_code):
+    @_instrumented
+    def cleanup_stale_rooms(self, max_age_hours=24):
         """
-        Process the admin's accusation against the current suspect.
+        Remove rooms that haven't been updated in the specified time and have nobody
+        online.
         
         Args:
-            room_code (str): The room code
+            max_age_hours (int): Maximum age in hours before a room is considered stale
             
         Returns:
-            dict: Results of the accusation
+            int: Number of rooms removed
         """
-        room = self.game_rooms.get(room_code)
-        if not room or room["status"] != "playing":
-            return {"error": "Invalid game state"}
+        max_age_seconds = max_age_hours * 3600
+        current_time = time.time()
+        stale_rooms = []
         
-        suspect = room["current_suspect"]
-        if not suspect:
-            return {"error": "No suspect selected"}
+        with self._lock:
+            for room_code, room in self.game_rooms.items():
+                if current_time - room["last_update"] > max_age_seconds and not room["online"]:
+                    stale_rooms.append(room_code)
+            
+            for room_code in stale_rooms:
+                self._remove_room(room_code, "cleanup")
         
-        # Get character info for suspected player
-        player_idx = room["player_assignments"][suspect]
-        character_info = room["story_data"]["players"][player_idx]
-        is_mafia = character_info["is_mafia"]
+        return len(stale_rooms)
+    
+    def _compact_room(self, room_code, room):
+        """
+        Compress a started room's story and drop what can be rebuilt from it. The
+        summary is republished without the story fields (flagged "compacted") under
+        the same version, since nothing about the game changed. Must be called with
+        the lock held.
         
-        result = {
-            "suspected_player": suspect,
-            "character_name": character_info["character_name"],
-            "is_mafia": is_mafia
-        }
+        Args:
+            room_code (str): The room code
+            room (dict): The room data
+        """
+        payload = {"story_data": room["story_data"], "revealed_clues": room["revealed_clues"]}
+        room["compacted"] = zlib.compress(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+        room["story_data"] = None
+        room["revealed_clues"] = []
+        room["private_views"] = {}  # Rebuilt from the story by _build_role_index
+        self._snapshots[room_code] = self._build_summary(room)
+    
+    def _expand_room(self, room_code, room):
+        """
+        Restore a compacted room's story in place. A no-op for rooms that aren't
+        compacted. Must be called with the lock held.
         
-        # Check if accusation was correct (suspect is Mafia)
-        if is_mafia:
-            room["status"] = "ended"
-            room["game_result"] = "civilians_win"
-            result["game_over"] = True
-            result["winner"] = "civilians"
-            self._notify_callbacks(room_code, "game_over")
-        else:
-            # Eliminate the wrongly accused player
-            room["eliminated_players"].append(suspect)
-            
-            # Count remaining players
-            active_players = [p for p in room["players"] if p not in room["eliminated_players"]]
-            
-            # Get number of mafia players remaining
-            mafia_count = 0
-            civilian_count = 0
-            for player in active_players:
-                player_idx = room["player_assignments"][player]
-                if room["story_data"]["players"][player_idx]["is_mafia"]:
-                    mafia_count += 1
-                else:
-                    civilian_count += 1
-            
-            # Check if Mafia wins (only 1 civilian left)
-            if mafia_count == 1 and civilian_count == 1:
-                room["status"] = "ended"
-                room["game_result"] = "mafia_wins"
-                result["game_over"] = True
-                result["winner"] = "mafia"
-                self._notify_callbacks(room_code, "game_over")
-            else:
-                # Continue to next round
-                room["current_round"] += 1
-                
-                # Reveal next clue if available
-                if room["current_round"] <= len(room["story_data"]["clues"]):
-                    next_clue = room["story_data"]["clues"][room["current_round"] - 1]
-                    room["revealed_clues"].append(next_clue)
-                
-                # Reset current suspect
-                room["current_suspect"] = None
-                
-                result["game_over"] = False
-                result["next_round"] = room["current_round"]
-                
-                if len(room["revealed_clues"]) >= len(room["story_data"]["clues"]):
-                    result["new_clue"] = None
-                else:
-                    result["new_clue"] = room["revealed_clues"][-1]
-                
-                self._notify_callbacks(room_code, "next_round")
+        Args:
+            room_code (str): The room code
+            room (dict): The room data
+        """
+        if room["compacted"] is None:
+            return
         
-        room["last_update"] = time.time()
-        return result
+        payload = json.loads(zlib.decompress(room["compacted"]).decode("utf-8"))
+        room["story_data"] = payload["story_data"]
+        room["revealed_clues"] = payload["revealed_clues"]
+        _, room["private_views"] = self._build_role_index(room["player_assignments"], room["story_data"])
+        room["compacted"] = None
+        room["expanded_at"] = time.time()
+        self._snapshots[room_code] = self._build_summary(room)
     
-    def get_player_info(self, room_code, player_name):
+    @_instrumented
+    def expand_room(self, room_code):
         """
-        Get information specific to a player.
+        Restore a compacted room's story, e.g. before showing it to a returning player.
         
         Args:
             room_code (str): The room code
-            player_name (str): The player's name
             
         Returns:
-            dict: Player-specific information or None if player not found
+            FrozenDict: The room summary with the story fields, or None if room not found
         """
-        if room_code not in self.game_rooms:
-            return None
-        
-        room = self.game_rooms[room_code]
-        
-        if player_name not in room["players"]:
-            return None
-        
-        player_info = {
-            "name": player_name,
-            "is_admin": player_name == room["admin"],
-            "is_eliminated": player_name in room["eliminated_players"]
-        }
-        
-        # If game is playing or ended, add role information
-        if room["status"] in ["playing", "ended"] and room["story_data"]:
-            character_idx = room["player_assignments"].get(player_name, 0)
-            character_info = room["story_data"]["players"][character_idx]
-            
-            player_info["character_name"] = character_info["character_name"]
-            player_info["character_description"] = character_info["character_description"]
-            player_info["is_mafia"] = character_info["is_mafia"]
-        
-        return player_info
+        with self._lock:
+            room = self.game_rooms.get(room_code)
+            if room is None:
+                return None
+            self._expand_room(room_code, room)
+            return self._snapshots[room_code]
     
-    def get_room_summary(self, room_code):
+    @_instrumented
+    def compact_rooms(self, ended_after=ROOM_COMPACT_ENDED_AFTER, idle_after=ROOM_COMPACT_IDLE_AFTER):
         """
-        Get a summary of the room state suitable for sharing with clients.
+        Compress the story payloads of ended rooms and of games nobody has touched for
+        a while, so memory tracks the games in progress. A compacted room is expanded
+        again by any call that needs its story.
         
         Args:
-            room_code (str): The room code
+            ended_after (float): Seconds since the last change before an ended room is
+                                 compacted, or None to leave ended rooms alone
+            idle_after (float): Seconds since the last change before a game in progress
+                                is compacted, or None to leave them alone
             
         Returns:
-            dict: Room summary or None if room not found
+            int: Number of rooms compacted
         """
-        if room_code not in self.game_rooms:
-            return None
-        
-        room = self.game_rooms[room_code]
-        
-        # Create a sanitized copy with only the information all players should see
-        summary = {
-            "status": room["status"],
-            "players": room["players"].copy(),
-            "admin": room["admin"],
-            "current_round": room["current_round"],
-            "eliminated_players": room["eliminated_players"].copy(),
-            "last_update": room["last_update"],
-            "current_suspect": room["current_suspect"]
-        }
-        
-        # Add game-specific information if game is in progress
-        if room["status"] in ["playing", "ended"] and room["story_data"]:
-            summary["main_story"] = room["story_data"]["main_story"]
-            summary["killed_character_name"] = room["story_data"]["killed_character_name"]
-            summary["revealed_clues"] = room["revealed_clues"].copy()
+        compacted = 0
+        current_time = time.time()
         
-        # Add game result if game is ended
-        if room["status"] == "ended":
-            summary["game_result"] = room["game_result"]
+        # Lock per room so a sweep over many rooms doesn't stall the game
+        for room_code in self.get_all_room_codes():
+            with self._lock:
+                room = self.game_rooms.get(room_code)
+                if room is None or room["compacted"] is not None or not room["story_data"]:
+                    continue
+                
+                threshold = ended_after if room["status"] == "ended" else idle_after
+                if room["status"] not in ["playing", "ended"] or threshold is None:
+                    continue
+                
+                last_used = max(room["last_update"], room["expanded_at"] or 0)
+                if current_time - last_used >= threshold:
+                    self._compact_room(room_code, room)
+                    compacted += 1
         
-        return summary
+        return compacted
     
-    def reset_game(self, room_code):
+    def _estimate_size(self, obj, seen):
         """
-        Reset a game room to lobby state but keep players.
+        Estimate the memory held by an object and everything it contains, counting
+        each object once across calls sharing the same seen set.
+        """
+        size = 0
+        stack = [obj]
+        while stack:
+            obj = stack.pop()
+            if id(obj) in seen:
+                continue
+            seen.add(id(obj))
+            size += sys.getsizeof(obj)
+            
+            if isinstance(obj, (dict, MappingProxyType)):
+                for key, value in obj.items():
+                    stack.append(key)
+                    stack.append(value)
+            elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+                stack.extend(obj)
+        return size
+    
+    def get_room_memory(self, room_code):
+        """
+        Estimate the memory used by one room: its state, private views, compressed
+        story and published summary.
         
         Args:
             room_code (str): The room code
             
         Returns:
-            bool: True if successful, False otherwise
+            dict: status, bytes, compacted and compressed_bytes, or None if room not found
         """
-        if room_code not in self.game_rooms:
-            return False
-        
-        room = self.game_rooms[room_code]
-        
-        # Only allow resetting if game has ended
-        if room["status"] != "ended":
-            return False
-        
-        # Keep players but reset game state
-        players = room["players"].copy()
-        admin = room["admin"]
-        
-        # Create a fresh room with same players
-        room.clear()
-        room.update({
-            "admin": admin,
-            "players": players,
-            "status": "lobby",
-            "story_data": None,
-            "player_assignments": {},
-            "current_round": 0,
-            "revealed_clues": [],
-            "current_suspect": None,
-            "eliminated_players": [],
-            "game_result": None,
-            "last_update": time.time()
-        })
-        
-        self._notify_callbacks(room_code, "reset")
-        return True
+        with self._lock:
+            room = self.game_rooms.get(room_code)
+            if room is None:
+                return None
+            
+            # Strings shared between the room and its summary are counted once
+            seen = set()
+            size = self._estimate_size(room, seen) + self._estimate_size(self._snapshots.get(room_code), seen)
+            return {
+                "status": room["status"],
+                "bytes": size,
+                "compacted": room["compacted"] is not None,
+                "compressed_bytes": len(room["compacted"]) if room["compacted"] is not None else 0
+            }
     
-    def cleanup_stale_rooms(self, max_age_hours=24):
+    def get_memory_usage(self, limit=None):
         """
-        Remove rooms that haven't been updated in the specified time.
+        Estimate the memory used by every room.
         
         Args:
-            max_age_hours (int): Maximum age in hours before a room is considered stale
+            limit (int, optional): Only list this many rooms, largest first
             
         Returns:
-            int: Number of rooms removed
+            dict: Totals overall and by status, the number of compacted rooms, the
+                  per-room estimates and, when tracemalloc is tracing (e.g. with
+                  PYTHONTRACEMALLOC=1), the process-wide traced memory
         """
-        max_age_seconds = max_age_hours * 3600
-        current_time = time.time()
-        stale_rooms = []
+        rooms = {}
+        for room_code in self.get_all_room_codes():
+            usage = self.get_room_memory(room_code)
+            if usage is not None:
+                rooms[room_code] = usage
+        
+        by_status = dict.fromkeys(ROOM_STATUSES, 0)
+        for usage in rooms.values():
+            by_status[usage["status"]] = by_status.get(usage["status"], 0) + usage["bytes"]
         
-        for room_code, room in self.game_rooms.items():
-            if current_time - room["last_update"] > max_age_seconds:
-                stale_rooms.append(room_code)
+        largest = sorted(rooms.items(), key=lambda item: item[1]["bytes"], reverse=True)
+        result = {
+            "total_bytes": sum(by_status.values()),
+            "bytes_by_status": by_status,
+            "room_count": len(rooms),
+            "compacted_rooms": sum(1 for usage in rooms.values() if usage["compacted"]),
+            "rooms": dict(largest[:limit] if limit is not None else largest)
+        }
         
-        for room_code in stale_rooms:
-            del self.game_rooms[room_code]
-            self._notify_callbacks(room_code, "cleanup")
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            result["tracemalloc"] = {"current_bytes": current, "peak_bytes": peak}
         
-        return len(stale_rooms)
+        return result
+    
+    def count_compacted_rooms(self):
+        """
+        Count rooms whose story is currently compressed.
+        
+        Returns:
+            int: Number of compacted rooms
+        """
+        return sum(1 for summary in list(self._snapshots.values()) if summary.get("compacted"))
+
+def _create_instance():
+    if GAME_SHARDS > 1:
+        from .sharding import ShardRouter
+        return ShardRouter(GAME_SHARDS)
+    return GameState()
 
-# Create the singleton instance
-_instance = GameState()
+# Create the singleton instance: a GameState, or a router to GAME_SHARDS worker
+# processes that each own a share of the rooms (see utils/sharding.py)
+_instance = _create_instance()
 
 # Module-level functions that delegate to the singleton
-def create_game_room(admin_name):
-    return _instance.create_game_room(admin_name)
+def create_game_room(admin_name, room_code=None):
+    return _instance.create_game_room(admin_name, room_code)
 
 def join_game_room(room_code, player_name):
     return _instance.join_game_room(room_code, player_name)
 
-def start_game(room_code, story_data):
-    return _instance.start_game(room_code, story_data)
+def begin_setup(room_code, job_id):
+    return _instance.begin_setup(room_code, job_id)
+
+def update_setup_progress(room_code, job_id, message):
+    return _instance.update_setup_progress(room_code, job_id, message)
+
+def cancel_setup(room_code, job_id=None, error=None):
+    return _instance.cancel_setup(room_code, job_id, error)
+
+def start_game(room_code, story_data, job_id=None):
+    return _instance.start_game(room_code, story_data, job_id)
 
 def set_admin_suspect(room_code, suspect_name):
     return _instance.set_admin_suspect(room_code, suspect_name)
@@ -457,12 +2302,60 @@ def set_admin_suspect(room_code, suspect_name):
 def process_admin_accusation(room_code):
     return _instance.process_admin_accusation(room_code)
 
+def start_discussion(room_code, duration=None):
+    return _instance.start_discussion(room_code, duration)
+
+def open_voting(room_code, duration=None, tie_policy=None, candidates=None):
+    return _instance.open_voting(room_code, duration, tie_policy, candidates)
+
+def cast_vote(room_code, voter, candidate):
+    return _instance.cast_vote(room_code, voter, candidate)
+
+def close_voting(room_code, vote_id=None):
+    return _instance.close_voting(room_code, vote_id)
+
+def get_clue_context(room_code):
+    return _instance.get_clue_context(room_code)
+
+def supply_clue(room_code, clue_index, clue_text):
+    return _instance.supply_clue(room_code, clue_index, clue_text)
+
 def get_player_info(room_code, player_name):
     return _instance.get_player_info(room_code, player_name)
 
+def get_private_view(room_code, player_name):
+    return _instance.get_private_view(room_code, player_name)
+
+def get_mafia_players(room_code):
+    return _instance.get_mafia_players(room_code)
+
 def get_room_summary(room_code):
     return _instance.get_room_summary(room_code)
 
+def heartbeat(room_code, name):
+    return _instance.heartbeat(room_code, name)
+
+def join_as_spectator(room_code, spectator_name):
+    return _instance.join_as_spectator(room_code, spectator_name)
+
+def remove_spectator(room_code, spectator_name):
+    return _instance.remove_spectator(room_code, spectator_name)
+
+def get_public_view(room_code):
+    return _instance.get_public_view(room_code)
+
+def post_message(room_code, player_name, text):
+    return _instance.post_message(room_code, player_name, text)
+
+def get_messages(room_code, after_seq=0):
+    return _instance.get_messages(room_code, after_seq)
+
+def wait_for_messages(room_code, after_seq, timeout=30.0):
+    return _instance.wait_for_messages(room_code, after_seq, timeout)
+
+def wait_for_change(room_code, version, timeout=30.0):
+    return _instance.wait_for_change(room_code, version, timeout)
+
 def reset_game(room_code):
     return _instance.reset_game(room_code)
 
@@ -472,8 +2365,94 @@ def register_callback(callback_id, callback_fn):
 def unregister_callback(callback_id):
     return _instance.unregister_callback(callback_id)
 
+def flush_events(timeout=5.0):
+    return _instance.flush_events(timeout)
+
+def flush_event_log(timeout=5.0):
+    return _instance.flush_event_log(timeout)
+
+def drain():
+    return _instance.drain()
+
+def get_drain_state():
+    return _instance.get_drain_state()
+
+def export_rooms(path):
+    return _instance.export_rooms(path)
+
+def import_rooms(path):
+    return _instance.import_rooms(path)
+
+def get_event_log_stats():
+    return _instance.get_event_log_stats()
+
+def get_room_history(room_code):
+    return _instance.get_room_history(room_code)
+
+def get_event_stats():
+    return _instance.get_event_stats()
+
+def get_timer_stats():
+    return _instance.get_timer_stats()
+
 def get_all_room_codes():
     return _instance.get_all_room_codes()
 
 def cleanup_stale_rooms(max_age_hours=24):
-    return _instance.cleanup_stale_rooms(max_age_hours) 
\ No newline at end of file
+    return _instance.cleanup_stale_rooms(max_age_hours) 
+
+def count_rooms_by_status():
+    return _instance.count_rooms_by_status()
+
+def expand_room(room_code):
+    return _instance.expand_room(room_code)
+
+def compact_rooms(ended_after=ROOM_COMPACT_ENDED_AFTER, idle_after=ROOM_COMPACT_IDLE_AFTER):
+    return _instance.compact_rooms(ended_after, idle_after)
+
+def get_room_memory(room_code):
+    return _instance.get_room_memory(room_code)
+
+def get_memory_usage(limit=None):
+    return _instance.get_memory_usage(limit)
+
+def count_compacted_rooms():
+    return _instance.count_compacted_rooms()
+
+_compactor = None
+_compactor_lock = threading.Lock()
+
+def _compactor_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            compacted = compact_rooms()
+            if compacted:
+                print(f"Compacted {compacted} room(s)")
+        except Exception as e:
+            print(f"Error compacting rooms: {str(e)}")
+
+def start_compactor(interval=None):
+    """
+    Start compacting ended and idle rooms in a background thread. Safe to call on
+    every Streamlit rerun; only the first call starts the thread.
+    
+    Args:
+        interval (float, optional): Seconds between sweeps, defaults to ROOM_COMPACT_INTERVAL
+        
+    Returns:
+        bool: True if the compactor is running
+    """
+    global _compactor
+    
+    interval = interval if interval is not None else ROOM_COMPACT_INTERVAL
+    with _compactor_lock:
+        if _compactor is None and interval:
+            _compactor = threading.Thread(target=_compactor_loop, args=(interval,),
+                                          name="room-compactor", daemon=True)
+            _compactor.start()
+        return _compactor is not None
+
+# Computed on each scrape from whichever instance is current
+metrics.gauge("mafia_rooms", "Active rooms by status", ["status"]).set_function(count_rooms_by_status)
+metrics.gauge("mafia_rooms_compacted", "Rooms whose story payload is compressed").set_function(count_compacted_rooms)
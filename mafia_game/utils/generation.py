@@ -0,0 +1,227 @@
+import os
+import time
+import uuid
+import threading
+import traceback
+
+from . import game_state, storyteller, providers, tracing
+from .scheduler import GenerationScheduler, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+
+# Story generation for every room goes through one priority scheduler so a burst of
+# "Start Game" clicks cannot spawn an unbounded number of concurrent API calls, and
+# rooms with players waiting are served before background work.
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "4"))
+GENERATION_TIMEOUT = float(os.getenv("GENERATION_TIMEOUT", "90"))  # Seconds from click to fallback story
+CLUE_TIMEOUT = float(os.getenv("CLUE_TIMEOUT", "60"))  # Seconds to write a lazy clue before keeping the pre-baked one
+
+scheduler = GenerationScheduler(workers=GENERATION_WORKERS)
+_inflight = {}  # room_code -> job_id of the generation running for that room
+_start_spans = {}  # job_id -> root tracing span, from the click until the room is playing
+_inflight_lock = threading.Lock()
+
+
+def request_game_start(room_code):
+    """
+    Start a game asynchronously. The room moves to "setup" right away and the story is
+    generated on the worker pool. Repeated calls for a room that is already being set up
+    return the existing job instead of starting another one.
+
+    Args:
+        room_code (str): The room code
+
+    Returns:
+        str: The ID of the in-flight job, or None if the room cannot be started
+    """
+    with _inflight_lock:
+        if room_code in _inflight:
+            return _inflight[room_code]
+
+        summary = game_state.get_room_summary(room_code)
+        if not summary:
+            return None
+
+        job_id = uuid.uuid4().hex
+        if not game_state.begin_setup(room_code, job_id):
+            return None
+
+        _inflight[room_code] = job_id
+        root_span = tracing.start_span("game.start", room_code=room_code, job_id=job_id,
+                                       players=len(summary["players"]))
+        _start_spans[job_id] = root_span
+
+    deadline = time.monotonic() + GENERATION_TIMEOUT
+    with tracing.use_span(root_span):
+        # Keyed on the job, not the room: _inflight already allows one start per room,
+        # and a start cancelled while running must not absorb the next one
+        scheduler.submit(_start_job_key(room_code, job_id), _run_start_job,
+                         args=(room_code, job_id, len(summary["players"]), deadline),
+                         priority=PRIORITY_INTERACTIVE, deadline=deadline,
+                         on_expired=_run_fallback_start_job)
+    return job_id
+
+
+def _start_job_key(room_code, job_id):
+    return f"start:{room_code}:{job_id}"
+
+
+def _end_start_span(job_id, outcome, error=None):
+    """
+    Close the root span of a game start. Whichever of the worker and a cancellation
+    gets here first records the outcome.
+    """
+    with _inflight_lock:
+        root_span = _start_spans.pop(job_id, None)
+    if root_span is None:
+        return
+
+    root_span.set_attribute("outcome", outcome)
+    root_span.set_status("error" if outcome == "error" else "ok", error)
+    root_span.end()
+
+
+def cancel_game_start(room_code):
+    """
+    Cancel a pending game start and send the room back to the lobby. A story that
+    arrives after cancellation is discarded.
+
+    Args:
+        room_code (str): The room code
+
+    Returns:
+        bool: True if a setup was cancelled, False otherwise
+    """
+    with _inflight_lock:
+        job_id = _inflight.pop(room_code, None)
+
+    if job_id is None:
+        return False
+
+    scheduler.cancel(_start_job_key(room_code, job_id))
+    _end_start_span(job_id, "cancelled")
+    return game_state.cancel_setup(room_code, job_id)
+
+
+def schedule_next_clue(room_code):
+    """
+    Queue background generation of the next unrevealed clue for a lazy-clue game.
+    If it isn't ready when the round advances, the pre-baked clue is revealed instead.
+
+    Args:
+        room_code (str): The room code
+
+    Returns:
+        GenerationJob: The queued job, or None if there is nothing to generate
+    """
+    context = game_state.get_clue_context(room_code)
+    if not context or not context["story_data"].get("lazy_clues"):
+        return None
+
+    clue_index = context["next_clue_index"]
+    if clue_index >= len(context["story_data"]["clues"]):
+        return None
+
+    return scheduler.submit(f"clue:{room_code}:{clue_index}", _run_clue_job,
+                            args=(room_code, clue_index, context),
+                            priority=PRIORITY_BACKGROUND,
+                            deadline=time.monotonic() + CLUE_TIMEOUT)
+
+
+def get_inflight_count():
+    """
+    Get the number of rooms currently waiting for a story.
+
+    Returns:
+        int: Number of in-flight generation jobs
+    """
+    with _inflight_lock:
+        return len(_inflight)
+
+
+def get_scheduler_metrics():
+    """
+    Get queue depth and latency metrics for the generation scheduler, plus request
+    counts and latency for each story provider.
+
+    Returns:
+        dict: Scheduler metrics
+    """
+    metrics = scheduler.get_metrics()
+    metrics["providers"] = providers.get_provider_stats()
+    return metrics
+
+
+def _run_fallback_start_job(room_code, job_id, num_players, deadline):
+    """
+    Expiry handler: the job waited out its budget in the queue, so skip the API.
+    """
+    _run_start_job(room_code, job_id, num_players, deadline, use_fallback=True)
+
+
+def _run_start_job(room_code, job_id, num_players, deadline, use_fallback=False):
+    """
+    Worker body: generate the story and hand it to the room if the job still owns it.
+    """
+    outcome, error = "cancelled", None
+    try:
+        remaining = deadline - time.monotonic()
+        if not game_state.update_setup_progress(room_code, job_id, "Writing the story..."):
+            return  # Cancelled while queued
+
+        if use_fallback or remaining <= 0:
+            with storyteller.story_generation_seconds.time(kind="story", outcome="fallback"), \
+                    tracing.span("story.generate", players=num_players, outcome="fallback", expired=True):
+                story_data = storyteller.generate_fallback_story(num_players)
+        else:
+            story_data = storyteller.generate_game_story(num_players, timeout=remaining)
+
+        if not game_state.update_setup_progress(room_code, job_id, "Assigning roles..."):
+            return  # Cancelled while generating
+
+        with tracing.span("game_state.start_game", room_code=room_code):
+            started = game_state.start_game(room_code, story_data, job_id=job_id)
+        if started:
+            outcome = "playing"
+        else:
+            outcome, error = "error", "Failed to start the game."
+            game_state.cancel_setup(room_code, job_id, error=error)
+    except Exception as e:
+        print(f"Error generating story for room {room_code}: {str(e)}")
+        print(traceback.format_exc())
+        outcome, error = "error", str(e)
+        game_state.cancel_setup(room_code, job_id, error=f"Error starting game: {str(e)}")
+    finally:
+        _end_start_span(job_id, outcome, error)
+        with _inflight_lock:
+            if _inflight.get(room_code) == job_id:
+                del _inflight[room_code]
+
+
+def _run_clue_job(room_code, clue_index, context):
+    """
+    Worker body: write clue N+1 from the game so far and store it if still unrevealed.
+    """
+    start = time.perf_counter()
+    try:
+        with tracing.span("clue.generate", room_code=room_code, clue_number=clue_index + 1):
+            clue = providers.generate_clue(context["story_data"], clue_index + 1,
+                                           context["revealed_clues"],
+                                           context["eliminated_characters"],
+                                           timeout=CLUE_TIMEOUT)
+    except Exception as e:
+        storyteller.story_generation_seconds.observe(time.perf_counter() - start, kind="clue", outcome="error")
+        print(f"Error generating clue {clue_index + 1} for room {room_code}, keeping pre-baked clue: {str(e)}")
+        return
+    storyteller.story_generation_seconds.observe(time.perf_counter() - start, kind="clue", outcome="api")
+
+    if not game_state.supply_clue(room_code, clue_index, clue):
+        print(f"Clue {clue_index + 1} for room {room_code} arrived after it was revealed")
+
+
+def _on_game_event(room_code, event_type):
+    # Each new round starts work on the clue that the next round will reveal. Games
+    # handed off from another process lost that work with it, so start it again here.
+    if event_type in ("start", "next_round", "handoff"):
+        schedule_next_clue(room_code)
+
+
+game_state.register_callback("lazy_clues", _on_game_event)
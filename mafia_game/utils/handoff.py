@@ -0,0 +1,153 @@
+import os
+import time
+import threading
+from urllib.parse import urlencode
+
+from . import game_state
+
+# Redeploying without losing games:
+#   1. Start the new process next to the old one, both with the same MAFIA_HANDOFF_FILE.
+#      Handoff is off unless it is set, so an unrelated process never loads the rooms.
+#   2. Drain the old one: POST /drain?handoff=true on its room API, or create
+#      MAFIA_DRAIN_FILE. It stops creating rooms, writes every room to the handoff
+#      file and stops accepting changes.
+#   3. The new process loads the file (it checks every second) and players continue
+#      there: the old process points them at MAFIA_REDIRECT_URL with their room code
+#      and name, which restore_session_from_query_params picks up.
+MAFIA_HANDOFF_FILE = os.getenv("MAFIA_HANDOFF_FILE", "")
+MAFIA_DRAIN_FILE = os.getenv("MAFIA_DRAIN_FILE", "")  # Create this file to drain and hand off
+MAFIA_REDIRECT_URL = os.getenv("MAFIA_REDIRECT_URL", "")  # Where players go once this process drains
+WATCH_INTERVAL = 1.0
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+def drain():
+    """
+    Stop creating rooms in this process. Games in progress continue here.
+    """
+    game_state.drain()
+    print("Draining: new rooms are redirected" + (f" to {MAFIA_REDIRECT_URL}" if MAFIA_REDIRECT_URL else ""))
+
+
+def hand_off(path=None):
+    """
+    Drain, then export every room to the handoff file and stop accepting changes.
+
+    Args:
+        path (str, optional): Handoff file, defaults to MAFIA_HANDOFF_FILE
+
+    Returns:
+        int: Number of rooms handed off
+
+    Raises:
+        ValueError: If no handoff file is given and MAFIA_HANDOFF_FILE isn't set
+    """
+    path = path or MAFIA_HANDOFF_FILE
+    if not path:
+        raise ValueError("No handoff file, set MAFIA_HANDOFF_FILE")
+    drain()
+    count = game_state.export_rooms(path)
+    print(f"Handed off {count} room(s) to {path}")
+    return count
+
+
+def resume(path=None):
+    """
+    Load rooms handed off by another process, if its handoff file is waiting. The
+    file is renamed afterwards so it is only loaded once.
+
+    Args:
+        path (str, optional): Handoff file, defaults to MAFIA_HANDOFF_FILE
+
+    Returns:
+        int: Number of rooms loaded
+    """
+    path = path or MAFIA_HANDOFF_FILE
+    # The process that wrote the file must not load its own rooms back
+    if not path or game_state.get_drain_state() is not None or not os.path.exists(path):
+        return 0
+
+    loaded_path = f"{path}.loaded-{int(time.time())}"
+    try:
+        # Claim the file first so two new processes can't both load it
+        os.replace(path, loaded_path)
+    except FileNotFoundError:
+        return 0
+
+    start = time.perf_counter()
+    count = game_state.import_rooms(loaded_path)
+    print(f"Loaded {count} handed-off room(s) from {path} in {(time.perf_counter() - start) * 1000:.1f} ms")
+    return count
+
+
+def get_redirect_link(room_code=None, player_name=None, spectator=False):
+    """
+    Build the link that takes a player (or spectator) to the new server, resuming
+    their session.
+
+    Returns:
+        str: The link, or None if MAFIA_REDIRECT_URL isn't set
+    """
+    if not MAFIA_REDIRECT_URL:
+        return None
+    if not (room_code and player_name):
+        return MAFIA_REDIRECT_URL
+    params = {"player_name": player_name, "room_code": room_code}
+    if spectator:
+        params["spectator"] = "1"
+    separator = "&" if "?" in MAFIA_REDIRECT_URL else "?"
+    return MAFIA_REDIRECT_URL + separator + urlencode(params)
+
+
+def get_status():
+    """
+    Returns:
+        dict: Drain state, room count, handoff file and redirect URL
+    """
+    return {
+        "state": game_state.get_drain_state() or "serving",
+        "rooms": len(game_state.get_all_room_codes()),
+        "handoff_file": MAFIA_HANDOFF_FILE or None,
+        "redirect_url": MAFIA_REDIRECT_URL or None,
+    }
+
+
+def _watch(interval):
+    while True:
+        try:
+            if MAFIA_DRAIN_FILE and os.path.exists(MAFIA_DRAIN_FILE) \
+                    and game_state.get_drain_state() != "handed_off":
+                # Remove the trigger so the next process doesn't drain itself on boot
+                os.remove(MAFIA_DRAIN_FILE)
+                if MAFIA_HANDOFF_FILE:
+                    hand_off()
+                else:
+                    drain()
+            resume()
+        except Exception as e:
+            print(f"Error during handoff: {str(e)}")
+        time.sleep(interval)
+
+
+def start_watcher(interval=WATCH_INTERVAL):
+    """
+    Load any waiting handoff file now, then keep watching for a handoff file to load
+    and for the drain trigger file. Safe to call on every Streamlit rerun; only the
+    first call does anything.
+
+    Returns:
+        bool: True if the watcher is running
+    """
+    global _watcher
+
+    with _watcher_lock:
+        if _watcher is None:
+            try:
+                resume()
+            except Exception as e:
+                print(f"Error loading handoff file: {str(e)}")
+            _watcher = threading.Thread(target=_watch, args=(interval,), name="handoff-watcher", daemon=True)
+            _watcher.start()
+        return True
@@ -0,0 +1,590 @@
+import os
+import hmac
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from . import game_state, generation, handoff, metrics, profiling
+from .socket_handler import get_websocket_manager
+
+# Host/port for the local HTTP API. Set MAFIA_API_PORT to an empty value to disable it.
+API_HOST = os.getenv("MAFIA_API_HOST", "127.0.0.1")
+API_PORT = os.getenv("MAFIA_API_PORT", "8765")
+
+# Shared secret for the routes that change the whole server (drain, handoff, ...).
+# Clients send it in the X-Mafia-Admin-Token header; without it set those routes are
+# refused.
+ADMIN_TOKEN = os.getenv("MAFIA_ADMIN_TOKEN", "")
+
+# Upper bound on how long a single long-poll request may park
+MAX_WAIT_SECONDS = 60.0
+
+# Host/port for the public room feed: a second listener that only serves the
+# read-only event feeds, so it can be opened to players' browsers while the room API
+# stays on loopback. Set MAFIA_FEED_PORT to an empty value to disable it.
+FEED_HOST = os.getenv("MAFIA_FEED_HOST", "0.0.0.0")
+FEED_PORT = os.getenv("MAFIA_FEED_PORT", "8766")
+
+# Seconds between keepalive comments on an idle room event feed
+FEED_KEEPALIVE_SECONDS = 15.0
+
+# Most event feeds open at once, over both listeners. Each open feed holds a server
+# thread, and with GAME_SHARDS also a thread in the room's shard while it waits for a
+# change. Browsers turned away fall back to timed reruns and retry later.
+MAX_FEED_CONNECTIONS = int(os.getenv("MAX_FEED_CONNECTIONS", "500"))
+
+_server = None
+_feed_server = None
+_server_lock = threading.Lock()
+_open_feeds = 0
+_open_feeds_lock = threading.Lock()
+
+
+def _active_sessions():
+    # Only meaningful inside `streamlit run`; the runtime API used here is internal
+    try:
+        from streamlit.runtime import Runtime
+    except ImportError:
+        return 0
+    if not Runtime.exists():
+        return 0
+    return Runtime.instance()._session_mgr.num_active_sessions()
+
+
+metrics.gauge("mafia_streamlit_sessions", "Active Streamlit browser sessions").set_function(_active_sessions)
+metrics.gauge("mafia_websocket_connections", "Registered websocket connections").set_function(
+    lambda: get_websocket_manager().get_connection_count())
+metrics.gauge("mafia_room_feed_connections", "Open room and chat event feeds").set_function(lambda: _open_feeds)
+metrics.gauge("mafia_generation_queue_depth", "Queued generation jobs by priority", ["priority"]).set_function(
+    lambda: generation.scheduler.get_metrics()["queue_depth_by_priority"])
+metrics.gauge("mafia_generation_running", "Generation jobs currently running").set_function(
+    lambda: generation.scheduler.get_metrics()["running"])
+
+
+class RoomFeedHandler(BaseHTTPRequestHandler):
+    """
+    Request handler for the public feed listener. It serves nothing but the event
+    feeds: a room's version and status, and its chat, which anyone with the room
+    code can already read as a spectator. So it can be reached from players' browsers.
+
+    Routes:
+        GET /rooms/<code>/events?version=N         -> server-sent events feed of the room's version
+        GET /rooms/<code>/chat/events?after=N      -> server-sent events feed of chat messages after N
+    """
+    # Keep the server quiet; Streamlit already owns the console
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _begin_stream(self):
+        """
+        Start a server-sent events response, counting it against MAX_FEED_CONNECTIONS.
+        Every stream that begins must be ended with _end_stream.
+
+        Returns:
+            bool: False if the limit was reached and the request has been refused with a 503
+        """
+        global _open_feeds
+
+        with _open_feeds_lock:
+            full = _open_feeds >= MAX_FEED_CONNECTIONS
+            if not full:
+                _open_feeds += 1
+        if full:
+            self._send_json(503, {"error": "Too many open feeds"})
+            return False
+
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-store")
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            self.wfile.write(b"retry: 2000\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            self._end_stream()
+            return False
+        return True
+
+    def _end_stream(self):
+        global _open_feeds
+
+        with _open_feeds_lock:
+            _open_feeds -= 1
+
+    def _stream_room(self, room_code, version, player):
+        """
+        Server-sent events feed of a room: a "version" event each time the room
+        passes the given version, a keepalive comment while it doesn't change, and a
+        "gone" event before closing once the room is removed or handed off. The
+        connection stays open until the client closes it. Refused with a 503 when
+        MAX_FEED_CONNECTIONS feeds are already open.
+        """
+        if game_state.get_room_summary(room_code) is None:
+            self._send_json(404, {"error": "Room not found"})
+            return
+        if not self._begin_stream():
+            return
+
+        # An open feed is a connected client, so it keeps the player online like a long-poll
+        keepalive = min(FEED_KEEPALIVE_SECONDS, game_state.PRESENCE_TIMEOUT / 2)
+        try:
+            while True:
+                if player:
+                    game_state.heartbeat(room_code, player)
+                summary = game_state.wait_for_change(room_code, version, keepalive)
+                if summary is None or game_state.get_drain_state() == "handed_off":
+                    self.wfile.write(b"event: gone\ndata: {}\n\n")
+                    self.wfile.flush()
+                    return
+                if summary["version"] > version:
+                    version = summary["version"]
+                    data = json.dumps({"version": version, "status": summary["status"]})
+                    self.wfile.write(f"id: {version}\nevent: version\ndata: {data}\n\n".encode("utf-8"))
+                else:
+                    self.wfile.write(b": keepalive\n\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The browser closed the page or is reconnecting
+            pass
+        finally:
+            self._end_stream()
+
+    def _stream_chat(self, room_code, after_seq):
+        """
+        Server-sent events feed of a room's chat: a "message" event for each message
+        after the given sequence number, oldest first, then one for each new message
+        as it is posted. A "reset" event comes first when messages the client hasn't
+        seen have dropped out of the room's history, and a "gone" event before
+        closing once the room is removed or handed off. Shares MAX_FEED_CONNECTIONS
+        with the room feed.
+        """
+        if game_state.get_room_summary(room_code) is None:
+            self._send_json(404, {"error": "Room not found"})
+            return
+        if not self._begin_stream():
+            return
+
+        try:
+            while True:
+                result = game_state.wait_for_messages(room_code, after_seq, FEED_KEEPALIVE_SECONDS)
+                if result is None or game_state.get_drain_state() == "handed_off":
+                    self.wfile.write(b"event: gone\ndata: {}\n\n")
+                    self.wfile.flush()
+                    return
+                if result["truncated"]:
+                    self.wfile.write(b"event: reset\ndata: {}\n\n")
+                for message in result["messages"]:
+                    data = json.dumps(message)
+                    self.wfile.write(f"id: {message['seq']}\nevent: message\ndata: {data}\n\n".encode("utf-8"))
+                if not result["messages"]:
+                    self.wfile.write(b": keepalive\n\n")
+                after_seq = result["last_seq"]
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self._end_stream()
+
+    def _serve_feed(self, parts, query, heartbeats=False):
+        """
+        Serve GET /rooms/<code>/events or /rooms/<code>/chat/events if that is the request.
+
+        Args:
+            parts (list): The request path's segments
+            query (dict): The parsed query string
+            heartbeats (bool): Count the room feed as presence heartbeats for its "player"
+
+        Returns:
+            bool: True if the request was a feed and has been answered
+        """
+        if len(parts) == 3 and parts[0] == "rooms" and parts[2] == "events":
+            name = "version"
+        elif len(parts) == 4 and parts[0] == "rooms" and parts[2:] == ["chat", "events"]:
+            name = "after"
+        else:
+            return False
+        try:
+            # A reconnecting EventSource sends the id of the last event it received
+            position = int(self.headers.get("Last-Event-ID") or query.get(name, ["0"])[0])
+        except ValueError:
+            self._send_json(400, {"error": f"{name} must be a number"})
+            return True
+        if name == "after":
+            self._stream_chat(parts[1].upper(), position)
+        else:
+            player = query.get("player", [None])[0] if heartbeats else None
+            self._stream_room(parts[1].upper(), position, player)
+        return True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        if not self._serve_feed(parts, parse_qs(url.query)):
+            self._send_json(404, {"error": "Not found"})
+
+
+class GameAPIHandler(RoomFeedHandler):
+    """
+    Request handler for the room API.
+
+    Routes:
+        GET /rooms/<code>                          -> current room summary
+        GET /rooms/<code>/wait?version=N&timeout=T&player=P
+                                                   -> long-poll until the room passes version N;
+                                                      with player, also a presence heartbeat
+        GET /rooms/<code>/events?version=N&player=P
+                                                   -> server-sent events feed of the room's version,
+                                                      held open; with player, also presence heartbeats
+        GET /rooms/<code>/chat/events?after=N      -> server-sent events feed of chat messages after N
+        GET /rooms/<code>/chat?after=N&timeout=T&player=P
+                                                   -> chat messages after sequence number N,
+                                                      long-polling up to T seconds for one
+        GET /rooms/<code>/memory                   -> estimated memory used by the room
+        GET /rooms/<code>/public                   -> spectator view, including its rendered markdown
+        GET /rooms/<code>/history                  -> every logged change of the room (event log only, admin)
+        GET /generation                            -> story generation queue metrics
+        GET /metrics                               -> all metrics in Prometheus text format
+        GET /events                                -> event bus counters and dispatch lag
+        GET /timers                                -> timer wheel counters and firing lag
+        GET /event-log                             -> event log counters
+        GET /memory?limit=N                        -> memory estimates for all rooms, largest first
+        GET /profile?limit=N                       -> profiler status, scopes and hottest functions
+        GET /profile/collapsed                     -> sampled stacks in collapsed (flamegraph) format
+        GET /drain                                 -> drain state and room count
+        POST /profile?mode=sampling|cprofile|off   -> start, switch or stop the profiler (admin)
+        POST /profile/reset                        -> discard collected profile data (admin)
+        POST /memory/compact                       -> compact ended and idle rooms now (admin)
+        POST /drain?handoff=true                   -> stop creating rooms; with handoff, also hand them off (admin)
+        POST /handoff                              -> write all rooms to the handoff file and stop changes (admin)
+        POST /handoff/load                         -> load a waiting handoff file now (admin)
+
+    Routes marked admin need the X-Mafia-Admin-Token header, because they act on
+    the whole server or reveal hidden game state. Only the event feeds
+    allow cross-origin reads.
+    """
+    def _check_admin(self):
+        """
+        Refuse the request unless it carries the admin token. Browsers only send a
+        custom header cross-origin after a preflight, which this server never
+        answers, so a web page a player has open can't call admin routes.
+
+        Returns:
+            bool: True if the request may go ahead; otherwise a 403 has been sent
+        """
+        if not ADMIN_TOKEN:
+            self._send_json(403, {"error": "Admin routes are disabled, set MAFIA_ADMIN_TOKEN"})
+            return False
+        token = self.headers.get("X-Mafia-Admin-Token", "")
+        if not hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+            self._send_json(403, {"error": "Missing or wrong X-Mafia-Admin-Token header"})
+            return False
+        return True
+
+    def _send_text(self, status, text, content_type):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        query = parse_qs(url.query)
+
+        if self._serve_feed(parts, query, heartbeats=True):
+            return
+
+        if len(parts) == 2 and parts[0] == "rooms":
+            summary = game_state.get_room_summary(parts[1].upper())
+            if summary is None:
+                self._send_json(404, {"error": "Room not found"})
+            else:
+                self._send_json(200, summary)
+            return
+
+        if len(parts) == 3 and parts[0] == "rooms" and parts[2] == "wait":
+            try:
+                version = int(query.get("version", ["0"])[0])
+                timeout = float(query.get("timeout", ["30"])[0])
+            except ValueError:
+                self._send_json(400, {"error": "version and timeout must be numbers"})
+                return
+
+            timeout = min(max(timeout, 0.0), MAX_WAIT_SECONDS)
+            # A client that is long-polling is connected. Its waits are kept well inside
+            # the presence timeout so it never shows as offline between polls.
+            player = query.get("player", [None])[0]
+            if player:
+                game_state.heartbeat(parts[1].upper(), player)
+                timeout = min(timeout, game_state.PRESENCE_TIMEOUT / 2)
+            summary = game_state.wait_for_change(parts[1].upper(), version, timeout)
+            if summary is None:
+                self._send_json(404, {"error": "Room not found"})
+            else:
+                self._send_json(200, summary)
+            return
+
+        if len(parts) == 3 and parts[0] == "rooms" and parts[2] == "chat":
+            try:
+                after = int(query.get("after", ["0"])[0])
+                timeout = float(query.get("timeout", ["0"])[0])
+            except ValueError:
+                self._send_json(400, {"error": "after and timeout must be numbers"})
+                return
+
+            timeout = min(max(timeout, 0.0), MAX_WAIT_SECONDS)
+            player = query.get("player", [None])[0]
+            if player:
+                game_state.heartbeat(parts[1].upper(), player)
+                timeout = min(timeout, game_state.PRESENCE_TIMEOUT / 2)
+            messages = game_state.wait_for_messages(parts[1].upper(), after, timeout)
+            if messages is None:
+                self._send_json(404, {"error": "Room not found"})
+            else:
+                self._send_json(200, messages)
+            return
+
+        if len(parts) == 3 and parts[0] == "rooms" and parts[2] == "history":
+            # The log holds the whole story, roles included, so it is for admins only
+            if not self._check_admin():
+                return
+            history = game_state.get_room_history(parts[1].upper())
+            if history is None:
+                self._send_json(404, {"error": "Event log is disabled, set EVENT_LOG_DIR"})
+            elif not history:
+                self._send_json(404, {"error": "Room not found in the event log"})
+            else:
+                self._send_json(200, history)
+            return
+
+        if len(parts) == 3 and parts[0] == "rooms" and parts[2] == "public":
+            view = game_state.get_public_view(parts[1].upper())
+            if view is None:
+                self._send_json(404, {"error": "Room not found"})
+            else:
+                self._send_json(200, view)
+            return
+
+        if len(parts) == 3 and parts[0] == "rooms" and parts[2] == "memory":
+            usage = game_state.get_room_memory(parts[1].upper())
+            if usage is None:
+                self._send_json(404, {"error": "Room not found"})
+            else:
+                self._send_json(200, usage)
+            return
+
+        if parts == ["generation"]:
+            self._send_json(200, generation.get_scheduler_metrics())
+            return
+
+        if parts == ["events"]:
+            self._send_json(200, game_state.get_event_stats())
+            return
+
+        if parts == ["timers"]:
+            self._send_json(200, game_state.get_timer_stats())
+            return
+
+        if parts == ["event-log"]:
+            stats = game_state.get_event_log_stats()
+            if stats is None:
+                self._send_json(404, {"error": "Event log is disabled, set EVENT_LOG_DIR"})
+            else:
+                self._send_json(200, stats)
+            return
+
+        if parts == ["memory"]:
+            try:
+                limit = int(query["limit"][0]) if "limit" in query else None
+            except ValueError:
+                self._send_json(400, {"error": "limit must be a number"})
+                return
+            self._send_json(200, game_state.get_memory_usage(limit))
+            return
+
+        if parts == ["metrics"]:
+            self._send_text(200, metrics.render(), metrics.CONTENT_TYPE)
+            return
+
+        if parts == ["profile"]:
+            try:
+                limit = int(query.get("limit", ["40"])[0])
+            except ValueError:
+                self._send_json(400, {"error": "limit must be a number"})
+                return
+            self._send_json(200, profiling.get_report(limit))
+            return
+
+        if parts == ["profile", "collapsed"]:
+            self._send_text(200, profiling.get_collapsed_stacks(), "text/plain; charset=utf-8")
+            return
+
+        if parts == ["drain"]:
+            self._send_json(200, handoff.get_status())
+            return
+
+        self._send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        query = parse_qs(url.query)
+
+        if parts == ["profile"]:
+            if not self._check_admin():
+                return
+            mode = query.get("mode", ["sampling"])[0].lower()
+            if mode == "off":
+                profiling.stop()
+            else:
+                try:
+                    interval = float(query["interval"][0]) if "interval" in query else None
+                except ValueError:
+                    self._send_json(400, {"error": "interval must be a number"})
+                    return
+                if not profiling.start(mode, interval):
+                    self._send_json(400, {"error": f"mode must be one of {', '.join(profiling.MODES)} or off"})
+                    return
+            self._send_json(200, {"mode": mode if profiling.is_enabled() else "off"})
+            return
+
+        if parts == ["profile", "reset"]:
+            if not self._check_admin():
+                return
+            profiling.reset()
+            self._send_json(200, {"reset": True})
+            return
+
+        if parts == ["memory", "compact"]:
+            if not self._check_admin():
+                return
+            self._send_json(200, {"compacted": game_state.compact_rooms()})
+            return
+
+        if parts == ["drain"]:
+            if not self._check_admin():
+                return
+            if query.get("handoff", ["false"])[0].lower() in ("1", "true", "yes"):
+                try:
+                    handoff.hand_off()
+                except ValueError as e:
+                    self._send_json(400, {"error": str(e)})
+                    return
+            else:
+                handoff.drain()
+            self._send_json(200, handoff.get_status())
+            return
+
+        if parts == ["handoff"]:
+            if not self._check_admin():
+                return
+            try:
+                rooms = handoff.hand_off()
+            except ValueError as e:
+                self._send_json(400, {"error": str(e)})
+                return
+            self._send_json(200, dict(handoff.get_status(), handed_off=rooms))
+            return
+
+        if parts == ["handoff", "load"]:
+            if not self._check_admin():
+                return
+            self._send_json(200, {"loaded": handoff.resume()})
+            return
+
+        self._send_json(404, {"error": "Not found"})
+
+
+def _listen(handler_class, host, port, label, thread_name):
+    """
+    Bind a threaded HTTP server and serve it from a background thread.
+
+    Returns:
+        ThreadingHTTPServer: The running server, or None if disabled or the port is taken
+    """
+    if port is None or str(port).strip() == "":
+        return None
+
+    try:
+        server = ThreadingHTTPServer((host, int(port)), handler_class)
+    except OSError as e:
+        print(f"Could not start {label} on port {port}: {e}")
+        return None
+
+    # Long-poll and event feed handlers must not keep the process alive on shutdown
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name=thread_name, daemon=True)
+    thread.start()
+
+    print(f"{label} listening on http://{server.server_address[0]}:{server.server_address[1]}")
+    return server
+
+
+def start_api_server(host=None, port=None):
+    """
+    Start the HTTP API in a background thread. Safe to call on every Streamlit rerun;
+    only the first call starts a server.
+
+    Args:
+        host (str, optional): Interface to bind, defaults to MAFIA_API_HOST
+        port (int, optional): Port to bind, defaults to MAFIA_API_PORT
+
+    Returns:
+        ThreadingHTTPServer: The running server, or None if disabled or the port is taken
+    """
+    global _server
+
+    with _server_lock:
+        if _server is None:
+            _server = _listen(GameAPIHandler, host or API_HOST, port if port is not None else API_PORT,
+                              "Game API", "game-api")
+        return _server
+
+
+def start_feed_server(host=None, port=None):
+    """
+    Start the public room feed listener in a background thread. Safe to call on every
+    Streamlit rerun; only the first call starts a server.
+
+    Args:
+        host (str, optional): Interface to bind, defaults to MAFIA_FEED_HOST
+        port (int, optional): Port to bind, defaults to MAFIA_FEED_PORT
+
+    Returns:
+        ThreadingHTTPServer: The running server, or None if disabled or the port is taken
+    """
+    global _feed_server
+
+    with _server_lock:
+        if _feed_server is None:
+            _feed_server = _listen(RoomFeedHandler, host or FEED_HOST, port if port is not None else FEED_PORT,
+                                   "Room feed", "room-feed")
+        return _feed_server
+
+
+def stop_api_server():
+    """
+    Stop the HTTP API and the room feed listener if they are running.
+    """
+    global _server, _feed_server
+
+    with _server_lock:
+        for server in (_server, _feed_server):
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+        _server = _feed_server = None
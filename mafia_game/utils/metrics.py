@@ -0,0 +1,328 @@
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Set MAFIA_METRICS=false to skip instrumentation entirely (decorated functions are
+# left unwrapped and the /metrics endpoint renders only callback gauges)
+METRICS_ENABLED = os.getenv("MAFIA_METRICS", "true").lower() not in ("0", "false", "no")
+
+# Latency buckets in seconds, from sub-millisecond state operations up to slow story generations
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Bound:
+    """
+    A gauge with its label values fixed, for code that updates the same series
+    repeatedly without rebuilding the label key.
+    """
+    def __init__(self, metric, key):
+        self._metric = metric
+        self._key = key
+
+    def inc(self, amount=1):
+        self._metric._inc(self._key, amount)
+
+    def dec(self, amount=1):
+        self._metric._inc(self._key, -amount)
+
+    def set(self, value):
+        self._metric._set(self._key, value)
+
+
+class _BoundCounter:
+    """
+    A counter series with its label values fixed, holding its cell directly.
+    """
+    def __init__(self, counter, key):
+        self._lock = counter._lock
+        self._cell = counter._cell_for(key)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._cell[0] += amount
+
+
+class _BoundHistogram:
+    """
+    A histogram series with its label values fixed. Holds its bucket counts directly
+    so an observation is one bisect and one short critical section.
+    """
+    def __init__(self, histogram, key):
+        self._lock = histogram._lock
+        self._buckets = histogram.buckets
+        self._state = histogram._state_for(key)
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self._buckets, value)
+        state = self._state
+        with self._lock:
+            state[0][idx] += 1
+            state[1] += value
+
+
+class Metric:
+    """
+    Base class for a named metric family with optional labels.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}  # label values tuple -> value
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        try:
+            return tuple(str(labels[name]) for name in self.labelnames)
+        except KeyError:
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+
+    def labels(self, **labels):
+        """
+        Bind label values once and return an object with the update methods.
+
+        Returns:
+            object: The bound series
+        """
+        raise NotImplementedError
+
+    def collect(self):
+        """
+        Get the samples to render.
+
+        Returns:
+            list: (sample name, label pairs, value) tuples
+        """
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name, list(zip(self.labelnames, key)), value) for key, value in sorted(items)]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def labels(self, **labels):
+        return _BoundCounter(self, self._key(labels))
+
+    def inc(self, amount=1, **labels):
+        cell = self._cell_for(self._key(labels))
+        with self._lock:
+            cell[0] += amount
+
+    def _cell_for(self, key):
+        with self._lock:
+            cell = self._values.get(key)
+            if cell is None:
+                cell = self._values[key] = [0]
+            return cell
+
+    def collect(self):
+        return [(name, pairs, cell[0]) for name, pairs, cell in super().collect()]
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. Instead of being set, a gauge can be computed at
+    scrape time by a function registered with set_function().
+    """
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def labels(self, **labels):
+        return _Bound(self, self._key(labels))
+
+    def set(self, value, **labels):
+        self._set(self._key(labels), value)
+
+    def inc(self, amount=1, **labels):
+        self._inc(self._key(labels), amount)
+
+    def dec(self, amount=1, **labels):
+        self._inc(self._key(labels), -amount)
+
+    def _set(self, key, value):
+        with self._lock:
+            self._values[key] = value
+
+    def _inc(self, key, amount):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_function(self, fn):
+        """
+        Compute this gauge at scrape time.
+
+        Args:
+            fn (callable): Returns a number for an unlabelled gauge, or a dict mapping
+                           label value tuples (or a single label value) to numbers
+        """
+        self._function = fn
+
+    def collect(self):
+        if self._function is None:
+            return super().collect()
+
+        try:
+            result = self._function()
+        except Exception as e:
+            print(f"Error collecting metric {self.name}: {str(e)}")
+            return []
+
+        if not isinstance(result, dict):
+            return [(self.name, [], result)]
+
+        samples = []
+        for key, value in sorted(result.items(), key=lambda item: str(item[0])):
+            key = key if isinstance(key, tuple) else (key,)
+            samples.append((self.name, list(zip(self.labelnames, key)), value))
+        return samples
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def labels(self, **labels):
+        return _BoundHistogram(self, self._key(labels))
+
+    def observe(self, value, **labels):
+        idx = bisect.bisect_left(self.buckets, value)
+        state = self._state_for(self._key(labels))
+        with self._lock:
+            state[0][idx] += 1
+            state[1] += value
+
+    def _state_for(self, key):
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (not cumulative) plus an overflow slot, and the sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            return state
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the duration of a with-block.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def collect(self):
+        with self._lock:
+            items = [(key, list(state[0]), state[1]) for key, state in self._values.items()]
+
+        samples = []
+        for key, counts, total in sorted(items):
+            pairs = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", pairs + [("le", _format_value(bound))], cumulative))
+            samples.append((f"{self.name}_sum", pairs, total))
+            samples.append((f"{self.name}_count", pairs, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Holds every metric family in the process and renders them in the Prometheus
+    text exposition format.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get_or_create(self, cls, name, documentation, labelnames, **kwargs):
+        # Modules can be re-imported (Streamlit reruns), so registering twice returns
+        # the existing family instead of failing
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} is already registered with a different type or labels")
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self):
+        """
+        Render all metrics.
+
+        Returns:
+            str: Prometheus text format (version 0.0.4)
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {_escape(metric.documentation)}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for sample_name, pairs, value in metric.collect():
+                lines.append(f"{sample_name}{_format_labels(pairs)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# Create a singleton instance
+registry = MetricsRegistry()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def counter(name, documentation, labelnames=()):
+    return registry.counter(name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    return registry.gauge(name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return registry.histogram(name, documentation, labelnames, buckets)
+
+
+def render():
+    return registry.render()
@@ -1,39 +1,52 @@
 import os
 import json
+import time
 import requests
 import re
 from dotenv import load_dotenv
 
+from . import metrics, tracing
+
 # Load environment variables
 load_dotenv()
 
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "google/gemini-2.5-pro-exp-03-25:free") # Default fallback model
-OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1/chat/completions"
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1/chat/completions")
+OPENROUTER_TIMEOUT = float(os.getenv("OPENROUTER_TIMEOUT", "60"))  # Seconds before giving up on a request
+OPENROUTER_MAX_RETRIES = int(os.getenv("OPENROUTER_MAX_RETRIES", "2"))  # Extra attempts after a 429/5xx or network error
+OPENROUTER_RETRY_BACKOFF = float(os.getenv("OPENROUTER_RETRY_BACKOFF", "1.0"))  # Seconds before the first retry, doubled each time
 
-def generate_mafia_story(num_players):
+def build_story_prompt(num_players, lazy_clues=False):
     """
-    Generate a Mafia game story using the OpenRouter API.
+    Build the story generation prompt.
 
     Args:
         num_players (int): Number of players in the game
+        lazy_clues (bool): Only ask for the first clue; the rest are generated during play
 
     Returns:
-        dict: JSON response containing story, characters, and clues
+        str: The prompt text
     """
-    if not OPENROUTER_API_KEY or OPENROUTER_API_KEY.strip() == "":
-        raise ValueError("OpenRouter API key not found or empty. Please check your .env file.")
-
-    # Check if the API key looks valid (basic format check)
-    if not OPENROUTER_API_KEY.startswith("sk-or-"):
-        print(f"Warning: OpenRouter API key doesn't match expected format. Key starts with: {OPENROUTER_API_KEY[:10]}...")
-        # Continue anyway, as the format might change in the future
-
     # Add a timestamp to ensure uniqueness in each generation
-    import time
     timestamp = int(time.time())
 
-    prompt = f"""أنت مؤلف قصص بوليسية محترف باللهجة المصرية. اكتب قصة جريمة قتل غامضة ومعقدة (بحد أقصى 2000 كلمة) مع {num_players} شخصيات، وضحية، و3 أدلة ذكية تتعلق بالجريمة.
+    if lazy_clues:
+        clue_count_text = "ودليل أول ذكي يتعلق بالجريمة (باقي الأدلة هتتكتب بعدين أثناء اللعب)"
+        clue_instructions = """الأدلة:
+- الدليل الأول بس: غامض ويمكن تفسيره بأكثر من طريقة"""
+        clue_json = '''    "الدليل الأول: دليل غامض يمكن تفسيره بأكثر من طريقة"'''
+    else:
+        clue_count_text = "و3 أدلة ذكية تتعلق بالجريمة"
+        clue_instructions = """الأدلة:
+- الدليل الأول: غامض ويمكن تفسيره بأكثر من طريقة
+- الدليل الثاني: يشير لعدة أشخاص محتملين
+- الدليل الثالث: يشير للقاتل الحقيقي لكن بطريقة ذكية وغير مباشرة"""
+        clue_json = '''    "الدليل الأول: دليل غامض يمكن تفسيره بأكثر من طريقة",
+    "الدليل الثاني: دليل يشير لعدة أشخاص محتملين",
+    "الدليل الثالث: دليل ذكي يشير للقاتل الحقيقي بطريقة غير مباشرة"'''
+
+    return f"""أنت مؤلف قصص بوليسية محترف باللهجة المصرية. اكتب قصة جريمة قتل غامضة ومعقدة (بحد أقصى 2000 كلمة) مع {num_players} شخصيات، وضحية، {clue_count_text}.
 
 مهم جداً: اصنع قصة معقدة مع حبكة غير متوقعة وتحويلات مفاجئة. اجعل القصة صعبة الحل بحيث:
 
@@ -51,10 +64,7 @@ def generate_mafia_story(num_players):
 5. دوافع محتملة للقتل (لكل الشخصيات، مش بس القاتل)
 6. أسرار أو ماضي غامض
 
-الأدلة:
-- الدليل الأول: غامض ويمكن تفسيره بأكثر من طريقة
-- الدليل الثاني: يشير لعدة أشخاص محتملين
-- الدليل الثالث: يشير للقاتل الحقيقي لكن بطريقة ذكية وغير مباشرة
+{clue_instructions}
 
 أضف عنصر مفاجأة أو تحول درامي في القصة (مثل: الضحية كان عنده أسرار خطيرة، أو علاقات سرية، أو خطط انتقامية). لا تضيف اي شئ جنسي في القصة.
 
@@ -74,78 +84,294 @@ Give your response in this JSON format (but write the content in Egyptian Arabic
     ... (there must be exactly {num_players} characters)
   ],
   "clues": [
-    "الدليل الأول: دليل غامض يمكن تفسيره بأكثر من طريقة",
-    "الدليل الثاني: دليل يشير لعدة أشخاص محتملين",
-    "الدليل الثالث: دليل ذكي يشير للقاتل الحقيقي بطريقة غير مباشرة"
+{clue_json}
   ]
 }}
 
 It is critical that your response is valid JSON that matches this format exactly. Do not include any text before or after the JSON object. Make sure all text is in Egyptian Arabic dialect (not formal Arabic)."""
 
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json"
-    }
+def build_clue_prompt(story_data, clue_number, revealed_clues, eliminated_characters):
+    """
+    Build the prompt for a single clue generated mid-game.
+
+    Args:
+        story_data (dict): The story data, with roles already assigned
+        clue_number (int): The 1-based number of the clue to write
+        revealed_clues (list): Clues the players have already seen
+        eliminated_characters (list): Character names of players wrongly eliminated so far
+
+    Returns:
+        str: The prompt text
+    """
+    killer = next((p["character_name"] for p in story_data["players"] if p.get("is_mafia")), "")
+    characters = "\n".join(f"- {p['character_name']}" for p in story_data["players"])
+    clues = "\n".join(f"- {c}" for c in revealed_clues) or "- (لسه مفيش)"
+    eliminated = "، ".join(eliminated_characters) or "محدش لسه"
+
+    if clue_number >= 3:
+        hint = "الدليل ده لازم يشير للقاتل الحقيقي لكن بطريقة ذكية وغير مباشرة"
+    else:
+        hint = "الدليل ده لازم يشير لعدة أشخاص محتملين، من ضمنهم القاتل"
+
+    return f"""أنت مؤلف قصص بوليسية محترف باللهجة المصرية. دي قصة جريمة بتتلعب دلوقتي:
+
+{story_data["main_story"]}
+
+الضحية: {story_data["killed_character_name"]}
+الشخصيات:
+{characters}
+
+القاتل الحقيقي (سر، متقولوش صراحة): {killer}
+الأدلة اللي اتكشفت لحد دلوقتي:
+{clues}
+الشخصيات اللي اتستبعدت غلط: {eliminated}
+
+اكتب الدليل رقم {clue_number}. {hint}. متكررش أي دليل قديم، ومتذكرش اسم القاتل صراحة.
+
+Give your response in this JSON format (but write the content in Egyptian Arabic dialect):
+
+{{
+  "clue": "نص الدليل"
+}}
+
+It is critical that your response is valid JSON that matches this format exactly. Do not include any text before or after the JSON object."""
+
+def _check_api_key():
+    if not OPENROUTER_API_KEY or OPENROUTER_API_KEY.strip() == "":
+        raise ValueError("OpenRouter API key not found or empty. Please check your .env file.")
+
+    # Check if the API key looks valid (basic format check)
+    if not OPENROUTER_API_KEY.startswith("sk-or-"):
+        print(f"Warning: OpenRouter API key doesn't match expected format. Key starts with: {OPENROUTER_API_KEY[:10]}...")
+        # Continue anyway, as the format might change in the future
+
+def _post_with_retries(url, headers, data, timeout, max_retries=None):
+    """
+    POST to the chat completions endpoint, retrying rate limits, server errors and
+    network errors with exponential backoff. Retries share the timeout budget, so the
+    whole call never takes much longer than a single request would.
+
+    Returns:
+        requests.Response: The last response received
+
+    Raises:
+        requests.exceptions.RequestException: If the last attempt failed on the network
+    """
+    if max_retries is None:
+        max_retries = OPENROUTER_MAX_RETRIES
+    deadline = time.monotonic() + timeout
+    backoff = OPENROUTER_RETRY_BACKOFF
+
+    # Serialize once so the request size can be reported and every attempt reuses it
+    body = json.dumps(data).encode("utf-8")
+    tracing.current_span().set_attribute("http.request_bytes", len(body))
+
+    for attempt in range(max_retries + 1):
+        error = None
+        with tracing.span("http.attempt", attempt=attempt + 1) as span:
+            try:
+                response = requests.post(url, headers=headers, data=body,
+                                         timeout=max(deadline - time.monotonic(), 0.1))
+                span.set_attribute("http.status_code", response.status_code)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                response, error = None, e
+                span.set_status("error", f"{e.__class__.__name__}: {e}")
+
+        if response is not None and response.status_code != 429 and response.status_code < 500:
+            return response
+
+        # Honour the server's Retry-After hint if it sent one
+        delay = backoff
+        retry_after = response.headers.get("Retry-After", "") if response is not None else ""
+        if retry_after.replace(".", "", 1).isdigit():
+            delay = float(retry_after)
+
+        # Give up unless the retry gets at least as long to run as we wait for it
+        if attempt == max_retries or 2 * delay >= deadline - time.monotonic():
+            if error is not None:
+                raise error
+            return response
+
+        reason = error.__class__.__name__ if error is not None else response.status_code
+        print(f"Request to {url} failed ({reason}), retrying in {delay:.1f}s")
+        time.sleep(delay)
+        backoff *= 2
+
+def _request_completion(prompt, max_tokens, timeout=None, base_url=None, api_key=None,
+                        model=None, max_retries=None, service="OpenRouter"):
+    """
+    Send a single-message chat completion request and return the message content.
+    Defaults to the OpenRouter configuration; any OpenAI-compatible endpoint works.
+
+    Raises:
+        requests.exceptions.RequestException: On network errors
+        ValueError: On HTTP errors or an unexpected response structure
+    """
+    if base_url is None:
+        base_url, api_key, model = OPENROUTER_BASE_URL, OPENROUTER_API_KEY, OPENROUTER_MODEL
+
+    headers = {"Content-Type": "application/json"}
+    if api_key:
+        headers["Authorization"] = f"Bearer {api_key}"
 
     data = {
-        "model": OPENROUTER_MODEL or "google/gemini-2.5-pro-exp-03-25:free",
+        "model": model or "google/gemini-2.5-pro-exp-03-25:free",
         "messages": [
             {"role": "user", "content": prompt}
         ],
-        "max_tokens": 2000,
+        "max_tokens": max_tokens,
         "temperature": 0.9,
         "response_format": {"type": "json_object"}  # Request JSON response specifically
     }
 
-    try:
-        response = requests.post(OPENROUTER_BASE_URL, headers=headers, json=data)
-
-        # Handle HTTP errors more gracefully
-        if response.status_code == 401:
-            print("Authentication error: The OpenRouter API key is invalid or expired.")
-            print("Please update your .env file with a valid API key.")
-            raise ValueError("Invalid or expired OpenRouter API key")
-        elif response.status_code == 429:
-            print("Rate limit exceeded: Too many requests to OpenRouter API.")
-            raise ValueError("OpenRouter API rate limit exceeded")
-        elif response.status_code != 200:
-            print(f"OpenRouter API returned error status code: {response.status_code}")
-            print(f"Response: {response.text[:500]}")
-            raise ValueError(f"OpenRouter API error: {response.status_code}")
+    with tracing.span("http.chat_completion", service=service, url=base_url,
+                      model=data["model"], max_tokens=max_tokens) as span:
+        response = _post_with_retries(base_url, headers, data, timeout or OPENROUTER_TIMEOUT, max_retries)
+        span.set_attributes(**{"http.status_code": response.status_code,
+                               "http.response_bytes": len(response.content)})
+        return _parse_completion(response, service, span)
+
+def _parse_completion(response, service, span):
+    """
+    Check a chat completion response and return the message content, recording token
+    usage on the HTTP span.
+    """
+    # Handle HTTP errors more gracefully
+    if response.status_code == 401:
+        print(f"Authentication error: The {service} API key is invalid or expired.")
+        print("Please update your .env file with a valid API key.")
+        raise ValueError(f"Invalid or expired {service} API key")
+    elif response.status_code == 429:
+        print(f"Rate limit exceeded: Too many requests to {service} API.")
+        raise ValueError(f"{service} API rate limit exceeded")
+    elif response.status_code != 200:
+        print(f"{service} API returned error status code: {response.status_code}")
+        print(f"Response: {response.text[:500]}")
+        raise ValueError(f"{service} API error: {response.status_code}")
 
+    try:
         response_data = response.json()
+    except ValueError:
+        print(f"API Response text: {response.text[:500]}")
+        raise
+
+    if "choices" not in response_data or not response_data["choices"]:
+        raise ValueError(f"Invalid API response structure: {response_data}")
+
+    content = response_data["choices"][0]["message"]["content"]
+
+    usage = response_data.get("usage") or {}
+    span.set_attributes(**{f"llm.{key}": usage[key]
+                           for key in ("prompt_tokens", "completion_tokens", "total_tokens") if key in usage})
+    span.set_attribute("llm.finish_reason", response_data["choices"][0].get("finish_reason") or "")
+    span.set_attribute("llm.content_chars", len(content or ""))
+
+    # Debug response
+    print(f"API Response: {content[:100]}...")
+
+    return content
+
+def generate_mafia_story(num_players, timeout=None, lazy_clues=False, provider=None):
+    """
+    Generate a Mafia game story using the OpenRouter API, or another provider.
+
+    Args:
+        num_players (int): Number of players in the game
+        timeout (float, optional): Request timeout in seconds, defaults to OPENROUTER_TIMEOUT
+        lazy_clues (bool): Only generate the first clue; later clues come from generate_next_clue
+        provider (Provider, optional): Backend to send the prompt to (see utils/providers.py),
+                                       defaults to OpenRouter
 
-        if "choices" not in response_data or not response_data["choices"]:
-            raise ValueError(f"Invalid API response structure: {response_data}")
+    Returns:
+        dict: JSON response containing story, characters, and clues
+    """
+    if provider is None:
+        _check_api_key()
+    service = provider.label if provider is not None else "OpenRouter"
 
-        content = response_data["choices"][0]["message"]["content"]
+    with tracing.span("prompt.build", kind="story", players=num_players) as span:
+        prompt = build_story_prompt(num_players, lazy_clues)
+        span.set_attribute("prompt_chars", len(prompt))
+    content = None
 
-        # Debug response
-        print(f"API Response: {content[:100]}...")
+    try:
+        if provider is None:
+            content = _request_completion(prompt, max_tokens=2000, timeout=timeout)
+        else:
+            content = provider.complete(prompt, max_tokens=2000, timeout=timeout)
 
         # Extract JSON from content
         story_data = extract_json_from_content(content)
 
         # Validate the response structure
-        validate_story_data(story_data, num_players)
+        validate_story_data(story_data, num_players, num_clues=1 if lazy_clues else 3)
 
         return story_data
 
     except requests.exceptions.RequestException as e:
-        print(f"Network error connecting to OpenRouter API: {str(e)}")
-        raise ConnectionError(f"Failed to connect to OpenRouter API: {str(e)}")
+        print(f"Network error connecting to {service} API: {str(e)}")
+        raise ConnectionError(f"Failed to connect to {service} API: {str(e)}")
     except (json.JSONDecodeError, ValueError) as e:
         # Print full error and API response if available
         print(f"Error: {str(e)}")
-        if 'content' in locals():
+        if content is not None:
             print(f"API Response content: {content[:500]}")
-        elif 'response' in locals() and hasattr(response, 'text'):
-            print(f"API Response text: {response.text[:500]}")
         else:
             print("No API response content available")
 
         raise ValueError(f"Error processing API response: {str(e)}")
 
+def generate_next_clue(story_data, clue_number, revealed_clues, eliminated_characters, timeout=None,
+                       provider=None):
+    """
+    Generate one clue for a game in progress, conditioned on what has happened so far.
+
+    Args:
+        story_data (dict): The story data, with roles already assigned
+        clue_number (int): The 1-based number of the clue to write
+        revealed_clues (list): Clues the players have already seen
+        eliminated_characters (list): Character names of players wrongly eliminated so far
+        timeout (float, optional): Request timeout in seconds, defaults to OPENROUTER_TIMEOUT
+        provider (Provider, optional): Backend to send the prompt to, defaults to OpenRouter
+
+    Returns:
+        str: The clue text
+    """
+    if provider is None:
+        _check_api_key()
+    service = provider.label if provider is not None else "OpenRouter"
+
+    with tracing.span("prompt.build", kind="clue", clue_number=clue_number) as span:
+        prompt = build_clue_prompt(story_data, clue_number, revealed_clues, eliminated_characters)
+        span.set_attribute("prompt_chars", len(prompt))
+    content = None
+
+    try:
+        if provider is None:
+            content = _request_completion(prompt, max_tokens=400, timeout=timeout)
+        else:
+            content = provider.complete(prompt, max_tokens=400, timeout=timeout)
+        clue = extract_json_from_content(content).get("clue")
+
+        if not isinstance(clue, str) or not clue.strip():
+            raise ValueError("Missing required field: clue")
+
+        return clue.strip()
+
+    except requests.exceptions.RequestException as e:
+        print(f"Network error connecting to {service} API: {str(e)}")
+        raise ConnectionError(f"Failed to connect to {service} API: {str(e)}")
+    except (json.JSONDecodeError, ValueError) as e:
+        print(f"Error: {str(e)}")
+        if content is not None:
+            print(f"API Response content: {content[:500]}")
+
+        raise ValueError(f"Error processing API response: {str(e)}")
+
+
+_extraction_total = metrics.counter("mafia_json_extraction_total",
+                                    "Which strategy extracted JSON from a model response", ["strategy"])
+
 def extract_json_from_content(content):
     """
     Extract valid JSON from the API response content using multiple strategies.
@@ -159,9 +385,27 @@ def extract_json_from_content(content):
     Raises:
         ValueError: If no valid JSON could be extracted
     """
+    with tracing.span("json.extract", content_chars=len(content)) as span:
+        data, strategy = _extract_json(content)
+        _extraction_total.inc(strategy=strategy)
+        span.set_attribute("strategy", strategy)
+
+        if data is None:
+            # If we reached here, we couldn't extract valid JSON
+            raise ValueError(f"Couldn't extract valid JSON from the API response. Response: {content.strip()[:200]}...")
+
+        return data
+
+def _extract_json(content):
+    """
+    Try each extraction strategy in turn.
+
+    Returns:
+        tuple: (data, strategy name), or (None, "failed")
+    """
     # Strategy 1: Check if it's already valid JSON
     try:
-        return json.loads(content)
+        return json.loads(content), "direct"
     except json.JSONDecodeError:
         pass
 
@@ -169,7 +413,7 @@ def extract_json_from_content(content):
     json_match = re.search(r'```(?:json)?\s*(.*?)\s*```', content, re.DOTALL)
     if json_match:
         try:
-            return json.loads(json_match.group(1))
+            return json.loads(json_match.group(1)), "code_block"
         except json.JSONDecodeError:
             pass
 
@@ -177,7 +421,7 @@ def extract_json_from_content(content):
     json_match = re.search(r'({[\s\S]*})', content, re.DOTALL)
     if json_match:
         try:
-            return json.loads(json_match.group(1))
+            return json.loads(json_match.group(1)), "braces"
         except json.JSONDecodeError:
             pass
 
@@ -188,24 +432,37 @@ def extract_json_from_content(content):
 
     if start_idx != -1 and end_idx != -1:
         try:
-            return json.loads(content[start_idx:end_idx+1])
+            return json.loads(content[start_idx:end_idx+1]), "trimmed"
         except json.JSONDecodeError:
             pass
 
-    # If we reached here, we couldn't extract valid JSON
-    raise ValueError(f"Couldn't extract valid JSON from the API response. Response: {content[:200]}...")
+    return None, "failed"
 
-def validate_story_data(data, num_players):
+def validate_story_data(data, num_players, num_clues=3):
     """
     Validate that the story data has the expected structure and content.
 
     Args:
         data (dict): The story data to validate
         num_players (int): The number of players in the game
+        num_clues (int): The number of clues the story should contain
 
     Raises:
         ValueError: If the story data is invalid
     """
+    with tracing.span("story.validate", players=num_players, clues=num_clues) as span:
+        repairs = _validate_story_data(data, num_players, num_clues)
+        span.set_attributes(repairs=repairs, repair_count=len(repairs))
+
+def _validate_story_data(data, num_players, num_clues):
+    """
+    Check and repair the story data in place.
+
+    Returns:
+        list: Descriptions of the repairs made, empty if the data was already valid
+    """
+    repairs = []
+
     # Check essential fields
     required_fields = ["main_story", "killed_character_name", "players", "clues"]
     for field in required_fields:
@@ -220,32 +477,42 @@ def validate_story_data(data, num_players):
             last_player = data["players"][-1].copy()
             last_player["character_name"] = f"Extra Character {len(data['players']) + 1}"
 
+            missing = num_players - len(data["players"])
             while len(data["players"]) < num_players:
                 data["players"].append(last_player.copy())
 
-            print(f"Warning: Added {num_players - len(data['players'])} missing players to match required count")
+            repairs.append(f"players_added:{missing}")
+            print(f"Warning: Added {missing} missing players to match required count")
         elif len(data["players"]) > num_players:
             # Truncate extra players
+            repairs.append(f"players_truncated:{len(data['players']) - num_players}")
             data["players"] = data["players"][:num_players]
             print(f"Warning: Truncated player list to match required count of {num_players}")
 
     # Check clues
-    if len(data["clues"]) != 3:
-        if len(data["clues"]) < 3:
+    if len(data["clues"]) != num_clues:
+        if len(data["clues"]) < num_clues:
             # Add generic clues if missing
-            while len(data["clues"]) < 3:
+            repairs.append(f"clues_added:{num_clues - len(data['clues'])}")
+            while len(data["clues"]) < num_clues:
                 data["clues"].append(f"Additional clue {len(data['clues']) + 1} pointing to the killer.")
-            print("Warning: Added missing clues to match required count of 3")
-        elif len(data["clues"]) > 3:
-            # Keep only the first 3 clues
-            data["clues"] = data["clues"][:3]
-            print("Warning: Truncated clues to match required count of 3")
+            print(f"Warning: Added missing clues to match required count of {num_clues}")
+        elif len(data["clues"]) > num_clues:
+            # Keep only the first clues
+            repairs.append(f"clues_truncated:{len(data['clues']) - num_clues}")
+            data["clues"] = data["clues"][:num_clues]
+            print(f"Warning: Truncated clues to match required count of {num_clues}")
 
     # Ensure all players have the required fields
     for i, player in enumerate(data["players"]):
         if "character_name" not in player:
             player["character_name"] = f"Character {i+1}"
+            repairs.append(f"player_{i}_name")
         if "character_description" not in player:
             player["character_description"] = f"A mysterious person connected to the case."
+            repairs.append(f"player_{i}_description")
         if "is_mafia" not in player:
-            player["is_mafia"] = False  # Default to civilian
\ No newline at end of file
+            player["is_mafia"] = False  # Default to civilian
+            repairs.append(f"player_{i}_is_mafia")
+
+    return repairs
\ No newline at end of file
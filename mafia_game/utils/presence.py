@@ -0,0 +1,116 @@
+import os
+import time
+import threading
+
+from . import game_state
+
+# Seconds between heartbeats for each browser session that is still connected. Keep
+# it well under PRESENCE_TIMEOUT so one late beat doesn't take a player offline.
+PRESENCE_HEARTBEAT_INTERVAL = float(os.getenv("PRESENCE_HEARTBEAT_INTERVAL", "15"))
+
+# Streamlit session id -> (room code, player or spectator name)
+_sessions = {}
+_sessions_lock = threading.Lock()
+_heartbeater = None
+_heartbeater_lock = threading.Lock()
+
+
+def _current_session_id():
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+    except ImportError:
+        return None
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else None
+
+
+def _session_manager():
+    # Only meaningful inside `streamlit run`; the runtime API used here is internal
+    try:
+        from streamlit.runtime import Runtime
+    except ImportError:
+        return None
+    if not Runtime.exists():
+        return None
+    return Runtime.instance()._session_mgr
+
+
+def track_session(room_code, name):
+    """
+    Send a heartbeat for the player (or spectator) of the current page run, and keep
+    sending them for as long as their browser stays connected. Streamlit only reruns
+    a page when something happens, so an idle player is kept online by the
+    heartbeater thread rather than by reruns.
+
+    Args:
+        room_code (str): The room code, or None once the session has left its room
+        name (str): The player or spectator name
+
+    Returns:
+        bool: True if the heartbeat was recorded
+    """
+    session_id = _current_session_id()
+    if session_id is not None:
+        with _sessions_lock:
+            if room_code and name:
+                _sessions[session_id] = (room_code, name)
+            else:
+                _sessions.pop(session_id, None)
+    if not (room_code and name):
+        return False
+    return game_state.heartbeat(room_code, name)
+
+
+def beat_connected_sessions():
+    """
+    Send a heartbeat for every tracked session that is still connected, and forget
+    sessions that disconnected or whose room is gone.
+
+    Returns:
+        int: Number of heartbeats sent
+    """
+    session_manager = _session_manager()
+    with _sessions_lock:
+        sessions = list(_sessions.items())
+
+    sent = 0
+    for session_id, member in sessions:
+        connected = session_manager is None or session_manager.is_active_session(session_id)
+        if connected and game_state.heartbeat(*member):
+            sent += 1
+            continue
+        with _sessions_lock:
+            # The session may have moved to another room in the meantime
+            if _sessions.get(session_id) == member:
+                del _sessions[session_id]
+    return sent
+
+
+def _beat(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            beat_connected_sessions()
+        except Exception as e:
+            print(f"Error sending presence heartbeats: {str(e)}")
+
+
+def start_heartbeats(interval=None):
+    """
+    Start the heartbeater thread. Safe to call on every Streamlit rerun; only the
+    first call starts the thread.
+
+    Args:
+        interval (float, optional): Seconds between heartbeats, defaults to PRESENCE_HEARTBEAT_INTERVAL
+
+    Returns:
+        bool: True if the heartbeater is running
+    """
+    global _heartbeater
+
+    with _heartbeater_lock:
+        if _heartbeater is None:
+            _heartbeater = threading.Thread(target=_beat, args=(interval or PRESENCE_HEARTBEAT_INTERVAL,),
+                                            name="presence-heartbeats", daemon=True)
+            _heartbeater.start()
+        return True
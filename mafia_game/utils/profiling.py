@@ -0,0 +1,359 @@
+import os
+import sys
+import time
+import atexit
+import pstats
+import cProfile
+import functools
+import threading
+from collections import Counter
+
+# Operator-toggled profiler for Streamlit reruns and GameState calls. Off by default;
+# set MAFIA_PROFILE to start it with the process, or switch it at runtime through
+# POST /profile on the room API (see http_api.py).
+#   sampling - a background thread samples the stacks of threads inside a profiled
+#              scope; low overhead and produces collapsed stacks for flamegraphs
+#   cprofile - every profiled scope runs under cProfile; exact call counts, higher overhead
+MAFIA_PROFILE = os.getenv("MAFIA_PROFILE", "").strip().lower()
+MAFIA_PROFILE_INTERVAL = float(os.getenv("MAFIA_PROFILE_INTERVAL", "0.005"))  # Seconds between samples
+MAFIA_PROFILE_OUTPUT = os.getenv("MAFIA_PROFILE_OUTPUT", "")  # Write collapsed stacks here at exit
+
+MODES = ("sampling", "cprofile")
+
+_APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _short_path(filename):
+    if filename.startswith(_APP_ROOT):
+        return os.path.relpath(filename, _APP_ROOT)
+    marker = "site-packages" + os.sep
+    if marker in filename:
+        return filename.split(marker, 1)[1]
+    return os.path.basename(filename)
+
+
+def _format_function(filename, lineno, name):
+    # Names end up in collapsed stacks, where ';' separates frames
+    if filename == "~":
+        return name.replace(";", ",")  # Builtins as reported by cProfile
+    return f"{name} ({_short_path(filename)}:{lineno})".replace(";", ",")
+
+
+class Profiler:
+    """
+    Aggregates profiles of the outermost profiled scope on each thread, across all
+    sessions, until reset. A GameState call made from inside a profiled main() rerun
+    is part of that rerun's profile rather than a scope of its own.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.mode = None
+        self.interval = MAFIA_PROFILE_INTERVAL
+        self.started = None
+        self._active = {}  # thread id -> (scope label, scope frame)
+        self._sampler = None
+        self._reset_data()
+
+    def _reset_data(self):
+        self._scopes = {}  # label -> [calls, total seconds]
+        self._stacks = Counter()  # (label, frame, ...) root first -> samples
+        self._samples = 0
+        self._stats = None  # pstats.Stats merged from every cProfile run
+        self._skipped = 0
+        self._code_names = {}
+
+    def is_enabled(self):
+        return self.mode is not None
+
+    def start(self, mode="sampling", interval=None):
+        """
+        Start (or switch) profiling. Data collected so far is kept.
+
+        Args:
+            mode (str): "sampling" or "cprofile"
+            interval (float, optional): Seconds between samples in sampling mode
+
+        Returns:
+            bool: True if profiling is now running in the given mode
+        """
+        if mode not in MODES:
+            print(f"Unknown profiling mode '{mode}', expected one of {', '.join(MODES)}")
+            return False
+
+        self.stop()
+        with self._lock:
+            self.mode = mode
+            self.interval = interval or self.interval
+            self.started = time.time()
+            if mode == "sampling":
+                stop_event = threading.Event()
+                thread = threading.Thread(target=self._sample_loop, args=(stop_event,),
+                                          name="profile-sampler", daemon=True)
+                self._sampler = (thread, stop_event)
+                thread.start()
+        print(f"Profiling started ({mode})")
+        return True
+
+    def stop(self):
+        """
+        Stop profiling, keeping the collected data for reports.
+        """
+        with self._lock:
+            mode, self.mode = self.mode, None
+            sampler, self._sampler = self._sampler, None
+        if sampler is not None:
+            sampler[1].set()
+            sampler[0].join()
+        if mode is not None:
+            print(f"Profiling stopped ({mode})")
+
+    def reset(self):
+        with self._lock:
+            self._reset_data()
+            if self.mode is not None:
+                self.started = time.time()
+
+    def run(self, label, fn, *args, **kwargs):
+        """
+        Call fn as a profiled scope. Without profiling, or when the thread is already
+        inside a profiled scope, this is a plain call.
+
+        Args:
+            label (str): Scope name, e.g. "app.main" or "GameState.join_game_room"
+            fn (callable): The function to call
+
+        Returns:
+            The result of fn
+        """
+        mode = self.mode
+        thread_id = threading.get_ident()
+        if mode is None or thread_id in self._active:
+            return fn(*args, **kwargs)
+
+        profile = None
+        if mode == "cprofile":
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler owns the interpreter (sys.monitoring on 3.12+)
+                self._skipped += 1
+                return fn(*args, **kwargs)
+
+        self._active[thread_id] = (label, sys._getframe())
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            del self._active[thread_id]
+            if profile is not None:
+                profile.disable()
+            self._record_scope(label, elapsed, profile)
+
+    def _record_scope(self, label, elapsed, profile):
+        # Build the stats outside the lock; it is the expensive part
+        stats = pstats.Stats(profile) if profile is not None else None
+        with self._lock:
+            scope = self._scopes.get(label)
+            if scope is None:
+                scope = self._scopes[label] = [0, 0.0]
+            scope[0] += 1
+            scope[1] += elapsed
+            if stats is not None:
+                if self._stats is None:
+                    self._stats = stats
+                else:
+                    self._stats.add(stats)
+
+    def _frame_name(self, code):
+        name = self._code_names.get(code)
+        if name is None:
+            name = self._code_names[code] = _format_function(
+                code.co_filename, code.co_firstlineno, getattr(code, "co_qualname", code.co_name))
+        return name
+
+    def _sample_loop(self, stop_event):
+        while not stop_event.wait(self.interval):
+            active = list(self._active.items())
+            if not active:
+                continue
+
+            frames = sys._current_frames()
+            stacks = []
+            for thread_id, (label, scope_frame) in active:
+                frame = frames.get(thread_id)
+                names = []
+                # Walk from the leaf up to the scope's run() frame
+                while frame is not None and frame is not scope_frame:
+                    names.append(self._frame_name(frame.f_code))
+                    frame = frame.f_back
+                if frame is None:
+                    continue  # The scope ended between the two snapshots
+                names.append(label)
+                names.reverse()
+                stacks.append(tuple(names))
+
+            with self._lock:
+                for stack in stacks:
+                    self._stacks[stack] += 1
+                self._samples += len(stacks)
+
+    def get_collapsed_stacks(self):
+        """
+        Get the sampled stacks in the collapsed format read by flamegraph.pl and
+        speedscope: one "scope;outer;...;leaf count" line per distinct stack.
+
+        Returns:
+            str: Collapsed stacks, empty if nothing was sampled
+        """
+        with self._lock:
+            stacks = sorted(self._stacks.items())
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in stacks)
+
+    def _sampled_functions(self, stacks, limit):
+        cumulative = Counter()
+        own = Counter()
+        for stack, count in stacks.items():
+            # Count recursive frames once per sample
+            for name in set(stack[1:]):
+                cumulative[name] += count
+            if len(stack) > 1:
+                own[stack[-1]] += count
+
+        return [{"function": name,
+                 "cumulative_seconds": round(count * self.interval, 4),
+                 "self_seconds": round(own[name] * self.interval, 4),
+                 "samples": count}
+                for name, count in cumulative.most_common(limit)]
+
+    def _profiled_functions(self, stats, limit):
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+        return [{"function": _format_function(*key),
+                 "cumulative_seconds": round(ct, 4),
+                 "self_seconds": round(tt, 4),
+                 "calls": nc}
+                for key, (cc, nc, tt, ct, callers) in rows]
+
+    def get_report(self, limit=40):
+        """
+        Get per-scope timings and the functions with the most cumulative time.
+
+        Args:
+            limit (int): Maximum number of functions per list
+
+        Returns:
+            dict: Profiler status, scopes and functions
+        """
+        with self._lock:
+            scopes = {label: list(values) for label, values in self._scopes.items()}
+            stacks = Counter(self._stacks)
+            stats = self._stats
+            report = {
+                "mode": self.mode or "off",
+                "interval": self.interval,
+                "since": self.started,
+                "samples": self._samples,
+                "skipped": self._skipped,
+            }
+
+            # Sampled and cProfile data are reported separately; they aren't comparable
+            report["cprofile_functions"] = self._profiled_functions(stats, limit) if stats is not None else []
+
+        report["scopes"] = {
+            label: {"calls": calls, "total_seconds": round(total, 4),
+                    "mean_ms": round(total / calls * 1000, 3) if calls else 0.0}
+            for label, (calls, total) in sorted(scopes.items(), key=lambda item: item[1][1], reverse=True)
+        }
+        report["sampled_functions"] = self._sampled_functions(stacks, limit)
+        return report
+
+    def dump_collapsed_stacks(self, path):
+        """
+        Write the collapsed stacks to a file.
+
+        Args:
+            path (str): Output file
+
+        Returns:
+            int: Number of distinct stacks written
+        """
+        collapsed = self.get_collapsed_stacks()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(collapsed)
+        return collapsed.count("\n")
+
+
+# Create a singleton instance
+_profiler = Profiler()
+
+
+def profiled(method):
+    """
+    Decorator that makes each call of method a profiled scope named after its
+    qualified name. Costs one attribute check while profiling is off.
+    """
+    label = method.__qualname__
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if _profiler.mode is None:
+            return method(*args, **kwargs)
+        return _profiler.run(label, method, *args, **kwargs)
+
+    return wrapper
+
+
+def get_profiler():
+    """
+    Returns:
+        Profiler: The process-wide profiler, for hot paths that check its mode
+                  themselves rather than adding a profiled wrapper
+    """
+    return _profiler
+
+
+def run(label, fn, *args, **kwargs):
+    return _profiler.run(label, fn, *args, **kwargs)
+
+
+def start(mode="sampling", interval=None):
+    return _profiler.start(mode, interval)
+
+
+def stop():
+    return _profiler.stop()
+
+
+def reset():
+    return _profiler.reset()
+
+
+def is_enabled():
+    return _profiler.is_enabled()
+
+
+def get_report(limit=40):
+    return _profiler.get_report(limit)
+
+
+def get_collapsed_stacks():
+    return _profiler.get_collapsed_stacks()
+
+
+def dump_collapsed_stacks(path):
+    return _profiler.dump_collapsed_stacks(path)
+
+
+def _dump_at_exit():
+    if MAFIA_PROFILE_OUTPUT:
+        count = dump_collapsed_stacks(MAFIA_PROFILE_OUTPUT)
+        print(f"Wrote {count} collapsed stacks to {MAFIA_PROFILE_OUTPUT}")
+
+
+if MAFIA_PROFILE in MODES:
+    start(MAFIA_PROFILE)
+elif MAFIA_PROFILE not in ("", "0", "false", "off", "no"):
+    print(f"Unknown MAFIA_PROFILE '{MAFIA_PROFILE}', expected one of {', '.join(MODES)}")
+
+atexit.register(_dump_at_exit)
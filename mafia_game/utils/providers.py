@@ -0,0 +1,257 @@
+import os
+import time
+import threading
+
+from . import openrouter, tracing
+
+# Which backend writes stories and clues:
+#   openrouter - the OpenRouter API (default)
+#   local      - an OpenAI-compatible server on this machine, e.g. llama.cpp's server
+#   auto       - every available backend, fastest first by recorded latency
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "openrouter").strip().lower()
+
+LOCAL_LLM_BASE_URL = os.getenv("LOCAL_LLM_BASE_URL", "http://localhost:8080/v1/chat/completions")
+LOCAL_LLM_MODEL = os.getenv("LOCAL_LLM_MODEL", "local")
+LOCAL_LLM_API_KEY = os.getenv("LOCAL_LLM_API_KEY", "")
+LOCAL_LLM_TIMEOUT = float(os.getenv("LOCAL_LLM_TIMEOUT", "180"))  # CPU inference is slow
+LOCAL_LLM_MAX_RETRIES = int(os.getenv("LOCAL_LLM_MAX_RETRIES", "1"))
+
+LATENCY_SMOOTHING = 0.3  # Weight of the newest sample in the latency moving average
+FAILURE_COOLDOWN = 30.0  # Seconds to skip a provider after a failed request
+
+
+class Provider:
+    """
+    A chat completions backend with recorded latency.
+
+    Latency is kept as an exponentially weighted moving average per max_tokens value,
+    so short clue requests and long story requests are compared like for like. A
+    failed request counts toward the average when it took longer than the average, so
+    failures never make a provider look faster. In auto mode, a provider whose request
+    fails for any reason is skipped for FAILURE_COOLDOWN seconds.
+    """
+    name = None
+    label = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latency = {}  # max_tokens -> moving average in seconds
+        self._failed_sizes = set()  # max_tokens values that have failed without a success
+        self._cooldown_until = 0.0
+        self.requests = 0
+        self.failures = 0
+
+    def is_configured(self):
+        return True
+
+    def is_available(self):
+        return self.is_configured() and time.monotonic() >= self._cooldown_until
+
+    def get_latency(self, max_tokens):
+        """
+        Get the moving average latency for requests of this size.
+
+        Returns:
+            float: Seconds, or None if no request of this size has succeeded yet
+        """
+        with self._lock:
+            return self._latency.get(max_tokens)
+
+    def has_only_failed(self, max_tokens):
+        """
+        Returns:
+            bool: True if requests of this size have failed and none has succeeded yet
+        """
+        with self._lock:
+            return max_tokens in self._failed_sizes
+
+    def _record_latency(self, max_tokens, elapsed):
+        # Must be called with self._lock held
+        previous = self._latency.get(max_tokens)
+        self._latency[max_tokens] = elapsed if previous is None else (
+            LATENCY_SMOOTHING * elapsed + (1 - LATENCY_SMOOTHING) * previous)
+
+    def complete(self, prompt, max_tokens, timeout=None):
+        """
+        Send a prompt and return the completion content, recording the latency.
+
+        Raises:
+            requests.exceptions.RequestException: On network errors
+            ValueError: On HTTP errors or an unexpected response structure
+        """
+        start = time.monotonic()
+        try:
+            with tracing.span("llm.complete", provider=self.name, max_tokens=max_tokens):
+                content = self._complete(prompt, max_tokens, timeout)
+        except Exception:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                self.requests += 1
+                self.failures += 1
+                self._cooldown_until = time.monotonic() + FAILURE_COOLDOWN
+                previous = self._latency.get(max_tokens)
+                if previous is None:
+                    self._failed_sizes.add(max_tokens)
+                elif elapsed > previous:
+                    # The time a failure wasted counts; a quick error doesn't make it faster
+                    self._record_latency(max_tokens, elapsed)
+            raise
+
+        elapsed = time.monotonic() - start
+        with self._lock:
+            self.requests += 1
+            self._failed_sizes.discard(max_tokens)
+            self._record_latency(max_tokens, elapsed)
+        return content
+
+    def _complete(self, prompt, max_tokens, timeout):
+        raise NotImplementedError
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "available": self.is_available(),
+                "requests": self.requests,
+                "failures": self.failures,
+                "latency_seconds": {str(k): round(v, 3) for k, v in sorted(self._latency.items())},
+            }
+
+
+class OpenRouterProvider(Provider):
+    name = "openrouter"
+    label = "OpenRouter"
+
+    def is_configured(self):
+        key = openrouter.OPENROUTER_API_KEY
+        return bool(key and key.strip())
+
+    def _complete(self, prompt, max_tokens, timeout):
+        openrouter._check_api_key()
+        return openrouter._request_completion(prompt, max_tokens, timeout=timeout)
+
+
+class LocalProvider(Provider):
+    """
+    An OpenAI-compatible server on this machine, such as `llama-server` from llama.cpp.
+    No WAN round trip and no quota, at the cost of CPU inference speed.
+    """
+    name = "local"
+    label = "Local LLM"
+
+    def _complete(self, prompt, max_tokens, timeout):
+        return openrouter._request_completion(prompt, max_tokens,
+                                              timeout=timeout or LOCAL_LLM_TIMEOUT,
+                                              base_url=LOCAL_LLM_BASE_URL,
+                                              api_key=LOCAL_LLM_API_KEY,
+                                              model=LOCAL_LLM_MODEL,
+                                              max_retries=LOCAL_LLM_MAX_RETRIES,
+                                              service=self.label)
+
+
+_providers = {p.name: p for p in (OpenRouterProvider(), LocalProvider())}
+
+
+def get_providers(max_tokens=2000):
+    """
+    Get the providers to try, in order, for a request of the given size.
+
+    In auto mode, providers that haven't been tried at this size come first so each
+    one gets measured, then the measured ones from fastest to slowest, then those
+    that have only failed at this size. Providers cooling down after a failure are
+    left out.
+
+    Args:
+        max_tokens (int): Size of the request, used to pick comparable latency samples
+
+    Returns:
+        list: Available providers in the order to try them
+    """
+    if LLM_PROVIDER != "auto":
+        provider = _providers.get(LLM_PROVIDER)
+        if provider is None:
+            print(f"Unknown LLM_PROVIDER '{LLM_PROVIDER}', using openrouter")
+            provider = _providers["openrouter"]
+        # A single configured backend is always tried; the cooldown only steers auto mode
+        return [provider] if provider.is_configured() else []
+
+    def sort_key(provider):
+        latency = provider.get_latency(max_tokens)
+        if latency is not None:
+            return (1, latency)
+        return (2 if provider.has_only_failed(max_tokens) else 0, 0.0)
+
+    return sorted((p for p in _providers.values() if p.is_available()), key=sort_key)
+
+
+def has_available_provider():
+    """
+    Check whether any configured provider can take a request right now.
+
+    Returns:
+        bool: True if at least one provider is available
+    """
+    return bool(get_providers())
+
+
+def get_provider_stats():
+    """
+    Get request counts and latency averages for every provider.
+
+    Returns:
+        dict: The routing mode and per-provider stats
+    """
+    return {"mode": LLM_PROVIDER, "providers": [p.get_stats() for p in _providers.values()]}
+
+
+def _call_in_order(max_tokens, timeout, call):
+    """
+    Run call(provider, timeout) on each provider in turn until one succeeds.
+    Later providers get whatever is left of the timeout.
+    """
+    providers = get_providers(max_tokens)
+    if not providers:
+        raise ValueError("No story generation provider is available")
+
+    deadline = time.monotonic() + timeout if timeout else None
+    last_error = None
+    for provider in providers:
+        remaining = deadline - time.monotonic() if deadline else None
+        if remaining is not None and remaining <= 0:
+            break
+        try:
+            return call(provider, remaining)
+        except (ConnectionError, ValueError) as e:
+            print(f"{provider.label} failed: {str(e)}")
+            last_error = e
+
+    raise last_error or TimeoutError("No provider answered before the timeout")
+
+
+def generate_story(num_players, timeout=None, lazy_clues=False):
+    """
+    Generate a story with the configured provider(s). Same prompt, extraction and
+    validation as openrouter.generate_mafia_story.
+
+    Args:
+        num_players (int): Number of players in the game
+        timeout (float, optional): Overall time budget in seconds
+        lazy_clues (bool): Only generate the first clue
+
+    Returns:
+        dict: The validated story data
+    """
+    return _call_in_order(2000, timeout, lambda provider, remaining: openrouter.generate_mafia_story(
+        num_players, timeout=remaining, lazy_clues=lazy_clues, provider=provider))
+
+
+def generate_clue(story_data, clue_number, revealed_clues, eliminated_characters, timeout=None):
+    """
+    Generate one in-game clue with the configured provider(s).
+
+    Returns:
+        str: The clue text
+    """
+    return _call_in_order(400, timeout, lambda provider, remaining: openrouter.generate_next_clue(
+        story_data, clue_number, revealed_clues, eliminated_characters,
+        timeout=remaining, provider=provider))
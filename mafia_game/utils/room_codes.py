@@ -0,0 +1,144 @@
+import os
+import json
+import hashlib
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: cross-process reservation is unavailable
+    fcntl = None
+
+# 32 symbols without look-alikes (no I, O, 0, 1), so 6 symbols cover exactly 2**30 codes
+ALPHABET = 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789'
+CODE_LENGTH = 6
+CODE_BITS = 30
+CODE_SPACE = 1 << CODE_BITS
+HALF_BITS = CODE_BITS // 2
+HALF_MASK = (1 << HALF_BITS) - 1
+FEISTEL_ROUNDS = 4
+
+
+class RoomCodeAllocator:
+    """
+    Allocates room codes in O(1) at any occupancy.
+
+    Codes are produced by pushing a counter through a keyed Feistel permutation of
+    the 30-bit code space, so every counter value maps to a distinct code and the
+    sequence can't be predicted without the secret. Counter values are handed out
+    in blocks. When a state file is configured, blocks are reserved from it under
+    an exclusive file lock, so several worker processes sharing the file (and the
+    secret stored in it) never hand out the same code.
+
+    A code freed by cleanup_stale_rooms is not reused until the counter wraps around
+    after 2**30 allocations. Codes that are still in use at that point are skipped.
+    """
+    def __init__(self, secret=None, state_path=None, block_size=256):
+        self.state_path = state_path if fcntl is not None else None
+        self.block_size = max(1, int(block_size))
+        self._lock = threading.Lock()
+        self._next = 0
+        self._block_end = 0
+
+        if state_path and fcntl is None:
+            print("Warning: file locking unavailable, room codes are reserved per process only")
+
+        if secret is None and self.state_path:
+            secret = self._update_state(self._ensure_secret)
+        if secret is None:
+            secret = os.urandom(32).hex()
+
+        self._key = hashlib.blake2b(str(secret).encode("utf-8"), digest_size=32).digest()
+        # Without a shared state file, start at a random point in the sequence
+        self._memory_counter = int.from_bytes(os.urandom(4), "big") % CODE_SPACE
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build an allocator from ROOM_CODE_SECRET, ROOM_CODE_STATE_FILE and ROOM_CODE_BLOCK_SIZE.
+
+        Returns:
+            RoomCodeAllocator: The configured allocator
+        """
+        return cls(secret=os.getenv("ROOM_CODE_SECRET") or None,
+                   state_path=os.getenv("ROOM_CODE_STATE_FILE") or None,
+                   block_size=int(os.getenv("ROOM_CODE_BLOCK_SIZE", "256")))
+
+    def allocate(self, in_use=()):
+        """
+        Allocate the next room code.
+
+        Args:
+            in_use (container): Codes that are currently taken; only consulted to skip
+                                live codes after the counter wraps around
+
+        Returns:
+            str: A 6-character room code
+        """
+        with self._lock:
+            while True:
+                if self._next >= self._block_end:
+                    self._next, self._block_end = self._reserve_block()
+
+                counter = self._next % CODE_SPACE
+                self._next += 1
+
+                code = self._encode(self._permute(counter))
+                if code not in in_use:
+                    return code
+
+    def _reserve_block(self):
+        if not self.state_path:
+            start = self._memory_counter
+            self._memory_counter += self.block_size
+            return start, start + self.block_size
+
+        def take_block(state):
+            start = state.get("next", 0)
+            state["next"] = start + self.block_size
+            return start
+
+        start = self._update_state(take_block)
+        return start, start + self.block_size
+
+    def _ensure_secret(self, state):
+        if not state.get("secret"):
+            state["secret"] = os.urandom(32).hex()
+        return state["secret"]
+
+    def _update_state(self, fn):
+        """
+        Read-modify-write the shared state file under an exclusive lock.
+        """
+        fd = os.open(self.state_path, os.O_RDWR | os.O_CREAT, 0o600)
+        with os.fdopen(fd, "r+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                raw = f.read()
+                state = json.loads(raw) if raw.strip() else {}
+                result = fn(state)
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+                os.fsync(f.fileno())
+                return result
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _round(self, round_idx, value):
+        digest = hashlib.blake2b(bytes([round_idx]) + value.to_bytes(2, "big"),
+                                 key=self._key, digest_size=4).digest()
+        return int.from_bytes(digest, "big") & HALF_MASK
+
+    def _permute(self, value):
+        left, right = value >> HALF_BITS, value & HALF_MASK
+        for round_idx in range(FEISTEL_ROUNDS):
+            left, right = right, left ^ self._round(round_idx, right)
+        return (left << HALF_BITS) | right
+
+    def _encode(self, value):
+        chars = []
+        for _ in range(CODE_LENGTH):
+            chars.append(ALPHABET[value & 31])
+            value >>= 5
+        return ''.join(chars)
@@ -0,0 +1,98 @@
+import os
+from urllib.parse import quote
+
+import streamlit.components.v1 as components
+
+from . import http_api
+
+# Public address of the room feed (see MAFIA_FEED_HOST and MAFIA_FEED_PORT in
+# utils/http_api.py). Leave it empty to reach the feed's port on the host the page
+# was loaded from. Set it when the feed is behind a proxy, for example to serve it
+# over HTTPS from the app's own origin. Only the read-only feed is served there,
+# never the room API.
+MAFIA_FEED_URL = os.getenv("MAFIA_FEED_URL", "")
+
+# Seconds between reruns while a browser's feed connection is failing (0 disables)
+FEED_FALLBACK_INTERVAL = float(os.getenv("FEED_FALLBACK_INTERVAL", "5"))
+
+_COMPONENTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "components")
+
+_component = components.declare_component("room_feed", path=os.path.join(_COMPONENTS_DIR, "room_feed"))
+_chat_component = components.declare_component("chat_log", path=os.path.join(_COMPONENTS_DIR, "chat_log"))
+
+
+def get_feed_path(room_code):
+    """
+    Returns:
+        str: Path of a room's event feed, relative to the feed's address
+    """
+    return f"/rooms/{quote(room_code)}/events"
+
+
+def get_chat_feed_path(room_code):
+    """
+    Returns:
+        str: Path of a room's chat feed, relative to the feed's address
+    """
+    return f"/rooms/{quote(room_code)}/chat/events"
+
+
+def _feed_address(path):
+    """
+    Returns:
+        tuple: (url, port) for the browser to reach path on: the full URL if
+               MAFIA_FEED_URL is set, else the feed listener's port (None if disabled)
+    """
+    url = MAFIA_FEED_URL.rstrip("/") + path if MAFIA_FEED_URL and path else None
+    # Already running after the app's first run; None if the feed is disabled
+    feed_server = http_api.start_feed_server()
+    port = feed_server.server_address[1] if feed_server else None
+    return url, port
+
+
+def follow_room(room_code, version, css=None, key="room_feed"):
+    """
+    Render the room feed component. It holds one connection to the room's event
+    feed and reruns the app when the room's version passes the given one, so pages
+    don't have to poll. It takes no space on the page. Render it on every run with
+    the same key, so the browser keeps the connection across reruns.
+
+    Args:
+        room_code (str): The room to follow, or None outside a room
+        version (int): The room version this run shows
+        css (str, optional): Styles to add to the page; they stay until the page is
+                             reloaded, so only the first run of a session needs to pass them
+        key (str): Streamlit widget key
+
+    Returns:
+        dict: What triggered the rerun ("version", "poll" or "gone"), or None
+    """
+    path = get_feed_path(room_code) if room_code else None
+    url, port = _feed_address(path)
+    return _component(room=room_code, url=url, port=port, path=path, version=version, css=css,
+                      fallback_interval=FEED_FALLBACK_INTERVAL, key=key, default=None)
+
+
+def chat_log(room_code, player_name=None, messages=None, height=300, key="chat_log"):
+    """
+    Render a room's chat log. The browser streams the room's chat feed and appends
+    each message as it is posted, so chat never reruns the app and a run sends no
+    messages at all. Render it on every run with the same key, so the browser keeps
+    the connection and the messages it has shown.
+
+    Args:
+        room_code (str): The room whose chat to show
+        player_name (str, optional): The player viewing, whose messages are marked
+        messages (list, optional): Messages to show instead of streaming them. Only
+                                   pass them once the component has asked for them
+        height (int): Height of the log in pixels
+        key (str): Streamlit widget key
+
+    Returns:
+        dict: {"fallback": True} once the browser has failed to reach the chat feed,
+              and from then on for the rest of the session, or None
+    """
+    path = get_chat_feed_path(room_code)
+    url, port = _feed_address(path)
+    return _chat_component(room=room_code, url=url, port=port, path=path, player=player_name,
+                           messages=messages, height=height, key=key, default=None)
@@ -0,0 +1,201 @@
+import heapq
+import itertools
+import threading
+import time
+import traceback
+import contextvars
+from collections import deque
+
+from . import tracing
+
+# Lower numbers are served first
+PRIORITY_INTERACTIVE = 0  # A room full of players is waiting on the result
+PRIORITY_BACKGROUND = 1   # In-game work that is needed soon (e.g. the next clue)
+PRIORITY_PREFETCH = 2     # Pool refills and speculative prefetch
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_BACKGROUND: "background",
+    PRIORITY_PREFETCH: "prefetch",
+}
+
+
+class GenerationJob:
+    """
+    A unit of work queued on the scheduler.
+    """
+    def __init__(self, key, fn, args, priority, deadline, on_expired):
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.priority = priority
+        self.deadline = deadline  # time.monotonic() value, or None for no deadline
+        self.on_expired = on_expired
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.cancelled = False
+        self.done = threading.Event()
+        # Run with the submitter's context so tracing spans (and any other context
+        # variables) carry over to the worker thread
+        self.context = contextvars.copy_context()
+
+    def remaining(self):
+        """
+        Seconds left before the job's deadline, or None if it has none.
+        """
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+
+class GenerationScheduler:
+    """
+    Priority queue of generation jobs served by a fixed number of worker threads.
+    Jobs with the same key are deduplicated while one is queued or running.
+    """
+    def __init__(self, workers=4, wait_samples=512):
+        self.workers = max(1, int(workers))
+        self._heap = []
+        self._jobs = {}  # key -> queued or running job
+        self._sequence = itertools.count()  # FIFO order within a priority
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._threads = []
+        self._running = 0
+        self._counters = {"submitted": 0, "deduplicated": 0, "completed": 0,
+                          "failed": 0, "expired": 0, "cancelled": 0}
+        # Recent queue wait times per priority, for latency percentiles
+        self._wait_times = {p: deque(maxlen=wait_samples) for p in PRIORITY_NAMES}
+
+    def _ensure_workers(self):
+        # Workers are started lazily so importing the module has no side effects
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker_loop,
+                                      name=f"story-gen-{len(self._threads)}", daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def submit(self, key, fn, args=(), priority=PRIORITY_BACKGROUND, deadline=None, on_expired=None):
+        """
+        Queue a job, or return the existing one if a job with the same key is pending.
+
+        Args:
+            key (str): Deduplication key, e.g. "start:ABC123"
+            fn (function): Function to run on a worker thread
+            args (tuple): Positional arguments for fn
+            priority (int): One of the PRIORITY_* constants
+            deadline (float, optional): time.monotonic() value after which the job has expired
+            on_expired (function, optional): Called with the same args instead of fn when the
+                                             job is dequeued after its deadline
+
+        Returns:
+            GenerationJob: The queued (or already pending) job
+        """
+        with self._lock:
+            existing = self._jobs.get(key)
+            if existing is not None and not existing.cancelled:
+                self._counters["deduplicated"] += 1
+                return existing
+
+            job = GenerationJob(key, fn, args, priority, deadline, on_expired)
+            self._jobs[key] = job
+            heapq.heappush(self._heap, (priority, next(self._sequence), job))
+            self._counters["submitted"] += 1
+            self._ensure_workers()
+            self._not_empty.notify()
+            return job
+
+    def cancel(self, key):
+        """
+        Cancel a queued job. Jobs that have already started run to completion.
+
+        Args:
+            key (str): The job's deduplication key
+
+        Returns:
+            bool: True if a queued job was cancelled
+        """
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None or job.started_at is not None:
+                return False
+
+            # Leave the heap entry in place; workers skip cancelled jobs
+            job.cancelled = True
+            del self._jobs[key]
+            self._counters["cancelled"] += 1
+            return True
+
+    def get_metrics(self):
+        """
+        Get queue depth and throughput counters.
+
+        Returns:
+            dict: Scheduler metrics
+        """
+        with self._lock:
+            depth = {name: 0 for name in PRIORITY_NAMES.values()}
+            for priority, _, job in self._heap:
+                if not job.cancelled:
+                    depth[PRIORITY_NAMES.get(priority, str(priority))] += 1
+
+            wait_p95 = {}
+            for priority, samples in self._wait_times.items():
+                ordered = sorted(samples)
+                wait_p95[PRIORITY_NAMES[priority]] = (
+                    ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] if ordered else 0.0
+                )
+
+            metrics = dict(self._counters)
+            metrics.update({
+                "workers": self.workers,
+                "running": self._running,
+                "queue_depth": sum(depth.values()),
+                "queue_depth_by_priority": depth,
+                "queue_wait_p95_seconds": wait_p95,
+            })
+            return metrics
+
+    def _next_job(self):
+        with self._lock:
+            while True:
+                while not self._heap:
+                    self._not_empty.wait()
+
+                _, _, job = heapq.heappop(self._heap)
+                if job.cancelled:
+                    continue
+
+                job.started_at = time.monotonic()
+                self._running += 1
+                if job.priority in self._wait_times:
+                    self._wait_times[job.priority].append(job.started_at - job.submitted_at)
+                return job
+
+    def _worker_loop(self):
+        while True:
+            job = self._next_job()
+            outcome = "completed"
+            try:
+                job.context.run(tracing.record_span, "scheduler.queue_wait",
+                                job.started_at - job.submitted_at, job_key=job.key,
+                                priority=PRIORITY_NAMES.get(job.priority, str(job.priority)))
+
+                remaining = job.remaining()
+                if remaining is not None and remaining <= 0:
+                    outcome = "expired"
+                    if job.on_expired is not None:
+                        job.context.run(job.on_expired, *job.args)
+                else:
+                    job.context.run(job.fn, *job.args)
+            except Exception as e:
+                outcome = "failed"
+                print(f"Error in generation job {job.key}: {e}")
+                print(traceback.format_exc())
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._counters[outcome] += 1
+                    if self._jobs.get(job.key) is job:
+                        del self._jobs[job.key]
+                job.done.set()
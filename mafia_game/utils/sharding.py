@@ -0,0 +1,593 @@
+import os
+import sys
+import json
+import time
+import zlib
+import signal
+import atexit
+import itertools
+import threading
+import subprocess
+from types import MappingProxyType
+from concurrent.futures import Future
+from multiprocessing.connection import Listener, Client
+
+from . import game_state
+from .event_bus import EventBus
+from .event_log import EVENT_LOG_DIR
+from .room_codes import RoomCodeAllocator
+
+# Rooms never interact, so they can be split across processes, each with its own GIL.
+# ShardRouter stands in for the GameState singleton when GAME_SHARDS > 1: calls about
+# a room are pickled over a pipe to the worker process that owns it, chosen by a hash
+# of the room code, and calls about every room are sent to all workers and merged.
+# Each worker is a fresh interpreter running this module, with GAME_SHARDS unset and
+# its own EVENT_LOG_DIR, so its game_state singleton is an ordinary GameState.
+
+_APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Calls that can park in the worker; they run on their own thread there so the
+# worker keeps serving other calls meanwhile
+BLOCKING_METHODS = ("wait_for_change", "wait_for_messages", "flush_events", "flush_event_log",
+                    "get_room_history")
+
+MAX_CREATE_ATTEMPTS = 10
+SHARD_START_TIMEOUT = 30.0
+
+
+def shard_index(room_code, shard_count):
+    """
+    Pick the shard that owns a room. Stable across processes and restarts, unlike hash().
+
+    Args:
+        room_code (str): The room code
+        shard_count (int): Number of shards
+
+    Returns:
+        int: Shard index
+    """
+    return zlib.crc32(room_code.encode("utf-8")) % shard_count
+
+
+def _serve_shard(index, conn):
+    """
+    Worker process main loop: execute the router's calls on this process's GameState.
+    """
+    # Ctrl+C reaches the whole process group; let the router decide when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    state = game_state._instance
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    def execute(call_id, method, args):
+        try:
+            value = getattr(state, method)(*args)
+            if isinstance(value, MappingProxyType):
+                # Private views are read-only proxies, which can't be pickled
+                value = game_state.FrozenDict(value)
+            result = ("result", call_id, value)
+        except Exception as e:
+            result = ("error", call_id, e)
+        try:
+            send(result)
+        except Exception as e:
+            # e.g. an exception that can't be pickled
+            send(("error", call_id, RuntimeError(f"{method} failed in shard {index}: {str(e)}")))
+
+    def forward_event(room_code, event_type):
+        # With the room's version, so the router knows whether its cached summary is older
+        summary = state.get_room_summary(room_code)
+        send(("event", room_code, (event_type, summary["version"] if summary is not None else None)))
+
+    # The router runs the registered callbacks; the worker's event bus still coalesces
+    state.register_callback("router", forward_event)
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break  # The router is gone
+        if message is None:
+            break
+
+        call_id, method, args = message
+        if method in BLOCKING_METHODS:
+            threading.Thread(target=execute, args=(call_id, method, args), daemon=True).start()
+        else:
+            execute(call_id, method, args)
+
+    # Deliver the last events before the interpreter exits
+    state.flush_events()
+    state.flush_event_log()
+
+
+class Shard:
+    """
+    Connection to one worker process. Any number of threads can call through it at
+    once: each call is tagged with an ID and a reader thread matches up the replies.
+    """
+    def __init__(self, index, event_log_dir, on_event):
+        self.index = index
+        self._on_event = on_event
+
+        env = dict(os.environ, GAME_SHARDS="0", EVENT_LOG_DIR=event_log_dir)
+        authkey = os.urandom(32)
+        env["MAFIA_SHARD_AUTHKEY"] = authkey.hex()
+        self._listener = Listener(authkey=authkey)
+        self.process = subprocess.Popen([sys.executable, "-m", "utils.sharding", str(index), self._listener.address],
+                                        cwd=_APP_ROOT, env=env)
+        self._conn = None
+
+        self._send_lock = threading.Lock()
+        self._call_ids = itertools.count(1)
+        self._pending = {}  # call ID -> Future
+        self._alive = False
+        self._closing = False
+
+    def connect(self):
+        """
+        Wait for the worker to connect back. It does so once its GameState is ready,
+        including replaying its event log.
+
+        Raises:
+            ConnectionError: If the worker exits or doesn't connect in time
+        """
+        # accept() can't time out, so wait for it on a thread and watch the process
+        accepted = []
+        thread = threading.Thread(target=lambda: accepted.append(self._listener.accept()), daemon=True)
+        thread.start()
+        deadline = time.monotonic() + SHARD_START_TIMEOUT
+        while not accepted:
+            if self.process.poll() is not None or time.monotonic() > deadline:
+                self.process.kill()
+                raise ConnectionError(f"Game shard {self.index} failed to start")
+            thread.join(0.05)
+        self._listener.close()
+
+        self._conn = accepted[0]
+        self._alive = True
+        self._reader = threading.Thread(target=self._read, name=f"shard-{self.index}-reader", daemon=True)
+        self._reader.start()
+
+    def submit(self, method, *args):
+        """
+        Send a GameState method call to the worker without waiting for it.
+
+        Returns:
+            Future: Resolves to the method's result, or to the exception it raised;
+                    ConnectionError if the worker process has exited
+        """
+        future = Future()
+        call_id = next(self._call_ids)
+        self._pending[call_id] = future
+        try:
+            if not self._alive:
+                raise ConnectionError(f"Game shard {self.index} has stopped")
+            with self._send_lock:
+                self._conn.send((call_id, method, args))
+        except Exception as e:
+            self._pending.pop(call_id, None)
+            future.set_exception(e)
+        return future
+
+    def call(self, method, *args):
+        """
+        Call a GameState method in the worker and wait for the result. Exceptions
+        raised in the worker are re-raised here.
+        """
+        return self.submit(method, *args).result()
+
+    def _read(self):
+        while True:
+            try:
+                kind, key, value = self._conn.recv()
+            except (EOFError, OSError):
+                break
+
+            if kind == "event":
+                self._on_event(key, *value)
+                continue
+
+            future = self._pending.pop(key, None)
+            if future is None:
+                continue
+            if kind == "error":
+                future.set_exception(value)
+            else:
+                future.set_result(value)
+
+        self._alive = False
+        if not self._closing:
+            print(f"Game shard {self.index} exited unexpectedly")
+        for call_id in list(self._pending):
+            future = self._pending.pop(call_id, None)
+            if future is not None:
+                future.set_exception(ConnectionError(f"Game shard {self.index} has stopped"))
+
+    def close(self, timeout=5.0):
+        """
+        Ask the worker to finish its writes and exit.
+        """
+        self._closing = True
+        if self._alive:
+            try:
+                with self._send_lock:
+                    self._conn.send(None)
+            except OSError:
+                pass
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def _routed(method, changes_room=True):
+    if changes_room:
+        def call(self, room_code, *args):
+            try:
+                return self._shard_for(room_code).call(method, room_code, *args)
+            finally:
+                # Whatever the call changed, the next summary read sees it
+                self._forget_summary(room_code)
+    else:
+        def call(self, room_code, *args):
+            return self._shard_for(room_code).call(method, room_code, *args)
+    call.__name__ = method
+    call.__doc__ = f"Forward GameState.{method} to the shard that owns the room."
+    return call
+
+
+class ShardRouter:
+    """
+    Drop-in replacement for the GameState singleton that spreads rooms over worker
+    processes. Room codes are allocated here, so shards never need to coordinate.
+
+    Everything passed to or returned from a shard is pickled, so room summaries are
+    copies. The router keeps the last summary of each room it has read, until a call
+    through it or an event from the shard says the room has changed, so the pages of
+    one app run cost at most one round trip for the summary. The operation metrics
+    and profiles of GameState calls are collected in the workers.
+    """
+    def __init__(self, shard_count, event_log_dir=EVENT_LOG_DIR):
+        """
+        Args:
+            shard_count (int): Number of worker processes to start
+            event_log_dir (str, optional): Each shard logs to its own subdirectory
+                                           ("shard-<n>") of this directory
+        """
+        self.callbacks = {}
+        self._events = EventBus(self._run_callbacks, name="shard-events", window=0)
+        self._code_allocator = RoomCodeAllocator.from_env()
+        self._drain_state = None
+
+        # room code -> (token, summary or None). Forgetting a room gives it a new token;
+        # a summary read from a shard is only kept if the room's token is unchanged
+        # since the read was sent, so a read racing a change never caches the old state.
+        # Rooms without an entry share _summary_epoch as their token.
+        self._summaries = {}
+        self._summary_tokens = itertools.count(1)
+        self._summary_epoch = next(self._summary_tokens)
+        self._summary_lock = threading.Lock()
+
+        start = time.perf_counter()
+        self.shards = [
+            Shard(index, os.path.join(event_log_dir, f"shard-{index}") if event_log_dir else "",
+                  self._on_shard_event)
+            for index in range(shard_count)
+        ]
+        # The workers start up in parallel
+        for shard in self.shards:
+            shard.connect()
+        print(f"Started {shard_count} game shards in {(time.perf_counter() - start) * 1000:.0f} ms")
+        atexit.register(self.close)
+
+    # Calls about one room go to the shard that owns it. Those that only read the
+    # room leave the cached summary alone; heartbeats and chat don't change it, except
+    # for a player coming online, which the shard's event reports
+    join_game_room = _routed("join_game_room")
+    begin_setup = _routed("begin_setup")
+    update_setup_progress = _routed("update_setup_progress")
+    cancel_setup = _routed("cancel_setup")
+    start_game = _routed("start_game")
+    set_admin_suspect = _routed("set_admin_suspect")
+    process_admin_accusation = _routed("process_admin_accusation")
+    start_discussion = _routed("start_discussion")
+    open_voting = _routed("open_voting")
+    cast_vote = _routed("cast_vote")
+    close_voting = _routed("close_voting")
+    get_clue_context = _routed("get_clue_context", changes_room=False)
+    supply_clue = _routed("supply_clue")
+    get_player_info = _routed("get_player_info", changes_room=False)
+    get_private_view = _routed("get_private_view", changes_room=False)
+    get_mafia_players = _routed("get_mafia_players", changes_room=False)
+    join_as_spectator = _routed("join_as_spectator")
+    remove_spectator = _routed("remove_spectator")
+    heartbeat = _routed("heartbeat", changes_room=False)
+    post_message = _routed("post_message", changes_room=False)
+    get_messages = _routed("get_messages", changes_room=False)
+    wait_for_messages = _routed("wait_for_messages", changes_room=False)
+    get_public_view = _routed("get_public_view", changes_room=False)
+    reset_game = _routed("reset_game")
+    get_room_history = _routed("get_room_history", changes_room=False)
+    expand_room = _routed("expand_room")
+    get_room_memory = _routed("get_room_memory", changes_room=False)
+
+    def _shard_for(self, room_code):
+        return self.shards[shard_index(room_code, len(self.shards))]
+
+    def _summary_token(self, room_code):
+        # Must be called with _summary_lock held
+        entry = self._summaries.get(room_code)
+        return entry[0] if entry is not None else self._summary_epoch
+
+    def _remember_summary(self, room_code, token, summary):
+        """
+        Cache a summary read from a shard, unless the room was forgotten since the
+        read was sent.
+        """
+        with self._summary_lock:
+            if self._summary_token(room_code) != token:
+                return
+            if summary is not None:
+                self._summaries[room_code] = (token, summary)
+                return
+        self._forget_room(room_code)
+
+    def _forget_summary(self, room_code=None, version=None):
+        """
+        Drop the cached summary of one room, or of every room if room_code is None.
+
+        Args:
+            room_code (str, optional): The room that changed
+            version (int, optional): Its version after the change; a cached summary
+                                     that is already this new is kept
+        """
+        with self._summary_lock:
+            if room_code is None:
+                self._summaries.clear()
+                self._summary_epoch = next(self._summary_tokens)
+                return
+            entry = self._summaries.get(room_code)
+            if version is not None and entry is not None and entry[1] is not None \
+                    and entry[1]["version"] >= version:
+                return
+            self._summaries[room_code] = (next(self._summary_tokens), None)
+
+    def _forget_room(self, room_code):
+        """
+        Drop the entry of a room that no longer exists. The new epoch stops reads sent
+        before now from caching the room again.
+        """
+        with self._summary_lock:
+            self._summaries.pop(room_code, None)
+            self._summary_epoch = next(self._summary_tokens)
+
+    def _on_shard_event(self, room_code, event_type, version):
+        # Runs on the shard's reader thread. The room may have changed through no call
+        # of ours (a timer, a player coming online); version is None if it was removed
+        if version is None:
+            self._forget_room(room_code)
+        else:
+            self._forget_summary(room_code, version)
+        self._events.publish(room_code, event_type)
+
+    def get_room_summary(self, room_code):
+        """
+        Get a room's summary, from the cache if the room hasn't changed since it was
+        last read through this router.
+        """
+        with self._summary_lock:
+            entry = self._summaries.get(room_code)
+            if entry is not None and entry[1] is not None:
+                return entry[1]
+            token = self._summary_token(room_code)
+        summary = self._shard_for(room_code).call("get_room_summary", room_code)
+        self._remember_summary(room_code, token, summary)
+        return summary
+
+    def wait_for_change(self, room_code, version, timeout=30.0):
+        """
+        Forward GameState.wait_for_change to the shard that owns the room. The summary
+        it returns is cached, so the run it wakes reads it without a round trip.
+        """
+        with self._summary_lock:
+            token = self._summary_token(room_code)
+        summary = self._shard_for(room_code).call("wait_for_change", room_code, version, timeout)
+        self._remember_summary(room_code, token, summary)
+        return summary
+
+    def _broadcast(self, method, *args):
+        # All shards work on the call at once
+        futures = [shard.submit(method, *args) for shard in self.shards]
+        return [future.result() for future in futures]
+
+    def register_callback(self, callback_id, callback_fn):
+        """
+        Register a callback for changes in any shard. Shards forward their events
+        (already coalesced) and the callbacks run on this process's event bus thread.
+        """
+        self.callbacks[callback_id] = callback_fn
+
+    def unregister_callback(self, callback_id):
+        if callback_id in self.callbacks:
+            del self.callbacks[callback_id]
+
+    def _run_callbacks(self, room_code, event_type):
+        for callback_id, callback_fn in list(self.callbacks.items()):
+            try:
+                callback_fn(room_code, event_type)
+            except Exception as e:
+                game_state._callback_errors_total.inc(callback=callback_id)
+                print(f"Error in callback: {e}")
+
+    def create_game_room(self, admin_name, room_code=None):
+        """
+        Allocate a room code and create the room in the shard that owns it.
+
+        Returns:
+            tuple: (room_code, room_data), or (None, None) while draining
+        """
+        if room_code is not None:
+            return self._shard_for(room_code).call("create_game_room", admin_name, room_code)
+
+        for _ in range(MAX_CREATE_ATTEMPTS):
+            if self._drain_state is not None:
+                return None, None
+            room_code = self._code_allocator.allocate()
+            result = self._shard_for(room_code).call("create_game_room", admin_name, room_code)
+            if result[0] is not None:
+                return result
+            # The shard is draining, or the code is still in use after the counter wrapped
+        return None, None
+
+    def get_all_room_codes(self):
+        return [room_code for codes in self._broadcast("get_all_room_codes") for room_code in codes]
+
+    def count_rooms_by_status(self):
+        counts = dict.fromkeys(game_state.ROOM_STATUSES, 0)
+        for shard_counts in self._broadcast("count_rooms_by_status"):
+            for status, count in shard_counts.items():
+                counts[status] = counts.get(status, 0) + count
+        return counts
+
+    def count_compacted_rooms(self):
+        return sum(self._broadcast("count_compacted_rooms"))
+
+    def cleanup_stale_rooms(self, max_age_hours=24):
+        try:
+            return sum(self._broadcast("cleanup_stale_rooms", max_age_hours))
+        finally:
+            self._forget_summary()
+
+    def compact_rooms(self, ended_after=game_state.ROOM_COMPACT_ENDED_AFTER,
+                      idle_after=game_state.ROOM_COMPACT_IDLE_AFTER):
+        try:
+            return sum(self._broadcast("compact_rooms", ended_after, idle_after))
+        finally:
+            # Compaction republishes summaries without a new version or an event
+            self._forget_summary()
+
+    def get_memory_usage(self, limit=None):
+        """
+        Merge the memory estimates of every shard. Each shard's tracemalloc figures,
+        if tracing, are listed under "shards".
+        """
+        usages = self._broadcast("get_memory_usage", None)
+        rooms = {}
+        by_status = dict.fromkeys(game_state.ROOM_STATUSES, 0)
+        for usage in usages:
+            rooms.update(usage["rooms"])
+            for status, size in usage["bytes_by_status"].items():
+                by_status[status] = by_status.get(status, 0) + size
+
+        largest = sorted(rooms.items(), key=lambda item: item[1]["bytes"], reverse=True)
+        result = {
+            "total_bytes": sum(by_status.values()),
+            "bytes_by_status": by_status,
+            "room_count": len(rooms),
+            "compacted_rooms": sum(usage["compacted_rooms"] for usage in usages),
+            "rooms": dict(largest[:limit] if limit is not None else largest)
+        }
+        if any("tracemalloc" in usage for usage in usages):
+            result["shards"] = [{"tracemalloc": usage.get("tracemalloc")} for usage in usages]
+        return result
+
+    def flush_events(self, timeout=5.0):
+        # Events reach this process only after the shards dispatch them
+        flushed = all(self._broadcast("flush_events", timeout))
+        return self._events.flush(timeout) and flushed
+
+    def get_event_stats(self):
+        stats = self._events.get_stats()
+        stats["shards"] = self._broadcast("get_event_stats")
+        return stats
+
+    def get_timer_stats(self):
+        return {"shards": self._broadcast("get_timer_stats")}
+
+    def flush_event_log(self, timeout=5.0):
+        return all(self._broadcast("flush_event_log", timeout))
+
+    def get_event_log_stats(self):
+        stats = self._broadcast("get_event_log_stats")
+        return {"shards": stats} if any(s is not None for s in stats) else None
+
+    def drain(self):
+        if self._drain_state is None:
+            self._drain_state = "draining"
+        self._broadcast("drain")
+
+    def get_drain_state(self):
+        return self._drain_state
+
+    def export_rooms(self, path):
+        """
+        Export every shard's rooms into one handoff file, which any process can load
+        whatever its shard count.
+
+        Returns:
+            int: Number of rooms exported
+        """
+        self._drain_state = "handed_off"
+        part_paths = [f"{path}.shard-{shard.index}" for shard in self.shards]
+        self._broadcast_each("export_rooms", part_paths)
+
+        rooms = {}
+        for part_path in part_paths:
+            with open(part_path, encoding="utf-8") as f:
+                rooms.update(json.load(f)["rooms"])
+            os.remove(part_path)
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"created": time.time(), "pid": os.getpid(), "rooms": rooms}, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return len(rooms)
+
+    def import_rooms(self, path):
+        """
+        Split a handoff file by owning shard and load each part into its shard.
+
+        Returns:
+            int: Number of rooms imported
+        """
+        with open(path, encoding="utf-8") as f:
+            handoff = json.load(f)
+
+        parts = [{} for _ in self.shards]
+        for room_code, state in handoff["rooms"].items():
+            parts[shard_index(room_code, len(self.shards))][room_code] = state
+
+        part_paths = [f"{path}.shard-{shard.index}" for shard in self.shards]
+        for part_path, rooms in zip(part_paths, parts):
+            with open(part_path, "w", encoding="utf-8") as f:
+                json.dump(dict(handoff, rooms=rooms), f, ensure_ascii=False)
+        try:
+            return sum(self._broadcast_each("import_rooms", part_paths))
+        finally:
+            self._forget_summary()
+            for part_path in part_paths:
+                os.remove(part_path)
+
+    def _broadcast_each(self, method, per_shard_args):
+        # Like _broadcast, with its own argument for each shard
+        futures = [shard.submit(method, arg) for shard, arg in zip(self.shards, per_shard_args)]
+        return [future.result() for future in futures]
+
+    def close(self, timeout=5.0):
+        """
+        Stop the workers after they finish their writes.
+        """
+        for shard in self.shards:
+            shard.close(timeout)
+
+
+if __name__ == "__main__":
+    # Started by Shard as: python -m utils.sharding <index> <router address>
+    _serve_shard(int(sys.argv[1]), Client(sys.argv[2], authkey=bytes.fromhex(os.environ["MAFIA_SHARD_AUTHKEY"])))
@@ -1,6 +1,7 @@
 import asyncio
 import json
 from datetime import datetime
+import threading
 import time
 
 class WebSocketManager:
@@ -100,26 +101,59 @@ _websocket_manager = WebSocketManager()
 def get_websocket_manager():
     return _websocket_manager
 
+# Event loop that broadcasts run on. Connection objects belong to the loop of the
+# server that accepted them, so integrations should hand theirs over with
+# set_event_loop; otherwise a private loop is started on its own thread.
+_loop = None
+_loop_lock = threading.Lock()
+
+def set_event_loop(loop):
+    """
+    Run broadcasts on the given event loop, e.g. the one serving the websockets.
+    Call it from the server's startup hook with asyncio.get_running_loop().
+    
+    Args:
+        loop (asyncio.AbstractEventLoop): A loop running in another thread
+    """
+    global _loop
+    with _loop_lock:
+        _loop = loop
+
+def get_event_loop():
+    """
+    Get the loop broadcasts run on, starting a private one in a daemon thread if
+    none was set.
+    
+    Returns:
+        asyncio.AbstractEventLoop: The broadcast loop
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="websocket-broadcast", daemon=True).start()
+        return _loop
+
 # Callback function for game state changes
 def game_state_callback(room_code, event_type):
     """
-    Callback function to notify connected clients of game state changes
+    Callback function to notify connected clients of game state changes.
+    Schedules the broadcast on the broadcast loop and returns without waiting for it.
     
     Args:
         room_code (str): The room code where the event occurred
         event_type (str): The type of event that occurred
+        
+    Returns:
+        concurrent.futures.Future: Completes when the broadcast has been sent
     """
     message = {
         "event": event_type,
         "room_code": room_code
     }
     
-    # Use asyncio to run the async broadcast function
-    loop = asyncio.get_event_loop()
-    if loop.is_running():
-        asyncio.create_task(_websocket_manager.broadcast_to_room(room_code, message))
-    else:
-        loop.run_until_complete(_websocket_manager.broadcast_to_room(room_code, message))
+    return asyncio.run_coroutine_threadsafe(_websocket_manager.broadcast_to_room(room_code, message),
+                                            get_event_loop())
 
 
 # ==========================================================================
@@ -1,14 +1,47 @@
 import random
 import time
-from .openrouter import generate_mafia_story
+from . import providers, metrics, tracing
 import traceback
-
-def generate_game_story(num_players):
+import textwrap
+import os
+
+# When enabled, the initial story only includes the first clue. Later clues are
+# generated during play (see utils/generation.py) with pre-baked clues as backup.
+LAZY_CLUES = os.getenv("LAZY_CLUES", "false").lower() in ("1", "true", "yes")
+
+# Wall time to produce a story or clue. Outcome is "api" when a provider answered,
+# "fallback" when none was available (or the budget ran out before asking) and
+# "error" when the provider failed and the fallback was used instead.
+story_generation_seconds = metrics.histogram("mafia_story_generation_seconds",
+                                             "Story and clue generation time by outcome",
+                                             ["kind", "outcome"])
+
+# Pre-baked clues used by the fallback story and to back up lazily generated clues
+FALLBACK_CLUES = [
+    # Clues that can be interpreted in multiple ways
+    "ساعة الضحية كانت واقفة عند {}، لكن فيه علامات إن حد غير وقتها عمداً.",
+    "ورقة ممزقة من مذكرات الضحية بتقول إنه كان بيخبي سر خطير عن واحد من الموجودين، لكن مافيش اسم محدد.",
+    "فيه بقعة دم صغيرة على سجادة في مكان بعيد عن مكان الجريمة، ومحدش لاحظها غير شخص واحد.",
+
+    # Clues that point to multiple suspects
+    "بصمات متعددة على {} اللي استخدمت في الجريمة، وكأن فيه أكتر من شخص لمسها.",
+    "الضحية كان عنده ملف فيه معلومات عن ثلاثة من الموجودين، والملف اختفى بعد الجريمة.",
+    "رسالة غامضة وصلت للضحية قبل الحادث بيوم بتقول: 'اللي بتثق فيهم هما اللي هيأذوك'.",
+
+    # Subtle clues that point to the real killer
+    "الضحية كتب اسم مشفر في مذكراته قبل موته، والاسم ده ممكن يشير للقاتل لو حد عرف يفك الشفرة.",
+    "فيه شيء صغير مفقود من مكان الجريمة، والشيء ده ممكن يكون موجود مع القاتل بس محدش يعرف.",
+    "الضحية كان بيتكلم بالتليفون قبل موته بساعة، وقال جملة غريبة ممكن تشير للقاتل لو فهمناها صح."
+]
+
+def generate_game_story(num_players, timeout=None, lazy_clues=None):
     """
     Generate a story for the game with the given number of players.
 
     Args:
         num_players (int): Number of players in the game
+        timeout (float, optional): Seconds to wait for the API before falling back
+        lazy_clues (bool, optional): Only generate the first clue up front, defaults to LAZY_CLUES
 
     Returns:
         dict: The generated story data
@@ -17,23 +50,56 @@ def generate_game_story(num_players):
     if num_players < 3:
         raise ValueError("Minimum 3 players required for a Mafia game")
 
-    # Check if we have a valid API key before attempting to call the API
-    from .openrouter import OPENROUTER_API_KEY
+    with tracing.span("story.generate", players=num_players) as span:
+        start = time.perf_counter()
+
+        # If no provider is usable (e.g. no OpenRouter API key), use fallback immediately
+        if not providers.has_available_provider():
+            print(f"No story generation provider available (LLM_PROVIDER={providers.LLM_PROVIDER}). Using fallback story generator.")
+            story_data = generate_fallback_story(num_players)
+            _record_outcome(span, start, "fallback")
+            return story_data
+
+        if lazy_clues is None:
+            lazy_clues = LAZY_CLUES
+        span.set_attribute("lazy_clues", lazy_clues)
+
+        # Try to generate the story using the configured provider(s)
+        try:
+            story_data = providers.generate_story(num_players, timeout=timeout, lazy_clues=lazy_clues)
+
+            if lazy_clues:
+                # Placeholders for the later clues, replaced if generation finishes in time
+                story_data["clues"].extend(generate_fallback_clues(2))
+                story_data["lazy_clues"] = True
+
+            _record_outcome(span, start, "api")
+            return story_data
+        except Exception as e:
+            print(f"Error generating story from API: {str(e)}")
+            print(traceback.format_exc())
+            span.set_attribute("error", str(e))
+            # Fall back to a pre-defined template if API fails
+            story_data = generate_fallback_story(num_players)
+            _record_outcome(span, start, "error")
+            return story_data
+
+def _record_outcome(span, start, outcome):
+    story_generation_seconds.observe(time.perf_counter() - start, kind="story", outcome=outcome)
+    span.set_attribute("outcome", outcome)
+
+def generate_fallback_clues(count):
+    """
+    Pick pre-baked clues that do not depend on story details.
 
-    # If no API key is available or it's empty, use fallback immediately
-    if not OPENROUTER_API_KEY or OPENROUTER_API_KEY.strip() == "":
-        print("No valid OpenRouter API key found. Using fallback story generator.")
-        return generate_fallback_story(num_players)
+    Args:
+        count (int): Number of clues to return
 
-    # Try to generate the story using OpenRouter API
-    try:
-        story_data = generate_mafia_story(num_players)
-        return story_data
-    except Exception as e:
-        print(f"Error generating story from API: {str(e)}")
-        print(traceback.format_exc())
-        # Fall back to a pre-defined template if API fails
-        return generate_fallback_story(num_players)
+    Returns:
+        list: Clue strings
+    """
+    generic_clues = [clue for clue in FALLBACK_CLUES if "{}" not in clue]
+    return random.sample(generic_clues, count)
 
 def generate_fallback_story(num_players):
     """
@@ -141,23 +207,6 @@ def generate_fallback_story(num_players):
         "تمثال ثقيل"
     ]
 
-    # Create a list of possible clues - more complex and ambiguous
-    possible_clues = [
-        # Clues that can be interpreted in multiple ways
-        "ساعة الضحية كانت واقفة عند {}، لكن فيه علامات إن حد غير وقتها عمداً.",
-        "ورقة ممزقة من مذكرات الضحية بتقول إنه كان بيخبي سر خطير عن واحد من الموجودين، لكن مافيش اسم محدد.",
-        "فيه بقعة دم صغيرة على سجادة في مكان بعيد عن مكان الجريمة، ومحدش لاحظها غير شخص واحد.",
-
-        # Clues that point to multiple suspects
-        "بصمات متعددة على {} اللي استخدمت في الجريمة، وكأن فيه أكتر من شخص لمسها.",
-        "الضحية كان عنده ملف فيه معلومات عن ثلاثة من الموجودين، والملف اختفى بعد الجريمة.",
-        "رسالة غامضة وصلت للضحية قبل الحادث بيوم بتقول: 'اللي بتثق فيهم هما اللي هيأذوك'.",
-
-        # Subtle clues that point to the real killer
-        "الضحية كتب اسم مشفر في مذكراته قبل موته، والاسم ده ممكن يشير للقاتل لو حد عرف يفك الشفرة.",
-        "فيه شيء صغير مفقود من مكان الجريمة، والشيء ده ممكن يكون موجود مع القاتل بس محدش يعرف.",
-        "الضحية كان بيتكلم بالتليفون قبل موته بساعة، وقال جملة غريبة ممكن تشير للقاتل لو فهمناها صح."
-    ]
 
     # Randomly select elements for the story
     setting = random.choice(settings)
@@ -168,7 +217,7 @@ def generate_fallback_story(num_players):
     random_time = f"{random.randint(10, 11)}:{random.randint(30, 59)} مساءً"
 
     # Select and format clues
-    selected_clues = random.sample(possible_clues, 3)
+    selected_clues = random.sample(FALLBACK_CLUES, 3)
     formatted_clues = []
     for clue in selected_clues:
         if "{}" in clue:
@@ -417,4 +466,89 @@ def format_game_results(winner, suspected_player=None, character_name=None):
         The town has descended into darkness as the killer's influence continues unchecked.
 
         Better luck next time, civilians!
-        """
\ No newline at end of file
+        """
+
+def format_vote_result(result):
+    """
+    Format the outcome of a closed vote.
+
+    Args:
+        result (dict): Vote result from game_state.close_voting or the room summary
+
+    Returns:
+        str: Formatted result
+    """
+    tied = " and ".join(f"**{player}**" for player in result["tied"])
+    if result["revote"]:
+        return f"### The round {result['round']} vote is tied\n\n{tied} face a second vote."
+
+    accused = result["accused"]
+    if accused is None:
+        reason = f"the vote was tied between {tied}" if tied else "no votes were cast"
+        return f"### Round {result['round']} vote: nobody was voted out\n\n{reason.capitalize()}."
+
+    votes = result["tallies"][accused]
+    message = f"### Round {result['round']} vote: **{accused}** was voted out with {votes} vote{'s' if votes != 1 else ''}"
+    if tied:
+        message += f"\n\nThe vote was tied between {tied}; {accused} was drawn at random."
+    if result.get("is_mafia"):
+        message += f"\n\n{result['character_name']} was the Mafia!"
+    else:
+        message += f"\n\n{result['character_name']} was not the Mafia."
+    return message
+
+
+def format_public_view(view):
+    """
+    Format what spectators see of a room: the players, the story and clues revealed
+    so far, and the result once the game is over. Never includes anyone's role
+    before the game ends.
+
+    Args:
+        view (dict): Public room view from game_state.get_public_view
+
+    Returns:
+        str: Formatted view
+    """
+    status = view["status"]
+    sections = []
+
+    if status == "lobby":
+        sections.append("# Waiting for the game to start")
+    elif status == "setup":
+        sections.append(f"# The story is being written\n\n_{view.get('setup_progress') or 'Creating story...'}_")
+
+    # Eliminated players are struck through
+    player_lines = []
+    for player in view["players"]:
+        label = f"{player} (Admin)" if player == view["admin"] else player
+        if player in view["eliminated_players"]:
+            label = f"~~{label}~~"
+        player_lines.append(f"- {label}")
+    sections.append("## Players\n\n" + "\n".join(player_lines))
+
+    if status in ["playing", "ended"] and view.get("main_story"):
+        sections.append(format_main_story(view))
+
+        clues = view.get("revealed_clues") or ()
+        if clues:
+            sections.append("## Discovered Clues\n\n" + "\n\n".join(
+                format_clue(clue, i + 1, len(clues)) for i, clue in enumerate(clues)))
+
+    if status == "playing":
+        sections.append(f"## Round {view['current_round']}")
+        if view.get("current_suspect"):
+            sections.append(f"The admin suspects **{view['current_suspect']}**.")
+        vote = view.get("vote")
+        if vote:
+            tallies = ", ".join(f"{player}: {count}" for player, count in vote["tallies"].items())
+            sections.append(f"Voting: {len(vote['voted'])} of {len(vote['voters'])} votes in ({tallies}).")
+        if view.get("vote_result"):
+            sections.append(format_vote_result(view["vote_result"]))
+    elif status == "ended":
+        killer = view.get("killer") or {}
+        winner = "civilians" if view.get("game_result") == "civilians_win" else "mafia"
+        sections.append(textwrap.dedent(format_game_results(winner, killer.get("player"),
+                                                           killer.get("character_name"))).strip())
+
+    return "\n\n".join(sections) + "\n"
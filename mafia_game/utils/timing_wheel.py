@@ -0,0 +1,248 @@
+import os
+import math
+import time
+import threading
+
+from . import metrics
+
+# Resolution of game timers in seconds. Timers fire up to one tick late, never early.
+TIMER_TICK = float(os.getenv("TIMER_TICK", "0.1"))
+
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS  # Slots per level
+LEVELS = 4  # With 0.1 s ticks the top level reaches about 194 days
+
+_timers_fired_total = metrics.counter("mafia_timers_fired_total", "Game timers fired, by wheel", ["wheel"])
+_timer_lag_seconds = metrics.histogram("mafia_timer_lag_seconds",
+                                       "Time between a game timer's deadline and firing it")
+
+
+class WheelTimer:
+    """
+    Handle for a timer scheduled on a TimingWheel.
+    """
+    __slots__ = ("wheel", "deadline", "expiry", "fn", "args", "slot", "cancelled")
+
+    def __init__(self, wheel, deadline, expiry, fn, args):
+        self.wheel = wheel
+        self.deadline = deadline  # time.monotonic() value
+        self.expiry = expiry  # Tick the timer fires on
+        self.fn = fn
+        self.args = args
+        self.slot = None  # The slot holding the timer until it is due
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Stop the timer from firing. Does nothing if it already has.
+
+        Returns:
+            bool: True if the timer was stopped before firing
+        """
+        return self.wheel.cancel(self)
+
+
+class TimingWheel:
+    """
+    Hierarchical timing wheel: LEVELS rings of SLOTS slots, each level's slots
+    spanning SLOTS times as many ticks as the level below. A timer goes in the
+    lowest level whose range reaches its deadline, and moves down a level each time
+    the wheel reaches its slot, until it is in the bottom ring and fires. Scheduling
+    and cancelling are O(1) whatever the number of timers, and each tick only looks
+    at the slots that are due.
+
+    One thread advances the wheel and runs the due timers in deadline order. Timers
+    run on that thread, outside the wheel's lock, so they must be quick and must not
+    wait for other timers.
+    """
+    def __init__(self, tick=None, name="timing-wheel"):
+        """
+        Args:
+            tick (float, optional): Seconds per tick, defaults to TIMER_TICK
+            name (str): Name of the wheel's thread and its metrics label
+        """
+        self.tick = tick or TIMER_TICK
+        self.name = name
+        self._origin = time.monotonic()
+        self._current = 0  # Last tick processed
+        # Each slot is a dict used as an ordered set, so a timer is removed in O(1)
+        self._levels = [[{} for _ in range(SLOTS)] for _ in range(LEVELS)]
+        self._count = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self._fired = _timers_fired_total.labels(wheel=name)
+        self._lag = _timer_lag_seconds.labels()
+        self.stats = {"scheduled": 0, "cancelled": 0, "fired": 0, "errors": 0, "cascaded": 0,
+                      "max_lag_seconds": 0.0}
+
+    def _expiry_tick(self, deadline):
+        # The first tick at or after the deadline
+        return math.ceil((deadline - self._origin) / self.tick)
+
+    def _elapsed_ticks(self, now):
+        # The last tick that has passed
+        return math.floor((now - self._origin) / self.tick)
+
+    def schedule(self, delay, fn, *args):
+        """
+        Call fn(*args) on the wheel's thread after delay seconds.
+
+        Args:
+            delay (float): Seconds from now; zero or less fires on the next tick
+            fn (callable): The function to call
+            *args: Arguments for fn
+
+        Returns:
+            WheelTimer: Handle for cancelling the timer
+        """
+        now = time.monotonic()
+        with self._cond:
+            idle = self._count == 0
+            if idle:
+                # Nothing is due, so skip the idle ticks instead of stepping through them
+                self._current = max(self._current, self._elapsed_ticks(now))
+            deadline = now + max(0.0, delay)
+            timer = WheelTimer(self, deadline, max(self._expiry_tick(deadline), self._current + 1), fn, args)
+            self._insert(timer)
+            self._count += 1
+            self.stats["scheduled"] += 1
+            if self._thread is None:
+                # Started lazily so importing the module has no side effects
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+            elif idle:
+                # The thread sleeps until a timer is scheduled. With timers pending it
+                # already wakes every tick, and this one can't be due before the next.
+                self._cond.notify()
+        return timer
+
+    def cancel(self, timer):
+        """
+        Cancel a timer. Does nothing if it has already fired or been cancelled.
+
+        Args:
+            timer (WheelTimer): Handle returned by schedule
+
+        Returns:
+            bool: True if the timer was stopped before firing
+        """
+        with self._cond:
+            if timer.cancelled:
+                return False
+            timer.cancelled = True
+            if timer.slot is not None:
+                # Still on the wheel; otherwise it is due and the thread skips it
+                del timer.slot[timer]
+                timer.slot = None
+                self._count -= 1
+            self.stats["cancelled"] += 1
+            return True
+
+    def _insert(self, timer):
+        # Must be called with the lock held. expiry >= _current here; a timer due
+        # on the current tick goes in the bottom slot that is about to be fired.
+        delta = timer.expiry - self._current
+        level = 0
+        while level < LEVELS - 1 and delta >= SLOTS << (SLOT_BITS * level):
+            level += 1
+        # Deadlines beyond the top level wait in its furthest slot and are re-placed
+        # when the wheel gets there
+        if delta >= SLOTS << (SLOT_BITS * level):
+            index = (self._current >> (SLOT_BITS * level)) - 1
+        else:
+            index = timer.expiry >> (SLOT_BITS * level)
+        slot = self._levels[level][index & (SLOTS - 1)]
+        slot[timer] = None
+        timer.slot = slot
+
+    def _advance(self, target):
+        """
+        Process every tick up to target and take the timers that are due. Must be
+        called with the lock held.
+
+        Returns:
+            list: The due timers, in deadline order
+        """
+        due = []
+        while self._current < target:
+            self._current += 1
+            # When a level's index wraps, move the next slot of the level above down
+            for level in range(1, LEVELS):
+                if self._current & ((1 << (SLOT_BITS * level)) - 1):
+                    break
+                slot = self._levels[level][(self._current >> (SLOT_BITS * level)) & (SLOTS - 1)]
+                if slot:
+                    timers = list(slot)
+                    slot.clear()
+                    self.stats["cascaded"] += len(timers)
+                    for timer in timers:
+                        self._insert(timer)
+
+            slot = self._levels[0][self._current & (SLOTS - 1)]
+            if slot:
+                for timer in slot:
+                    timer.slot = None
+                due.extend(slot)
+                self._count -= len(slot)
+                slot.clear()
+            if self._count == 0:
+                # Nothing left to cascade or fire, so skip straight to the target
+                self._current = target
+        due.sort(key=lambda timer: timer.deadline)
+        return due
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    now = time.monotonic()
+                    target = self._elapsed_ticks(now)
+                    if self._count and target > self._current:
+                        break
+                    # Sleep until the next tick, or until a timer is scheduled if none are pending
+                    next_tick = self._origin + (self._current + 1) * self.tick
+                    self._cond.wait(max(next_tick - now, 0.001) if self._count else None)
+                due = self._advance(target)
+
+            now = time.monotonic()
+            for timer in due:
+                # A timer taken off the wheel can still be cancelled until it runs
+                with self._cond:
+                    if timer.cancelled:
+                        continue
+                    timer.cancelled = True
+                lag = max(0.0, now - timer.deadline)
+                self._lag.observe(lag)
+                self._fired.inc()
+                self.stats["fired"] += 1
+                self.stats["max_lag_seconds"] = max(self.stats["max_lag_seconds"], lag)
+                try:
+                    timer.fn(*timer.args)
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    print(f"Error in timer {getattr(timer.fn, '__name__', timer.fn)}: {str(e)}")
+
+    def stop(self):
+        """
+        Stop the wheel's thread. Pending timers never fire.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def __len__(self):
+        return self._count
+
+    def get_stats(self):
+        """
+        Returns:
+            dict: Timers scheduled, cancelled, fired and pending, and the worst lag
+        """
+        with self._cond:
+            stats = dict(self.stats)
+            stats["pending"] = self._count
+        stats["tick_seconds"] = self.tick
+        return stats
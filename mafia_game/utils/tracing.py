@@ -0,0 +1,373 @@
+import os
+import json
+import time
+import queue
+import atexit
+import threading
+import contextvars
+from contextlib import contextmanager
+
+import requests
+
+# Tracing is off unless a destination is configured. With neither set, spans are
+# shared no-op objects and cost one context variable lookup.
+TRACE_FILE = os.getenv("TRACE_FILE", "")  # Append finished spans to this JSONL file
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "")  # e.g. http://127.0.0.1:4318/v1/traces
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "mafia-game")
+TRACE_FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", "2"))  # Seconds between export batches
+
+MAX_BATCH = 512
+
+# The active span for the current thread or task. Copy the context
+# (contextvars.copy_context) to carry it to another thread, as the scheduler does.
+_current_span = contextvars.ContextVar("mafia_current_span", default=None)
+
+
+def _new_id(num_bytes):
+    return os.urandom(num_bytes).hex()
+
+
+class Span:
+    """
+    A timed operation within a trace. Spans nest through the current context; a span
+    started with no current span begins a new trace.
+    """
+    def __init__(self, name, trace_id, parent_id=None, attributes=None, start_ns=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.attributes.setdefault("thread.name", threading.current_thread().name)
+        self.start_ns = start_ns if start_ns is not None else time.time_ns()
+        self.end_ns = None
+        self.status = "unset"
+        self.status_message = None
+        self._lock = threading.Lock()
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+
+    def set_status(self, status, message=None):
+        """
+        Args:
+            status (str): "ok" or "error"
+            message (str, optional): Error description
+        """
+        self.status = status
+        self.status_message = message
+
+    def end(self, end_ns=None):
+        """
+        Finish the span and queue it for export. Later calls are ignored, so a span
+        can safely be ended from whichever thread finishes the work first.
+        """
+        with self._lock:
+            if self.end_ns is not None:
+                return
+            self.end_ns = end_ns if end_ns is not None else time.time_ns()
+
+        exporter = _exporter
+        if exporter is not None:
+            exporter.export(self)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_time_unix_nano": self.start_ns,
+            "end_time_unix_nano": self.end_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3) if self.end_ns else None,
+            "status": self.status,
+            "status_message": self.status_message,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    """
+    Stand-in returned while tracing is disabled.
+    """
+    trace_id = span_id = parent_id = None
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, **attributes):
+        pass
+
+    def set_status(self, status, message=None):
+        pass
+
+    def end(self, end_ns=None):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class JsonlSink:
+    """
+    Appends one JSON object per span to a file.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, spans):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n")
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [_otlp_value(v) for v in value]}}
+    return {"stringValue": str(value)}
+
+
+class OtlpSink:
+    """
+    Posts spans to an OTLP/HTTP collector using the JSON encoding.
+    """
+    STATUS_CODES = {"unset": 0, "ok": 1, "error": 2}
+
+    def __init__(self, endpoint, service_name, timeout=5.0):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.timeout = timeout
+
+    def encode(self, spans):
+        otlp_spans = []
+        for span in spans:
+            entry = {
+                "traceId": span.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": 1,  # SPAN_KIND_INTERNAL
+                "startTimeUnixNano": str(span.start_ns),
+                "endTimeUnixNano": str(span.end_ns),
+                "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in span.attributes.items()],
+                "status": {"code": self.STATUS_CODES.get(span.status, 0)},
+            }
+            if span.parent_id:
+                entry["parentSpanId"] = span.parent_id
+            if span.status_message:
+                entry["status"]["message"] = span.status_message
+            otlp_spans.append(entry)
+
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+            "scopeSpans": [{"scope": {"name": "mafia_game"}, "spans": otlp_spans}],
+        }]}
+
+    def write(self, spans):
+        response = requests.post(self.endpoint, json=self.encode(spans), timeout=self.timeout)
+        if response.status_code >= 300:
+            raise ValueError(f"collector returned {response.status_code}")
+
+
+class SpanExporter:
+    """
+    Collects finished spans on a queue and writes them to the sinks in batches from a
+    background thread, so request paths never wait on the disk or the collector.
+    """
+    def __init__(self, sinks, flush_interval=TRACE_FLUSH_INTERVAL):
+        self.sinks = sinks
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._flushed = threading.Condition()
+        self._pending = 0
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+        self._thread.start()
+
+    def export(self, span):
+        with self._flushed:
+            self._pending += 1
+        self._queue.put(span)
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                if self._stopped:
+                    return
+                continue
+
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for sink in self.sinks:
+                try:
+                    sink.write(batch)
+                except Exception as e:
+                    print(f"Error exporting {len(batch)} spans to {sink.__class__.__name__}: {str(e)}")
+
+            with self._flushed:
+                self._pending -= len(batch)
+                self._flushed.notify_all()
+
+    def flush(self, timeout=5.0):
+        """
+        Wait until every span exported so far has been written.
+
+        Returns:
+            bool: True if the queue drained before the timeout
+        """
+        deadline = time.monotonic() + timeout
+        with self._flushed:
+            while self._pending > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._flushed.wait(remaining)
+        return True
+
+    def shutdown(self, timeout=5.0):
+        self.flush(timeout)
+        self._stopped = True
+
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def configure(trace_file=None, otlp_endpoint=None, service_name=None):
+    """
+    Enable (or, with no destinations, disable) tracing. Called at import with the
+    TRACE_* environment variables; call it again to redirect spans at runtime.
+
+    Args:
+        trace_file (str, optional): JSONL file to append spans to
+        otlp_endpoint (str, optional): OTLP/HTTP JSON traces endpoint
+        service_name (str, optional): service.name resource attribute for OTLP
+    """
+    global _exporter
+
+    sinks = []
+    if trace_file:
+        sinks.append(JsonlSink(trace_file))
+    if otlp_endpoint:
+        sinks.append(OtlpSink(otlp_endpoint, service_name or TRACE_SERVICE_NAME))
+
+    with _exporter_lock:
+        previous = _exporter
+        _exporter = SpanExporter(sinks) if sinks else None
+    if previous is not None:
+        previous.shutdown()
+
+
+def is_enabled():
+    return _exporter is not None
+
+
+def flush(timeout=5.0):
+    """
+    Write out all finished spans. Returns True if everything was written in time.
+    """
+    exporter = _exporter
+    return exporter.flush(timeout) if exporter is not None else True
+
+
+def current_span():
+    """
+    Get the active span, or a no-op span if there is none.
+    """
+    return _current_span.get() or NOOP_SPAN
+
+
+def start_span(name, parent=None, start_ns=None, **attributes):
+    """
+    Start a span without making it current. The caller must end() it, which allows a
+    span to outlive the function (or thread) that started it.
+
+    Args:
+        name (str): Span name
+        parent (Span, optional): Parent span, defaults to the current span
+        start_ns (int, optional): Start time in time.time_ns() units, defaults to now
+        **attributes: Initial attributes
+
+    Returns:
+        Span: The new span, or NOOP_SPAN when tracing is disabled
+    """
+    if _exporter is None:
+        return NOOP_SPAN
+
+    if parent is None:
+        parent = _current_span.get()
+    if parent is None or parent is NOOP_SPAN:
+        return Span(name, _new_id(16), None, attributes, start_ns)
+    return Span(name, parent.trace_id, parent.span_id, attributes, start_ns)
+
+
+@contextmanager
+def use_span(span):
+    """
+    Make an existing span current for a with-block without ending it.
+    """
+    token = _current_span.set(span)
+    try:
+        yield span
+    finally:
+        _current_span.reset(token)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Trace a with-block as a child of the current span. An exception marks the span as
+    an error and is re-raised.
+
+    Example:
+        with tracing.span("story.validate", players=5) as s:
+            s.set_attribute("repairs", 0)
+    """
+    if _exporter is None:
+        yield NOOP_SPAN
+        return
+
+    current = start_span(name, **attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.set_status("error", f"{e.__class__.__name__}: {e}")
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end()
+
+
+def record_span(name, duration, **attributes):
+    """
+    Record a span that has already finished, e.g. time spent waiting in a queue. Only
+    recorded inside an existing trace, so untraced work doesn't produce stray traces.
+
+    Args:
+        name (str): Span name
+        duration (float): Seconds, ending now
+    """
+    if _exporter is None or _current_span.get() is None:
+        return
+    end_ns = time.time_ns()
+    finished = start_span(name, start_ns=end_ns - int(duration * 1e9), **attributes)
+    finished.end(end_ns)
+
+
+configure(TRACE_FILE, TRACE_OTLP_ENDPOINT)
+atexit.register(lambda: _exporter.shutdown() if _exporter is not None else None)